@@ -23,6 +23,9 @@ bcrypt = Bcrypt(app)
 # Initialize Flask Sql Alchemy
 db = SQLAlchemy(app)
 
+# Commit once per request
+from app import unit_of_work
+
 # Import the application views
 from app import views
 
@@ -39,6 +42,10 @@ from app.postitems.views import postitems
 
 app.register_blueprint(postitems, url_prefix='/v1')
 
+from app.search.views import search
+
+app.register_blueprint(search, url_prefix='/v1')
+
 from app.docs.views import docs
 
 app.register_blueprint(docs)
@@ -1,7 +1,40 @@
 from flask import request, make_response, jsonify
+from app import app, metrics
+from app.cache import LRUCache
 from app.models import User
+from app.unit_of_work import on_commit
 from functools import wraps
 
+# Verified tokens of this worker mapped to their (user id, token epoch) claims
+token_cache = LRUCache(app.config.get('TOKEN_CACHE_SIZE', 10000), app.config.get('TOKEN_CACHE_TTL_SECONDS', 60))
+metrics.register('tokenCache', token_cache.stats)
+
+
+class CurrentUser:
+    """
+    Principal of an authenticated request, built from the verified token claims.
+    The User row is only loaded the first time an attribute other than the claims
+    is accessed, so views that only need the user Id never query the users table.
+    """
+
+    def __init__(self, user_id, token_epoch=0):
+        self.id = user_id
+        self.token_epoch = token_epoch
+        self._user = None
+
+    @property
+    def user(self):
+        """
+        Load the User row on first use.
+        :return: User
+        """
+        if self._user is None:
+            self._user = User.get_by_id(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        return getattr(self.user, name)
+
 
 def token_required(f):
     """
@@ -31,23 +64,44 @@ def token_required(f):
                 'message': 'Token is missing'
             })), 401
 
-        try:
-            decode_response = User.decode_auth_token(token)
-            current_user = User.query.filter_by(id=decode_response).first()
-        except:
-            message = 'Invalid token'
-            if isinstance(decode_response, str):
-                message = decode_response
-            return make_response(jsonify({
-                'status': 'failed',
-                'message': message
-            })), 401
+        claims = token_cache.get(token)
+        if claims is None:
+            payload = User.verify_auth_token(token)
+            if isinstance(payload, str):
+                return make_response(jsonify({
+                    'status': 'failed',
+                    'message': payload
+                })), 401
+            claims = (payload['sub'], payload.get('epoch', 0))
+            token_cache.set(token, claims, payload['exp'])
 
+        current_user = CurrentUser(*claims)
         return f(current_user, *args, **kwargs)
 
     return decorated_function
 
 
+def invalidate_token(token):
+    """
+    Remove a token from the verified token cache once the current transaction commits,
+    for example on logout. Evicting it earlier would let a concurrent request cache
+    it again before its blacklisting is visible.
+    :param token: Auth token
+    :return:
+    """
+    on_commit(lambda: token_cache.delete(token))
+
+
+def invalidate_user_tokens(user_id):
+    """
+    Remove all the cached tokens of a user once the current transaction commits, for
+    example after a password reset.
+    :param user_id: User Id
+    :return:
+    """
+    on_commit(lambda: token_cache.delete_where(lambda claims: claims[0] == user_id))
+
+
 def response(status, message, status_code):
     """
     Helper method to make an Http response
@@ -62,17 +116,47 @@ def response(status, message, status_code):
     })), status_code
 
 
-def response_auth(status, message, token, status_code):
+def response_auth(status, message, token, status_code, refresh_token=None):
     """
     Make a Http response to send the auth token
     :param status: Status
     :param message: Message
     :param token: Authorization Token
     :param status_code: Http status code
+    :param refresh_token: Refresh token, included when set
     :return: Http Json response
     """
-    return make_response(jsonify({
+    body = {
         'status': status,
         'message': message,
         'auth_token': token.decode("utf-8")
-    })), status_code
+    }
+    if refresh_token:
+        body['refresh_token'] = refresh_token
+    return make_response(jsonify(body)), status_code
+
+
+def response_throttled(retry_after):
+    """
+    Make a 429 Http response telling the client when to retry.
+    :param retry_after: Seconds to wait before retrying
+    :return: Http Json response
+    """
+    http_response, status_code = response('failed', 'Too many attempts, please try again later', 429)
+    http_response.headers['Retry-After'] = str(retry_after)
+    return http_response, status_code
+
+
+def client_address():
+    """
+    Address of the client of the current request. Behind TRUSTED_PROXY_HOPS proxies,
+    such as the Heroku router, every client reaches the app from a proxy address, so
+    it is read from X-Forwarded-For instead. Each proxy appends the address it got
+    the request from, the entries further left are sent by the client and ignored.
+    :return: Client IP address
+    """
+    hops = app.config['TRUSTED_PROXY_HOPS']
+    forwarded = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',')]
+    if hops and len(forwarded) >= hops and forwarded[-hops]:
+        return forwarded[-hops]
+    return request.remote_addr
@@ -0,0 +1,120 @@
+from app import db
+from app.hashing import hasher
+from app.models import User
+from sqlalchemy import exc
+import csv
+import datetime
+import json
+import re
+import time
+
+
+def read_users(path):
+    """
+    Read user records from a CSV file with email and password columns, or from a
+    newline delimited json file (.ndjson or .jsonl) of objects with the same keys.
+    The json lines that cannot be decoded are read as None records.
+    :param path: Path of the file
+    :return: Generator of records, dictionaries when valid
+    """
+    with open(path, newline='') as users_file:
+        if path.endswith(('.ndjson', '.jsonl')):
+            for line in users_file:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        yield None
+        else:
+            for row in csv.DictReader(users_file):
+                yield row
+
+
+def batches(records, batch_size):
+    """
+    Split an iterable of records into lists of at most batch_size records.
+    :param records: Iterable
+    :param batch_size: Batch size
+    :return: Generator of lists
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def valid_user(record):
+    """
+    Read the email and password of a user record.
+    :param record: Record read from the import file
+    :return: Email and password or None if the record is not a valid user
+    """
+    if not isinstance(record, dict):
+        return None
+    email, password = record.get('email') or '', record.get('password') or ''
+    if not isinstance(email, str) or not isinstance(password, str):
+        return None
+    email = email.strip()
+    if not re.match(r"[^@]+@[^@]+\.[^@]+", email) or not len(password) > 4:
+        return None
+    return email, password
+
+
+def insert_users(hashes):
+    """
+    Insert the users of a batch in one transaction. The users registered since their
+    emails were looked up make the insert fail, they are looked up again and skipped.
+    :param hashes: Dictionary of the emails to their password hashes
+    :return: Number of users inserted
+    """
+    registered_on = datetime.datetime.now()
+    while hashes:
+        try:
+            db.session.bulk_insert_mappings(User, [
+                {'email': email, 'password': pw_hash, 'registered_on': registered_on, 'token_epoch': 0}
+                for email, pw_hash in hashes.items()
+            ])
+            db.session.commit()
+            break
+        except exc.IntegrityError:
+            db.session.rollback()
+            registered = {email for email, in db.session.query(User.email).filter(User.email.in_(list(hashes)))}
+            if not registered:
+                raise
+            hashes = {email: pw_hash for email, pw_hash in hashes.items() if email not in registered}
+    return len(hashes)
+
+
+def provision_users(records, batch_size=1000):
+    """
+    Create users in bulk. For each batch the existing emails are looked up with a single
+    query, the passwords of the new users are hashed across all cores and the users are
+    inserted in one transaction.
+    :param records: Iterable of records, dictionaries with email and password keys
+    :param batch_size: Number of users per transaction
+    :return: Dictionary with the created, skipped and invalid counts and the elapsed seconds
+    """
+    result = {'created': 0, 'skipped': 0, 'invalid': 0}
+    start = time.time()
+    for batch in batches(records, batch_size):
+        users = {}
+        for record in batch:
+            user = valid_user(record)
+            if user is None:
+                result['invalid'] += 1
+            elif user[0] in users:
+                result['skipped'] += 1
+            else:
+                users[user[0]] = user[1]
+
+        existing = {email for email, in db.session.query(User.email).filter(User.email.in_(list(users)))}
+        emails = [email for email in users if email not in existing]
+        created = insert_users(dict(zip(emails, hasher.hash_many([users[email] for email in emails]))))
+        result['created'] += created
+        result['skipped'] += len(users) - created
+    result['elapsed'] = time.time() - start
+    return result
@@ -0,0 +1,138 @@
+from app import app, metrics
+import math
+import os
+import sqlite3
+import threading
+import time
+
+
+class Throttle:
+    """
+    Token bucket rate limiter whose buckets live in a SQLite file, so that all the
+    gunicorn workers of a host share the same counts without an external service.
+    Each bucket holds up to `capacity` tokens and refills at capacity / period per second.
+    """
+
+    def __init__(self, config):
+        """
+        :param config: Application config holding the THROTTLE_* settings
+        """
+        self.config = config
+        self.counters = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._purged_at = 0
+
+    def _connection(self):
+        """
+        Return the SQLite connection of the current thread, opening it if needed.
+        :return: sqlite3 Connection
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.config.get('THROTTLE_DB_PATH'), timeout=1, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS buckets '
+                               '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_buckets_updated_at ON buckets (updated_at)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def hit(self, key, capacity, period):
+        """
+        Take a token from the bucket of the key.
+        :param key: Bucket key
+        :param capacity: Bucket size
+        :param period: Seconds it takes to refill an empty bucket
+        :return: Seconds to wait before retrying, 0 when the hit is allowed
+        """
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * capacity / period)
+            retry_after = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) * period / capacity
+            connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)',
+                               (key, tokens, now))
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            connection.execute('ROLLBACK')
+            raise
+        return retry_after
+
+    def check(self, action, email, ip_address):
+        """
+        Check the per email and per client IP buckets of an action. A request rejected
+        by its email bucket takes no token from the client IP bucket, so that guessing
+        the password of one account does not lock out the other users of the address.
+        The throttle fails open if the shared store cannot be used.
+        :param action: Throttled action such as login or register
+        :param email: Email address sent in the request
+        :param ip_address: Client IP address
+        :return: Seconds to wait before retrying, 0 when the request is allowed
+        """
+        if not self.config.get('THROTTLE_ENABLED', True):
+            return 0
+        self._purge_idle()
+        for scope, value in (('email', (email or '').lower()), ('ip', ip_address or '')):
+            capacity, period = self.config['THROTTLE_{}_{}'.format(action.upper(), scope.upper())]
+            try:
+                wait = self.hit('{}:{}:{}'.format(action, scope, value), capacity, period)
+            except sqlite3.Error:
+                self._count('errors')
+                continue
+            if wait:
+                self._count('{}.{}.throttled'.format(action, scope))
+                return int(math.ceil(wait))
+            self._count('{}.{}.allowed'.format(action, scope))
+        return 0
+
+    def _purge_idle(self):
+        """
+        Delete the buckets left idle for longer than the longest refill period, at most
+        once every THROTTLE_PURGE_INTERVAL_SECONDS per worker. Such buckets are full again,
+        the same as no bucket, and the email keys are chosen by the clients so the table
+        would otherwise grow without bound.
+        :return:
+        """
+        now = time.time()
+        if now - self._purged_at < self.config.get('THROTTLE_PURGE_INTERVAL_SECONDS', 60):
+            return
+        self._purged_at = now
+        longest_period = max(value[1] for name, value in self.config.items()
+                             if name.startswith('THROTTLE_') and isinstance(value, tuple))
+        try:
+            self._connection().execute('DELETE FROM buckets WHERE updated_at < ?', (now - longest_period,))
+        except sqlite3.Error:
+            self._count('errors')
+
+    def reset(self):
+        """
+        Empty all the buckets and reset the counters.
+        :return:
+        """
+        self._connection().execute('DELETE FROM buckets')
+        self._purged_at = 0
+        with self._lock:
+            self.counters = {}
+
+    def stats(self):
+        """
+        Throttle counters for the metrics endpoint.
+        :return: Dictionary of counters
+        """
+        return dict(self.counters)
+
+
+throttle = Throttle(app.config)
+metrics.register('throttle', throttle.stats)
@@ -1,10 +1,11 @@
-from app import bcrypt
 from flask import Blueprint, request
 from flask.views import MethodView
-from app.models import User, BlackListToken
-from app.auth.helper import response, response_auth
+from app.models import User, BlackListToken, RefreshToken
+from app.auth.helper import response, response_auth, response_throttled, client_address
+from app.auth.throttle import throttle
+from app.hashing import hasher
 from sqlalchemy import exc
-from app.auth.helper import token_required
+from app.auth.helper import token_required, invalidate_token, invalidate_user_tokens
 import re
 
 auth = Blueprint('auth', __name__)
@@ -25,10 +26,15 @@ class RegisterUser(MethodView):
             email = post_data.get('email')
             password = post_data.get('password')
             if re.match(r"[^@]+@[^@]+\.[^@]+", email) and len(password) > 4:
+                retry_after = throttle.check('register', email, client_address())
+                if retry_after:
+                    return response_throttled(retry_after)
                 user = User.get_by_email(email)
                 if not user:
-                    token = User(email=email, password=password).save()
-                    return response_auth('success', 'Successfully registered', token, 201)
+                    user = User(email=email, password=password)
+                    token = user.save()
+                    return response_auth('success', 'Successfully registered', token, 201,
+                                         RefreshToken.issue(user.id))
                 else:
                     return response('failed', 'Failed, User already exists, Please sign In', 400)
             return response('failed', 'Missing or wrong email format or password is less than four characters', 400)
@@ -46,9 +52,15 @@ class LoginUser(MethodView):
             email = post_data.get('email')
             password = post_data.get('password')
             if re.match(r"[^@]+@[^@]+\.[^@]+", email) and len(password) > 4:
+                retry_after = throttle.check('login', email, client_address())
+                if retry_after:
+                    return response_throttled(retry_after)
                 user = User.query.filter_by(email=email).first()
-                if user and bcrypt.check_password_hash(user.password, password):
-                    return response_auth('success', 'Successfully logged In', user.encode_auth_token(user.id), 200)
+                if user and hasher.check_password_hash(user.password, password):
+                    if hasher.needs_rehash(user.password):
+                        user.rehash_password(password)
+                    return response_auth('success', 'Successfully logged In', user.encode_auth_token(user.id), 200,
+                                         RefreshToken.issue(user.id))
                 return response('failed', 'User does not exist or password is incorrect', 401)
             return response('failed', 'Missing or wrong email format or password is less than four characters', 401)
         return response('failed', 'Content-type must be json', 202)
@@ -75,11 +87,45 @@ class LogOutUser(MethodView):
                 if not isinstance(decoded_token_response, str):
                     token = BlackListToken(auth_token)
                     token.blacklist()
+                    invalidate_token(auth_token)
+                    post_data = request.get_json(silent=True) or {}
+                    refresh_token = RefreshToken.get_by_token(post_data.get('refresh_token') or '')
+                    if refresh_token and refresh_token.user_id == decoded_token_response:
+                        refresh_token.revoke()
                     return response('success', 'Successfully logged out', 200)
                 return response('failed', decoded_token_response, 401)
         return response('failed', 'Provide an authorization header', 403)
 
 
+class RefreshAuthToken(MethodView):
+    """
+    Exchange a refresh token for a new auth token and a new refresh token
+    """
+
+    def post(self):
+        """
+        Rotate the refresh token sent in the json payload. Presenting a refresh token that was
+        already rotated revokes all the refresh tokens of its user.
+        :return: Http Json response
+        """
+        if request.content_type == 'application/json':
+            post_data = request.get_json()
+            token = post_data.get('refresh_token')
+            if not token:
+                return response('failed', 'Provide a refresh token', 400)
+            refresh_token = RefreshToken.get_by_token(token)
+            if not refresh_token or refresh_token.is_expired():
+                return response('failed', 'Invalid or expired refresh token, Please sign in again', 401)
+            new_refresh_token = refresh_token.rotate()
+            if not new_refresh_token:
+                RefreshToken.revoke_all(refresh_token.user_id)
+                return response('failed', 'Refresh token was revoked, Please sign in again', 401)
+            user = User.get_by_id(refresh_token.user_id)
+            return response_auth('success', 'Successfully refreshed', user.encode_auth_token(user.id), 200,
+                                 new_refresh_token)
+        return response('failed', 'Content-type must be json', 400)
+
+
 @auth.route('/auth/reset/password', methods=['POST'])
 @token_required
 def reset_password(current_user):
@@ -90,23 +136,41 @@ def reset_password(current_user):
         password_confirmation = data.get('passwordConfirmation')
         if not old_password or not new_password or not password_confirmation:
             return response('failed', "Missing required attributes", 400)
-        if bcrypt.check_password_hash(current_user.password, old_password.encode('utf-8')):
+        if hasher.check_password_hash(current_user.password, old_password):
             if not new_password == password_confirmation:
                 return response('failed', 'New Passwords do not match', 400)
             if not len(new_password) > 4:
                 return response('failed', 'New password should be greater than four characters long', 400)
             current_user.reset_password(new_password)
-            return response('success', 'Password reset successfully', 200)
+            invalidate_user_tokens(current_user.id)
+            return response_auth('success', 'Password reset successfully',
+                                 current_user.encode_auth_token(current_user.id), 200,
+                                 RefreshToken.issue(current_user.id))
         return response('failed', "Incorrect password", 401)
     return response('failed', 'Content type must be json', 400)
 
 
+@auth.route('/auth/logout/all', methods=['POST'])
+@token_required
+def logout_all(current_user):
+    """
+    Log a user out of all their sessions by revoking every token issued to them.
+    :param current_user: User
+    :return: Http Json response
+    """
+    current_user.revoke_tokens()
+    invalidate_user_tokens(current_user.id)
+    return response('success', 'Successfully logged out of all sessions', 200)
+
+
 # Register classes as views
 registration_view = RegisterUser.as_view('register')
 login_view = LoginUser.as_view('login')
 logout_view = LogOutUser.as_view('logout')
+refresh_view = RefreshAuthToken.as_view('refresh')
 
 # Add rules for the api Endpoints
 auth.add_url_rule('/auth/register', view_func=registration_view, methods=['POST'])
 auth.add_url_rule('/auth/login', view_func=login_view, methods=['POST'])
 auth.add_url_rule('/auth/logout', view_func=logout_view, methods=['POST'])
+auth.add_url_rule('/auth/refresh', view_func=refresh_view, methods=['POST'])
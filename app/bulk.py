@@ -0,0 +1,59 @@
+from app import app
+from app.multiget import MAX_ID, parse_id
+
+
+class InvalidOperations(ValueError):
+    """
+    Raised when the body of a bulk request is not an array of operations or has too many of them.
+    """
+
+
+def parse_operations(data, key):
+    """
+    Read the array of operations of a bulk request from its json payload. Each operation
+    is a json object, the operations that cannot be applied fail on their own.
+    :param data: Json payload
+    :param key: Key of the array of operations
+    :return: List of the operations
+    """
+    operations = data.get(key) if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations \
+            or not all(isinstance(operation, dict) for operation in operations):
+        raise InvalidOperations('Provide a non empty {} array of json objects'.format(key))
+    maximum = app.config['MAX_BULK_OPERATIONS']
+    if len(operations) > maximum:
+        raise InvalidOperations('At most {} operations can be sent at once'.format(maximum))
+    return operations
+
+
+def operation_id(operation, key='id'):
+    """
+    Read the Id an operation applies to.
+    :param operation: Operation json object
+    :param key: Key of the Id
+    :return: Integer Id or None if it is missing or invalid
+    """
+    value = operation.get(key)
+    if isinstance(value, str):
+        return parse_id(value)
+    if isinstance(value, int) and not isinstance(value, bool) and 1 <= value <= MAX_ID:
+        return value
+    return None
+
+
+def succeeded(**result):
+    """
+    Result of an operation that was applied.
+    :param result: Json of the written resource
+    :return: Dictionary
+    """
+    return dict(result, status='success')
+
+
+def failed(message):
+    """
+    Result of an operation that was not applied.
+    :param message: Reason
+    :return: Dictionary
+    """
+    return {'status': 'failed', 'message': message}
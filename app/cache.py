@@ -0,0 +1,197 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Bounded, thread safe LRU cache whose entries can also carry an expiry time.
+    Each gunicorn worker holds its own instances, so entries must be safe to
+    serve for up to their ttl after they change in another worker.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        """
+        :param max_size: Maximum number of entries kept before the least recently used is evicted
+        :param ttl: Default time to live of an entry in seconds, None means no expiry
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value stored under the key if it exists and has not expired.
+        :param key: Cache key
+        :param default: Value returned on a miss
+        :return:
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, expires_at=None):
+        """
+        Store a value, evicting the least recently used entry when the cache is full.
+        The entry expires at the earlier of expires_at and now + ttl.
+        :param key: Cache key
+        :param value: Value
+        :param expires_at: Optional unix timestamp after which the entry is stale
+        :return:
+        """
+        if self.max_size <= 0:
+            return
+        if self.ttl is not None:
+            ttl_expiry = time.time() + self.ttl
+            expires_at = ttl_expiry if expires_at is None else min(expires_at, ttl_expiry)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Remove a key from the cache if it is present.
+        :param key: Cache key
+        :return:
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        """
+        Remove every entry whose value matches the predicate.
+        :param predicate: Callable receiving the cached value
+        :return: Number of removed entries
+        """
+        with self._lock:
+            keys = [key for key, (value, _) in self._data.items() if predicate(value)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self):
+        """
+        Drop all the entries and reset the counters.
+        :return:
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """
+        Cache counters for the metrics endpoint.
+        :return: Dictionary of counters
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxSize': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hitRatio': round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+class MembershipFilter:
+    """
+    In memory set of keys mirrored from an append only database table.
+    Rows are pulled incrementally at most once every sync_interval seconds,
+    so membership checks only touch the database when the local copy is due
+    for a refresh. Each load overlaps the previous one by `overlap` seconds
+    so rows committed late by slow transactions are not missed.
+    """
+
+    def __init__(self, loader, sync_interval, overlap=30):
+        """
+        :param loader: Callable(since) returning (key, expires_at) tuples for the rows added after since,
+        since is None on the first load
+        :param sync_interval: Seconds between two incremental loads, 0 syncs on every check
+        :param overlap: Seconds each load goes back before the previous one
+        """
+        self.loader = loader
+        self.sync_interval = sync_interval
+        self.overlap = overlap
+        self.syncs = 0
+        self._keys = {}
+        self._last_sync = None
+        self._lock = threading.Lock()
+
+    def contains(self, key):
+        """
+        Check whether a key is a member, pulling rows added by other workers first if due.
+        :param key: Key
+        :return: Boolean
+        """
+        self.sync()
+        expires_at = self._keys.get(key)
+        return expires_at is not None and expires_at > time.time()
+
+    def add(self, key, expires_at):
+        """
+        Add a key written to the database by this worker.
+        :param key: Key
+        :param expires_at: Unix timestamp after which the key no longer needs to be tracked
+        :return:
+        """
+        with self._lock:
+            self._keys[key] = expires_at
+
+    def sync(self, force=False):
+        """
+        Load the rows added since the last sync and drop the expired keys.
+        :param force: Sync even if the interval has not elapsed
+        :return:
+        """
+        now = time.time()
+        if not force and self._last_sync is not None and now - self._last_sync < self.sync_interval:
+            return
+        with self._lock:
+            since = None if self._last_sync is None else self._last_sync - self.overlap
+            for key, expires_at in self.loader(since):
+                self._keys[key] = expires_at
+            self._keys = {key: expires_at for key, expires_at in self._keys.items() if expires_at > now}
+            self._last_sync = now
+            self.syncs += 1
+
+    def clear(self):
+        """
+        Forget all the keys so that the next check reloads them from the database.
+        :return:
+        """
+        with self._lock:
+            self._keys = {}
+            self._last_sync = None
+            self.syncs = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def stats(self):
+        """
+        Filter counters for the metrics endpoint.
+        :return: Dictionary of counters
+        """
+        return {
+            'size': len(self._keys),
+            'syncs': self.syncs
+        }
@@ -0,0 +1,54 @@
+from sqlalchemy.orm import load_only
+import datetime
+
+
+class InvalidFields(ValueError):
+    """
+    Raised when a sparse fieldset names a field the resource does not have.
+    """
+
+
+def parse_fields(model, fields):
+    """
+    Read a sparse fieldset from the comma separated fields query parameter.
+    :param model: Model class with a JSON_FIELDS mapping of its json keys to its columns
+    :param fields: Comma separated json keys or None
+    :return: List of json keys or None for all of them
+    """
+    if not fields:
+        return None
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in model.JSON_FIELDS]
+    if unknown or not fields:
+        raise InvalidFields('Unknown fields: ' + ', '.join(unknown))
+    return fields
+
+
+def load_fields(query, model, fields, *columns):
+    """
+    Restrict a query to the columns of the requested json keys, the other columns,
+    such as unbounded descriptions, are not selected.
+    :param query: Query of the model
+    :param model: Model class
+    :param fields: List of json keys or None for all of them
+    :param columns: Names of the columns always loaded, such as the sort key of a listing
+    :return: Query
+    """
+    if fields is None:
+        return query
+    return query.options(load_only(*sorted({model.JSON_FIELDS[field] for field in fields}.union(columns))))
+
+
+def fields_json(instance, fields):
+    """
+    Json representation of the requested fields of a model instance, only the columns
+    of these fields are read.
+    :param instance: Model instance
+    :param fields: List of json keys or None for all of them
+    :return: Dictionary
+    """
+    json_fields = {}
+    for field in fields or instance.JSON_FIELDS:
+        value = getattr(instance, instance.JSON_FIELDS[field])
+        json_fields[field] = value.isoformat() if isinstance(value, datetime.datetime) else value
+    return json_fields
@@ -0,0 +1,226 @@
+from app import app, metrics
+from concurrent.futures import ProcessPoolExecutor
+import bcrypt
+import os
+import threading
+import time
+
+
+class HashingUnavailable(Exception):
+    """
+    Raised when the hashing queue stays full for longer than the configured wait timeout.
+    """
+
+
+def _hash_password(password, rounds):
+    """
+    Hash a password with bcrypt, runs inside a pool process.
+    :param password: Plain text password
+    :param rounds: bcrypt cost factor
+    :return: Password hash
+    """
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check_password(pw_hash, password):
+    """
+    Check a password against a bcrypt hash, runs inside a pool process.
+    :param pw_hash: Password hash
+    :param password: Plain text password
+    :return: Boolean
+    """
+    return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+
+def hash_cost(pw_hash):
+    """
+    Read the cost factor of a bcrypt hash.
+    :param pw_hash: Password hash such as $2b$12$...
+    :return: Cost factor or None if the hash is not a bcrypt hash
+    """
+    try:
+        return int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def calibrate_cost(target_seconds, samples=3, min_cost=4, max_cost=16):
+    """
+    Time bcrypt on this host for increasing cost factors and pick the highest
+    one whose median hash time fits within the target.
+    :param target_seconds: Target time of a single hash
+    :param samples: Number of hashes timed per cost factor
+    :param min_cost: Lowest cost factor tried
+    :param max_cost: Highest cost factor tried
+    :return: Chosen cost factor and a list of (cost, median seconds) timings
+    """
+    timings = []
+    chosen = min_cost
+    for cost in range(min_cost, max_cost + 1):
+        durations = []
+        for _ in range(samples):
+            start = time.time()
+            _hash_password('calibration password', cost)
+            durations.append(time.time() - start)
+        median = sorted(durations)[len(durations) // 2]
+        timings.append((cost, median))
+        if median > target_seconds:
+            break
+        chosen = cost
+    return chosen, timings
+
+
+class HashingExecutor:
+    """
+    Run bcrypt on a process pool so that hashing bursts do not hold the GIL of the
+    worker serving the request. At most workers + queue size hashes are admitted at
+    once, callers wait up to the configured timeout for a slot and get a
+    HashingUnavailable error otherwise.
+    The pool and the slots belong to one worker process. The web workers are threaded,
+    so with fewer slots than threads a burst of logins only ties up as many threads
+    as there are slots and the other threads keep serving requests. A sync worker
+    serves one request at a time and never fills its slots. Each worker process gets
+    its own pool, so the pool size is kept to one process per worker by default.
+    The pool is created lazily from the application config on first use.
+    """
+
+    def __init__(self, config):
+        """
+        :param config: Application config holding the HASH_POOL_* settings
+        """
+        self.config = config
+        self.completed = 0
+        self.rejected = 0
+        self.pending = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._pool = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    @property
+    def workers(self):
+        return self.config.get('HASH_POOL_WORKERS', 1)
+
+    def _setup(self):
+        """
+        Create the slots semaphore and the process pool if they do not exist yet.
+        :return:
+        """
+        with self._lock:
+            if self._slots is None:
+                self._slots = threading.BoundedSemaphore(max(self.workers, 1) + self.config.get('HASH_QUEUE_SIZE', 0))
+            if self._pool is None and self.workers > 0:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def submit(self, fn, *args):
+        """
+        Run the function on the pool, or inline if the pool is disabled, and wait for the result.
+        :param fn: Picklable module level function
+        :param args: Function arguments
+        :return: Function result
+        """
+        self._setup()
+        if not self._slots.acquire(timeout=self.config.get('HASH_QUEUE_TIMEOUT_SECONDS', 1)):
+            with self._lock:
+                self.rejected += 1
+            raise HashingUnavailable()
+        with self._lock:
+            self.pending += 1
+        start = time.time()
+        try:
+            if self._pool is None:
+                return fn(*args)
+            return self._pool.submit(fn, *args).result()
+        finally:
+            latency = time.time() - start
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            self._slots.release()
+
+    @property
+    def cost(self):
+        return self.config.get('BCRYPT_HASH_PREFIX', 12)
+
+    def generate_password_hash(self, password):
+        """
+        Hash a password with the configured cost factor.
+        :param password: Plain text password
+        :return: Password hash
+        """
+        return self.submit(_hash_password, password, self.cost)
+
+    def hash_many(self, passwords):
+        """
+        Hash a batch of passwords spread across HASH_BATCH_WORKERS processes, all the
+        CPUs by default. Meant for offline jobs such as bulk provisioning, which run
+        alone on their host, it does not take request slots.
+        :param passwords: List of plain text passwords
+        :return: List of password hashes in the same order
+        """
+        workers = self.config.get('HASH_BATCH_WORKERS')
+        if workers is None:
+            workers = os.cpu_count() or 1
+        start = time.time()
+        if workers == 0:
+            hashes = [_hash_password(password, self.cost) for password in passwords]
+        else:
+            chunk_size = max(1, len(passwords) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                hashes = list(pool.map(_hash_password, passwords, [self.cost] * len(passwords),
+                                       chunksize=chunk_size))
+        with self._lock:
+            self.completed += len(passwords)
+            self.total_latency += time.time() - start
+        return hashes
+
+    def needs_rehash(self, pw_hash):
+        """
+        Check whether a hash was made with a cost factor other than the configured one.
+        :param pw_hash: Password hash such as $2b$12$...
+        :return: Boolean
+        """
+        return hash_cost(pw_hash) != self.cost
+
+    def check_password_hash(self, pw_hash, password):
+        """
+        Check a password against its hash.
+        :param pw_hash: Password hash
+        :param password: Plain text password
+        :return: Boolean
+        """
+        return self.submit(_check_password, pw_hash, password)
+
+    def reset(self):
+        """
+        Shut the pool down and reset the counters, the next call re-reads the config.
+        :return:
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+            self._pool = None
+            self._slots = None
+            self.completed = self.rejected = self.pending = 0
+            self.total_latency = self.max_latency = 0.0
+
+    def stats(self):
+        """
+        Pool counters for the metrics endpoint.
+        :return: Dictionary of counters
+        """
+        return {
+            'workers': self.workers,
+            'queueDepth': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avgLatencyMs': round(self.total_latency / self.completed * 1000, 2) if self.completed else 0.0,
+            'maxLatencyMs': round(self.max_latency * 1000, 2)
+        }
+
+
+hasher = HashingExecutor(app.config)
+metrics.register('hashing', hasher.stats)
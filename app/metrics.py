@@ -0,0 +1,22 @@
+from collections import OrderedDict
+
+# Metric sources registered by the different modules, keyed by name
+_sources = OrderedDict()
+
+
+def register(name, source):
+    """
+    Register a callable returning a dictionary of counters under a name.
+    :param name: Name the counters are reported under
+    :param source: Callable returning a dictionary
+    :return:
+    """
+    _sources[name] = source
+
+
+def collect():
+    """
+    Collect the current counters of all the registered sources.
+    :return: Dictionary of counters keyed by source name
+    """
+    return {name: source() for name, source in _sources.items()}
@@ -1,6 +1,16 @@
-from app import app, db, bcrypt
+from app import app, db, metrics
+from app.cache import LRUCache, MembershipFilter
+from app.fields import fields_json, load_fields
+from app.hashing import hasher
+from app.unit_of_work import on_commit
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import aliased, make_transient_to_detached
 import datetime
+import hashlib
 import jwt
+import secrets
+import sqlite3
 
 
 class User(db.Model):
@@ -13,22 +23,25 @@ class User(db.Model):
     email = db.Column(db.String(255), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
     registered_on = db.Column(db.DateTime, nullable=False)
+    token_epoch = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     posts = db.relationship('post', backref='post', lazy='dynamic')
 
     def __init__(self, email, password):
         self.email = email
-        self.password = bcrypt.generate_password_hash(password, app.config.get('BCRYPT_LOG_ROUNDS')) \
-            .decode('utf-8')
+        self.password = hasher.generate_password_hash(password)
         self.registered_on = datetime.datetime.now()
+        self.token_epoch = 0
+        self.post_count = 0
 
     def save(self):
         """
-        Persist the user in the database
+        Stage the user in the current unit of work, flushing it to get its Id
         :param user:
         :return:
         """
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
         return self.encode_auth_token(self.id)
 
     def encode_auth_token(self, user_id):
@@ -43,7 +56,8 @@ class User(db.Model):
                                                                        seconds=app.config.get(
                                                                            'AUTH_TOKEN_EXPIRY_SECONDS')),
                 'iat': datetime.datetime.utcnow(),
-                'sub': user_id
+                'sub': user_id,
+                'epoch': self.token_epoch
             }
             return jwt.encode(
                 payload,
@@ -60,17 +74,69 @@ class User(db.Model):
         :param token: Auth Token
         :return:
         """
+        payload = User.verify_auth_token(token)
+        if isinstance(payload, str):
+            return payload
+        return payload['sub']
+
+    @staticmethod
+    def verify_auth_token(token):
+        """
+        Verify the token signature, expiry, epoch and blacklist status.
+        :param token: Auth Token
+        :return: The token payload or an error message
+        """
         try:
             payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms='HS256')
+            epoch = User.get_token_epoch(payload['sub'], payload.get('epoch', 0))
+            if epoch is None:
+                return 'Invalid token. Please sign in again'
+            if payload.get('epoch', 0) != epoch:
+                return 'Token was revoked, Please login In'
             is_token_blacklisted = BlackListToken.check_blacklist(token)
             if is_token_blacklisted:
                 return 'Token was Blacklisted, Please login In'
-            return payload['sub']
+            return payload
         except jwt.ExpiredSignatureError:
             return 'Signature expired, Please sign in again'
         except jwt.InvalidTokenError:
             return 'Invalid token. Please sign in again'
 
+    @staticmethod
+    def get_token_epoch(user_id, seen=0):
+        """
+        Return the current token epoch of a user, from the epoch cache when possible.
+        The epoch is only bumped in the cache of the worker that revoked the tokens, so
+        a cached epoch older than one seen in a token is stale and read again.
+        :param user_id: User Id
+        :param seen: Epoch of the token being verified
+        :return: Token epoch or None if the user does not exist
+        """
+        epoch = token_epochs.get(user_id)
+        if epoch is not None and epoch < seen:
+            token_epochs.delete(user_id)
+            epoch = None
+        if epoch is None:
+            epoch = db.session.query(User.token_epoch).filter_by(id=user_id).scalar()
+            if epoch is not None:
+                token_epochs.set(user_id, epoch)
+        return epoch
+
+    def revoke_tokens(self):
+        """
+        Invalidate all the tokens issued to the user so far by bumping their token epoch
+        and revoking their refresh tokens.
+        The change is committed together with any other pending change of the user, the
+        cached epoch is dropped once it is.
+        :return:
+        """
+        user_id = self.id
+        User.query.filter_by(id=user_id).update({User.token_epoch: User.token_epoch + 1},
+                                                synchronize_session=False)
+        db.session.expire(self, ['token_epoch'])
+        RefreshToken.revoke_all(user_id)
+        on_commit(lambda: token_epochs.delete(user_id))
+
     @staticmethod
     def get_by_id(user_id):
         """
@@ -91,76 +157,487 @@ class User(db.Model):
 
     def reset_password(self, new_password):
         """
-        Update/reset the user password.
+        Update/reset the user password and revoke the tokens issued before the reset.
         :param new_password: New User Password
         :return:
         """
-        self.password = bcrypt.generate_password_hash(new_password, app.config.get('BCRYPT_LOG_ROUNDS')) \
-            .decode('utf-8')
-        db.session.commit()
+        self.password = hasher.generate_password_hash(new_password)
+        self.revoke_tokens()
+
+    def rehash_password(self, password):
+        """
+        Store a new hash of the already verified password made with the configured cost factor.
+        :param password: Plain text password
+        :return:
+        """
+        self.password = hasher.generate_password_hash(password)
 
 
 class BlackListToken(db.Model):
     """
-    Table to store blacklisted/invalid auth tokens
+    Table to store blacklisted/invalid auth tokens.
+    Only a fixed width digest of the token is kept along with its expiry so that
+    rows can be purged once the token could no longer be used anyway.
     """
     __tablename__ = 'blacklist_token'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    token = db.Column(db.String(255), unique=True, nullable=False)
-    blacklisted_on = db.Column(db.DateTime, nullable=False)
+    token_digest = db.Column(db.String(64), unique=True, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    blacklisted_on = db.Column(db.DateTime, nullable=False, index=True)
 
-    def __init__(self, token):
-        self.token = token
-        self.blacklisted_on = datetime.datetime.now()
+    def __init__(self, token, expires_at=None):
+        self.token_digest = digest_token(token)
+        if expires_at is None:
+            expires_at = BlackListToken.token_expiry(token)
+        self.expires_at = expires_at
+        self.blacklisted_on = datetime.datetime.utcnow()
 
     def blacklist(self):
         """
-        Persist Blacklisted token in the database
+        Stage the blacklisted token in the current unit of work, it is added to the
+        blacklist filter once committed
         :return:
         """
         db.session.add(self)
-        db.session.commit()
+        token_digest, expires_at = self.token_digest, timestamp(self.expires_at)
+        on_commit(lambda: blacklist_filter.add(token_digest, expires_at))
 
     @staticmethod
     def check_blacklist(token):
         """
         Check to find out whether a token has already been blacklisted.
+        The check is answered from the in memory blacklist filter.
         :param token: Authorization token
         :return:
         """
-        response = BlackListToken.query.filter_by(token=token).first()
-        if response:
-            return True
-        return False
+        return blacklist_filter.contains(digest_token(token))
+
+    @staticmethod
+    def token_expiry(token):
+        """
+        Read the expiry of a token without verifying it.
+        :param token: Authorization token
+        :return: Naive UTC datetime
+        """
+        try:
+            return datetime.datetime.utcfromtimestamp(jwt.decode(token, verify=False)['exp'])
+        except (jwt.InvalidTokenError, KeyError):
+            return datetime.datetime.utcnow() + datetime.timedelta(days=app.config.get('AUTH_TOKEN_EXPIRY_DAYS'),
+                                                                    seconds=app.config.get('AUTH_TOKEN_EXPIRY_SECONDS'))
+
+    @staticmethod
+    def load_revoked(since):
+        """
+        Return the digests and expiry timestamps of the unexpired tokens blacklisted after since.
+        :param since: Unix timestamp or None to load all of them
+        :return: List of tuples
+        """
+        query = db.session.query(BlackListToken.token_digest, BlackListToken.expires_at) \
+            .filter(BlackListToken.expires_at > datetime.datetime.utcnow())
+        if since is not None:
+            query = query.filter(BlackListToken.blacklisted_on >= datetime.datetime.utcfromtimestamp(since))
+        return [(token_digest, timestamp(expires_at)) for token_digest, expires_at in query]
+
+    @staticmethod
+    def purge_expired():
+        """
+        Delete the blacklisted tokens that have already expired, the caller commits.
+        :return: Number of deleted rows
+        """
+        return BlackListToken.query.filter(BlackListToken.expires_at <= datetime.datetime.utcnow()) \
+            .delete(synchronize_session=False)
+
+
+def digest_token(token):
+    """
+    Return the SHA-256 hex digest stored in place of a token.
+    :param token: Authorization or refresh token
+    :return:
+    """
+    if isinstance(token, str):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).hexdigest()
+
+
+def timestamp(utc_datetime):
+    """
+    Convert a naive UTC datetime into a unix timestamp.
+    :param utc_datetime: Naive UTC datetime
+    :return: Float
+    """
+    return utc_datetime.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+# Per worker cache of the users' current token epochs
+token_epochs = LRUCache(app.config.get('TOKEN_EPOCH_CACHE_SIZE', 10000), app.config.get('TOKEN_EPOCH_CACHE_TTL_SECONDS', 30))
+metrics.register('tokenEpochCache', token_epochs.stats)
+
+# Per worker cache of the owners of the posts, a post never changes owner
+post_owners = LRUCache(app.config.get('POST_OWNER_CACHE_SIZE', 10000), app.config.get('POST_OWNER_CACHE_TTL_SECONDS', 300))
+metrics.register('postOwnerCache', post_owners.stats)
+
+# Per worker copy of the blacklisted token digests
+blacklist_filter = MembershipFilter(BlackListToken.load_revoked, app.config.get('BLACKLIST_SYNC_SECONDS', 5))
+metrics.register('blacklistFilter', blacklist_filter.stats)
+
+
+class RefreshToken(db.Model):
+    """
+    Long lived refresh tokens, tracked server side so that they can be rotated and revoked.
+    Only a digest of the opaque token is stored.
+    """
+    __tablename__ = 'refresh_tokens'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    token_digest = db.Column(db.String(64), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    revoked_at = db.Column(db.DateTime, nullable=True)
+
+    def __init__(self, user_id):
+        self.token = secrets.token_urlsafe(32)
+        self.user_id = user_id
+        self.token_digest = digest_token(self.token)
+        self.created_at = datetime.datetime.utcnow()
+        self.expires_at = self.created_at + datetime.timedelta(days=app.config.get('REFRESH_TOKEN_EXPIRY_DAYS'))
+
+    @staticmethod
+    def issue(user_id):
+        """
+        Create a new refresh token for the user in the current unit of work.
+        :param user_id: User Id
+        :return: The opaque refresh token
+        """
+        refresh_token = RefreshToken(user_id)
+        db.session.add(refresh_token)
+        return refresh_token.token
+
+    @staticmethod
+    def get_by_token(token):
+        """
+        Find a refresh token by its digest.
+        :param token: Opaque refresh token
+        :return: RefreshToken or None
+        """
+        return RefreshToken.query.filter_by(token_digest=digest_token(token)).first()
+
+    def is_expired(self):
+        return self.expires_at <= datetime.datetime.utcnow()
+
+    def rotate(self):
+        """
+        Revoke this refresh token and issue its replacement.
+        The revocation is conditional so that only one of two concurrent rotations wins.
+        :return: The new opaque refresh token or None if the token was already revoked
+        """
+        revoked = RefreshToken.query.filter_by(id=self.id, revoked_at=None) \
+            .update({RefreshToken.revoked_at: datetime.datetime.utcnow()}, synchronize_session=False)
+        if not revoked:
+            return None
+        return RefreshToken.issue(self.user_id)
+
+    def revoke(self):
+        """
+        Revoke this refresh token.
+        :return:
+        """
+        RefreshToken.query.filter_by(id=self.id, revoked_at=None) \
+            .update({RefreshToken.revoked_at: datetime.datetime.utcnow()}, synchronize_session=False)
+
+    @staticmethod
+    def revoke_all(user_id):
+        """
+        Revoke all the active refresh tokens of a user, the caller commits.
+        :param user_id: User Id
+        :return:
+        """
+        RefreshToken.query.filter_by(user_id=user_id, revoked_at=None) \
+            .update({RefreshToken.revoked_at: datetime.datetime.utcnow()}, synchronize_session=False)
+
+    @staticmethod
+    def purge_expired():
+        """
+        Delete the refresh tokens that have already expired, the caller commits.
+        Revoked tokens are kept until they expire so that replaying one still revokes
+        all the tokens of its user.
+        :return: Number of deleted rows
+        """
+        return RefreshToken.query.filter(RefreshToken.expires_at <= datetime.datetime.utcnow()) \
+            .delete(synchronize_session=False)
 
 
 class post(db.Model):
     """
-    Class to represent the postList model
+    Class to represent the postList model.
+    Deleted posts are kept as tombstones, with their deletion time set, until
+    compact_tombstones removes them and their items.
     """
     __tablename__ = 'posts'
+    __table_args__ = (
+        # Listing the live posts of a user in id order
+        db.Index('ix_posts_user_id_id', 'user_id', 'id',
+                 postgresql_where=db.text('deleted_at IS NULL'), sqlite_where=db.text('deleted_at IS NULL')),
+        # Finding the tombstones to compact
+        db.Index('ix_posts_deleted_at', 'deleted_at',
+                 postgresql_where=db.text('deleted_at IS NOT NULL'), sqlite_where=db.text('deleted_at IS NOT NULL')),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(255), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     create_at = db.Column(db.DateTime, nullable=False)
     modified_at = db.Column(db.DateTime, nullable=False)
-    items = db.relationship('postItem', backref='item', lazy='dynamic')
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    deleted_at = db.Column(db.DateTime, nullable=True)
+    # The database deletes the items of a deleted post, they are never loaded for it
+    items = db.relationship('postItem', backref='item', lazy='dynamic', cascade='all', passive_deletes=True)
+
+    # Json keys of the post and the columns they are read from
+    JSON_FIELDS = {
+        'id': 'id',
+        'name': 'name',
+        'itemCount': 'item_count',
+        'createdAt': 'create_at',
+        'modifiedAt': 'modified_at'
+    }
 
     def __init__(self, name, user_id):
         self.name = name
         self.user_id = user_id
         self.create_at = datetime.datetime.utcnow()
         self.modified_at = datetime.datetime.utcnow()
+        self.item_count = 0
 
     def save(self):
         """
-        Persist a post in the database
+        Stage a post in the current unit of work, a new post is counted in the post count
+        of its user within the same transaction and its owner is cached once committed.
         :return:
         """
+        if self.id is None:
+            count_posts(self.user_id, 1)
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        cache_post_owner(self.id, self.user_id)
+
+    @staticmethod
+    def create(user_id, name):
+        """
+        Create a post of a user and count it in the user post count. Where the database
+        supports RETURNING both happen in a single statement, the insert being a CTE of
+        the counter update, and the post is built from the returned row.
+        :param user_id: User Id
+        :param name: post name
+        :return: post
+        """
+        if not supports_returning():
+            user_post = post(name, user_id)
+            user_post.save()
+            return user_post
+        now = datetime.datetime.utcnow()
+        posts, users = post.__table__, User.__table__
+        new_post = posts.insert() \
+            .values(name=name, user_id=user_id, create_at=now, modified_at=now, item_count=0) \
+            .returning(*posts.c).cte('new_post')
+        row = write_returning(users.update()
+                              .values(post_count=users.c.post_count + 1)
+                              .where(users.c.id == new_post.c.user_id)
+                              .returning(*new_post.c))
+        cache_post_owner(row.id, row.user_id)
+        return post.from_row(row)
+
+    @staticmethod
+    def update_owned(user_id, post_id, values):
+        """
+        Update the sent columns of a post of a user and its modification time, with a
+        single UPDATE ... RETURNING checking the owner where the database supports it.
+        :param user_id: User Id
+        :param post_id: post Id
+        :param values: Dictionary of the new column values
+        :return: The updated post or None if the user has no post with the Id
+        """
+        values = dict(values, modified_at=datetime.datetime.utcnow())
+        if not supports_returning():
+            user_post = post.get_owned(user_id, post_id)
+            if user_post is not None:
+                for column, value in values.items():
+                    setattr(user_post, column, value)
+            return user_post
+        posts = post.__table__
+        row = write_returning(posts.update()
+                              .values(**values)
+                              .where(db.and_(posts.c.id == post_id, posts.c.user_id == user_id,
+                                             posts.c.deleted_at.is_(None)))
+                              .returning(*posts.c))
+        return post.from_row(row) if row is not None else None
+
+    @staticmethod
+    def delete_owned(user_id, post_id):
+        """
+        Tombstone a post of a user and take it off the user post count, with a single
+        statement where the database supports RETURNING. The items of the post are left
+        to compact_tombstones, they can only be reached through their live post.
+        :param user_id: User Id
+        :param post_id: post Id
+        :return: Whether the post was deleted
+        """
+        if not supports_returning():
+            user_post = post.get_owned(user_id, post_id)
+            if user_post is not None:
+                user_post.delete()
+            return user_post is not None
+        posts, users = post.__table__, User.__table__
+        deleted_post = posts.update() \
+            .values(deleted_at=datetime.datetime.utcnow()) \
+            .where(db.and_(posts.c.id == post_id, posts.c.user_id == user_id, posts.c.deleted_at.is_(None))) \
+            .returning(posts.c.id, posts.c.user_id).cte('deleted_post')
+        row = write_returning(users.update()
+                              .values(post_count=users.c.post_count - 1)
+                              .where(users.c.id == deleted_post.c.user_id)
+                              .returning(deleted_post.c.id))
+        if row is not None:
+            post_id = row.id
+            on_commit(lambda: post_owners.delete(post_id))
+        return row is not None
+
+    @staticmethod
+    def create_many(user_id, names):
+        """
+        Create posts of a user and count them in the user post count. Where the database
+        supports RETURNING the posts are inserted with a single multi-row INSERT and built
+        from the returned rows.
+        :param user_id: User Id
+        :param names: post names
+        :return: List of the posts in the order of the names
+        """
+        if not supports_returning():
+            user_posts = [post(name, user_id) for name in names]
+            count_posts(user_id, len(user_posts))
+            db.session.add_all(user_posts)
+            db.session.flush()
+        else:
+            now = datetime.datetime.utcnow()
+            posts = post.__table__
+            rows = db.session.execute(posts.insert()
+                                      .values([dict(name=name, user_id=user_id, create_at=now, modified_at=now,
+                                                    item_count=0) for name in names])
+                                      .returning(*posts.c)).fetchall()
+            count_posts(user_id, len(rows))
+            # The ids are drawn from the sequence in the order of the rows
+            user_posts = [post.from_row(row) for row in sorted(rows, key=lambda row: row.id)]
+        for user_post in user_posts:
+            cache_post_owner(user_post.id, user_id)
+        return user_posts
+
+    @staticmethod
+    def update_many_owned(user_id, names):
+        """
+        Rename posts of a user and update their modification time, with a single
+        UPDATE ... RETURNING checking the owner where the database supports it.
+        :param user_id: User Id
+        :param names: Dictionary of the new names by post Id
+        :return: List of the updated posts, in no particular order
+        """
+        now = datetime.datetime.utcnow()
+        if not supports_returning():
+            user_posts = post.get_many_owned(user_id, list(names))
+            for user_post in user_posts:
+                user_post.name = names[user_post.id]
+                user_post.modified_at = now
+            return user_posts
+        posts = post.__table__
+        rows = db.session.execute(posts.update()
+                                  .values(name=db.case(names, value=posts.c.id), modified_at=now)
+                                  .where(db.and_(posts.c.id.in_(list(names)), posts.c.user_id == user_id,
+                                                 posts.c.deleted_at.is_(None)))
+                                  .returning(*posts.c)).fetchall()
+        return [post.from_row(row) for row in rows]
+
+    @staticmethod
+    def delete_many_owned(user_id, post_ids):
+        """
+        Tombstone posts of a user with a single UPDATE and take them off the user post
+        count. Where the database does not support RETURNING the live posts among the
+        Ids are selected first.
+        :param user_id: User Id
+        :param post_ids: post Ids
+        :return: List of the Ids of the deleted posts
+        """
+        now = datetime.datetime.utcnow()
+        owned = db.and_(post.id.in_(post_ids), post.user_id == user_id, post.deleted_at.is_(None))
+        if supports_returning():
+            posts = post.__table__
+            deleted_ids = [row.id for row in db.session.execute(posts.update()
+                                                                .values(deleted_at=now)
+                                                                .where(owned)
+                                                                .returning(posts.c.id))]
+        else:
+            deleted_ids = [row.id for row in db.session.query(post.id).filter(owned)]
+            if deleted_ids:
+                post.query.filter(post.id.in_(deleted_ids)).update({post.deleted_at: now}, synchronize_session=False)
+        if deleted_ids:
+            count_posts(user_id, -len(deleted_ids))
+
+            def forget_owners():
+                for post_id in deleted_ids:
+                    post_owners.delete(post_id)
+            on_commit(forget_owners)
+        return deleted_ids
+
+    @staticmethod
+    def from_row(row):
+        """
+        Make a detached post from a row returned by a write, so that it is not loaded again.
+        :param row: posts row
+        :return: post
+        """
+        user_post = post(row.name, row.user_id)
+        user_post.id = row.id
+        user_post.create_at = row.create_at
+        user_post.modified_at = row.modified_at
+        user_post.item_count = row.item_count
+        make_transient_to_detached(user_post)
+        return user_post
+
+    @staticmethod
+    def get_owner_id(post_id):
+        """
+        Return the Id of the user owning a post, from the owner cache when possible.
+        :param post_id: post Id
+        :return: User Id or None if the post does not exist
+        """
+        owner_id = post_owners.get(post_id)
+        if owner_id is None:
+            owner_id = db.session.query(post.user_id).filter_by(id=post_id, deleted_at=None).scalar()
+            if owner_id is not None:
+                post_owners.set(post_id, owner_id)
+        return owner_id
+
+    @staticmethod
+    def get_owned(user_id, post_id, fields=None):
+        """
+        Get a live post of a user with a single query.
+        :param user_id: User Id
+        :param post_id: post Id
+        :param fields: Json keys whose columns are loaded, all of them when None
+        :return: post or None if the user has no post with the Id
+        """
+        return load_fields(post.query, post, fields, 'id') \
+            .filter_by(id=post_id, user_id=user_id, deleted_at=None).first()
+
+    @staticmethod
+    def get_many_owned(user_id, post_ids, fields=None):
+        """
+        Get the live posts of a user among the Ids with a single IN query.
+        :param user_id: User Id
+        :param post_ids: post Ids
+        :param fields: Json keys whose columns are loaded, all of them when None
+        :return: List of the posts found, in no particular order
+        """
+        return load_fields(post.query, post, fields, 'id') \
+            .filter(post.id.in_(post_ids), post.user_id == user_id, post.deleted_at.is_(None)).all()
 
     def update(self, name):
         """
@@ -169,42 +646,61 @@ class post(db.Model):
         :return:
         """
         self.name = name
-        db.session.commit()
+        self.modified_at = datetime.datetime.utcnow()
 
     def delete(self):
         """
-        Delete a post from the database
+        Tombstone a post and take it off the post count of its user
         :return:
         """
-        db.session.delete(self)
-        db.session.commit()
+        post_id = self.id
+        count_posts(self.user_id, -1)
+        self.deleted_at = datetime.datetime.utcnow()
+        db.session.flush()
+        on_commit(lambda: post_owners.delete(post_id))
 
-    def json(self):
+    def json(self, fields=None):
         """
         Json representation of the post model.
+        :param fields: Json keys to include, all of them when None
         :return:
         """
-        return {
-            'id': self.id,
-            'name': self.name,
-            'createdAt': self.create_at.isoformat(),
-            'modifiedAt': self.modified_at.isoformat()
-        }
+        return fields_json(self, fields)
 
 
 class postItem(db.Model):
     """
-    postItem model class
+    postItem model class.
+    Deleted items are kept as tombstones until compact_tombstones removes them.
     """
 
     __tablename__ = 'postitems'
+    __table_args__ = (
+        # Listing the live items of a post newest first
+        db.Index('ix_postitems_post_id_create_at_id', 'post_id', db.desc('create_at'), db.desc('id'),
+                 postgresql_where=db.text('deleted_at IS NULL'), sqlite_where=db.text('deleted_at IS NULL')),
+        # Finding the tombstones to compact
+        db.Index('ix_postitems_deleted_at', 'deleted_at',
+                 postgresql_where=db.text('deleted_at IS NOT NULL'), sqlite_where=db.text('deleted_at IS NOT NULL')),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text, nullable=True)
-    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'))
     create_at = db.Column(db.DateTime, nullable=False)
     modified_at = db.Column(db.DateTime, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=True)
+
+    # Json keys of the item and the columns they are read from
+    JSON_FIELDS = {
+        'id': 'id',
+        'name': 'name',
+        'description': 'description',
+        'postId': 'post_id',
+        'createdAt': 'create_at',
+        'modifiedAt': 'modified_at'
+    }
 
     def __init__(self, name, description, post_id):
         self.name = name
@@ -215,11 +711,288 @@ class postItem(db.Model):
 
     def save(self):
         """
-        Persist Item into the database
+        Stage an item in the current unit of work, a new item is counted in the item count
+        of its post within the same transaction.
         :return:
         """
+        if self.id is None:
+            count_items(self.post_id, 1)
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+
+    @staticmethod
+    def get_owned(user_id, post_id, item_id, fields=None):
+        """
+        Get a live item of a live post of a user with a single query joining the post
+        to check its owner.
+        :param user_id: User Id
+        :param post_id: post Id
+        :param item_id: Item Id
+        :param fields: Json keys whose columns are loaded, all of them when None
+        :return: postItem or None if the user has no such item
+        """
+        return load_fields(postItem.query, postItem, fields, 'id').join(post, postItem.post_id == post.id) \
+            .filter(postItem.id == item_id, postItem.post_id == post_id, postItem.deleted_at.is_(None),
+                    post.user_id == user_id, post.deleted_at.is_(None)).first()
+
+    @staticmethod
+    def of_live_post(query):
+        """
+        Restrict a query on items to the items of live posts. Deleting a post only
+        tombstones the post, and the owner of a deleted post can still be cached by
+        the other workers, so reads trusting the owner cache join the post on its
+        primary key to check it is live.
+        :param query: Query on postItem
+        :return: Query
+        """
+        return query.join(post, postItem.post_id == post.id).filter(post.deleted_at.is_(None))
+
+    @staticmethod
+    def get_many(post_id, item_ids, fields=None):
+        """
+        Get the live items of a live post among the Ids with a single IN query, the
+        caller checks that the user owns the post.
+        :param post_id: post Id
+        :param item_ids: Item Ids
+        :param fields: Json keys whose columns are loaded, all of them when None
+        :return: List of the items found, in no particular order
+        """
+        return postItem.of_live_post(load_fields(postItem.query, postItem, fields, 'id')) \
+            .filter(postItem.id.in_(item_ids), postItem.post_id == post_id, postItem.deleted_at.is_(None)).all()
+
+    @staticmethod
+    def first_of_posts(post_ids, limit):
+        """
+        Get the newest live items of each of the posts with a single windowed query,
+        numbering the items of every post in listing order.
+        :param post_ids: post Ids
+        :param limit: Maximum number of items of each post
+        :return: Dictionary of the post Ids to their items, newest first
+        """
+        items = {post_id: [] for post_id in post_ids}
+        if not post_ids:
+            return items
+        row_number = db.func.row_number().over(partition_by=postItem.post_id,
+                                               order_by=(postItem.create_at.desc(), postItem.id.desc()))
+        numbered = db.session.query(postItem, row_number.label('row_number')) \
+            .filter(postItem.post_id.in_(post_ids), postItem.deleted_at.is_(None)).subquery()
+        item = aliased(postItem, numbered)
+        for first_item in db.session.query(item).filter(numbered.c.row_number <= limit) \
+                .order_by(numbered.c.post_id, numbered.c.row_number):
+            items[first_item.post_id].append(first_item)
+        return items
+
+    @staticmethod
+    def create_owned(user_id, post_id, name, description):
+        """
+        Create an item in a post of a user and count it in the post item count. Where the
+        database supports RETURNING this is a single statement: an INSERT ... SELECT from
+        the post of the user, which inserts nothing if the user does not own the post, as
+        a CTE of the counter update.
+        :param user_id: User Id
+        :param post_id: post Id
+        :param name: Item name
+        :param description: Item description
+        :return: The created item or None if the user has no post with the Id
+        """
+        if not supports_returning():
+            # The owner cache may still hold a post deleted by another worker
+            if post.get_owned(user_id, post_id, ['id']) is None:
+                return None
+            item = postItem(name, description, post_id)
+            item.save()
+            return item
+        now = datetime.datetime.utcnow()
+        items, posts = postItem.__table__, post.__table__
+        owned_post = db.select([db.literal(name, db.String), db.literal(description, db.Text), posts.c.id,
+                                db.literal(now, db.DateTime), db.literal(now, db.DateTime)]) \
+            .where(db.and_(posts.c.id == post_id, posts.c.user_id == user_id, posts.c.deleted_at.is_(None)))
+        new_item = items.insert() \
+            .from_select(['name', 'description', 'post_id', 'create_at', 'modified_at'], owned_post) \
+            .returning(*items.c).cte('new_item')
+        row = write_returning(posts.update()
+                              .values(item_count=posts.c.item_count + 1)
+                              .where(posts.c.id == new_item.c.post_id)
+                              .returning(*new_item.c))
+        return postItem.from_row(row) if row is not None else None
+
+    @staticmethod
+    def update_owned(user_id, post_id, item_id, values):
+        """
+        Update the sent columns of an item of a post of a user and its modification time,
+        with a single UPDATE ... FROM posts ... RETURNING checking the owner where the
+        database supports it.
+        :param user_id: User Id
+        :param post_id: post Id
+        :param item_id: Item Id
+        :param values: Dictionary of the new column values
+        :return: The updated item or None if the user has no such item
+        """
+        values = dict(values, modified_at=datetime.datetime.utcnow())
+        if not supports_returning():
+            item = postItem.get_owned(user_id, post_id, item_id)
+            if item is not None:
+                for column, value in values.items():
+                    setattr(item, column, value)
+            return item
+        items, posts = postItem.__table__, post.__table__
+        row = write_returning(items.update()
+                              .values(**values)
+                              .where(db.and_(items.c.id == item_id, items.c.post_id == post_id,
+                                             items.c.deleted_at.is_(None), posts.c.id == items.c.post_id,
+                                             posts.c.user_id == user_id, posts.c.deleted_at.is_(None)))
+                              .returning(*items.c))
+        return postItem.from_row(row) if row is not None else None
+
+    @staticmethod
+    def delete_owned(user_id, post_id, item_id):
+        """
+        Tombstone an item of a post of a user and take it off the post item count, with
+        a single statement where the database supports RETURNING.
+        :param user_id: User Id
+        :param post_id: post Id
+        :param item_id: Item Id
+        :return: Whether the item was deleted
+        """
+        if not supports_returning():
+            item = postItem.get_owned(user_id, post_id, item_id)
+            if item is not None:
+                item.delete()
+            return item is not None
+        items, posts = postItem.__table__, post.__table__
+        deleted_item = items.update() \
+            .values(deleted_at=datetime.datetime.utcnow()) \
+            .where(db.and_(items.c.id == item_id, items.c.post_id == post_id, items.c.deleted_at.is_(None),
+                           posts.c.id == items.c.post_id, posts.c.user_id == user_id, posts.c.deleted_at.is_(None))) \
+            .returning(items.c.id, items.c.post_id).cte('deleted_item')
+        row = write_returning(posts.update()
+                              .values(item_count=posts.c.item_count - 1)
+                              .where(posts.c.id == deleted_item.c.post_id)
+                              .returning(deleted_item.c.id))
+        return row is not None
+
+    @staticmethod
+    def create_many_owned(user_id, post_id, values):
+        """
+        Create items in a live post of a user and count them in the post item count.
+        Where the database supports RETURNING the items are inserted with a single
+        INSERT ... SELECT from the post of the user, which inserts nothing if the user
+        does not own the post, and built from the returned rows.
+        :param user_id: User Id
+        :param post_id: post Id
+        :param values: List of the name and description of each item
+        :return: List of the items in the order of the values, empty if the user has no post with the Id
+        """
+        if not supports_returning():
+            if post.get_owned(user_id, post_id, ['id']) is None:
+                return []
+            items = [postItem(name, description, post_id) for name, description in values]
+            count_items(post_id, len(items))
+            db.session.add_all(items)
+            db.session.flush()
+            return items
+        now = datetime.datetime.utcnow()
+        items, posts = postItem.__table__, post.__table__
+        new_items = db.union_all(*[db.select([db.literal(position).label('position'),
+                                              db.cast(db.literal(name), db.String).label('name'),
+                                              db.cast(db.literal(description), db.Text).label('description')])
+                                   for position, (name, description) in enumerate(values)]).alias('new_items')
+        owned_post = db.select([new_items.c.name, new_items.c.description, posts.c.id,
+                                db.literal(now, db.DateTime), db.literal(now, db.DateTime)]) \
+            .where(db.and_(posts.c.id == post_id, posts.c.user_id == user_id, posts.c.deleted_at.is_(None))) \
+            .order_by(new_items.c.position)
+        rows = db.session.execute(items.insert()
+                                  .from_select(['name', 'description', 'post_id', 'create_at', 'modified_at'],
+                                               owned_post)
+                                  .returning(*items.c)).fetchall()
+        if rows:
+            count_items(post_id, len(rows))
+        # The ids are drawn from the sequence in the order of the positions
+        return [postItem.from_row(row) for row in sorted(rows, key=lambda row: row.id)]
+
+    @staticmethod
+    def move_many_owned(user_id, post_id, item_ids, to_post_id):
+        """
+        Move live items of a post of a user to another live post of the user and move
+        them between the item counts of the posts. Where the database supports RETURNING
+        the items are moved with a single UPDATE ... SET post_id checking the owner of
+        both posts.
+        :param user_id: User Id
+        :param post_id: post Id the items are in
+        :param item_ids: Item Ids
+        :param to_post_id: post Id the items are moved to
+        :return: List of the moved items, in no particular order
+        """
+        now = datetime.datetime.utcnow()
+        if not supports_returning():
+            if len(post.get_many_owned(user_id, [post_id, to_post_id], ['id'])) != 2:
+                return []
+            moved = postItem.get_many(post_id, item_ids)
+            for item in moved:
+                item.post_id = to_post_id
+                item.modified_at = now
+        else:
+            items = postItem.__table__
+            source, target = post.__table__.alias('source'), post.__table__.alias('target')
+            rows = db.session.execute(items.update()
+                                      .values(post_id=to_post_id, modified_at=now)
+                                      .where(db.and_(items.c.id.in_(item_ids), items.c.post_id == post_id,
+                                                     items.c.deleted_at.is_(None), source.c.id == post_id,
+                                                     source.c.user_id == user_id, source.c.deleted_at.is_(None),
+                                                     target.c.id == to_post_id, target.c.user_id == user_id,
+                                                     target.c.deleted_at.is_(None)))
+                                      .returning(*items.c)).fetchall()
+            moved = [postItem.from_row(row) for row in rows]
+        if moved:
+            count_items(post_id, -len(moved))
+            count_items(to_post_id, len(moved))
+        return moved
+
+    @staticmethod
+    def delete_many_owned(user_id, post_id, item_ids):
+        """
+        Tombstone live items of a post of a user and take them off the post item count.
+        Where the database supports RETURNING the items are tombstoned with a single
+        UPDATE ... FROM posts checking the owner.
+        :param user_id: User Id
+        :param post_id: post Id
+        :param item_ids: Item Ids
+        :return: List of the Ids of the deleted items
+        """
+        now = datetime.datetime.utcnow()
+        if not supports_returning():
+            if post.get_owned(user_id, post_id, ['id']) is None:
+                return []
+            deleted_ids = [row.id for row in db.session.query(postItem.id).filter(
+                postItem.id.in_(item_ids), postItem.post_id == post_id, postItem.deleted_at.is_(None))]
+            if deleted_ids:
+                postItem.query.filter(postItem.id.in_(deleted_ids)) \
+                    .update({postItem.deleted_at: now}, synchronize_session=False)
+        else:
+            items, posts = postItem.__table__, post.__table__
+            deleted_ids = [row.id for row in db.session.execute(
+                items.update()
+                .values(deleted_at=now)
+                .where(db.and_(items.c.id.in_(item_ids), items.c.post_id == post_id, items.c.deleted_at.is_(None),
+                               posts.c.id == post_id, posts.c.user_id == user_id, posts.c.deleted_at.is_(None)))
+                .returning(items.c.id))]
+        if deleted_ids:
+            count_items(post_id, -len(deleted_ids))
+        return deleted_ids
+
+    @staticmethod
+    def from_row(row):
+        """
+        Make a detached item from a row returned by a write, so that it is not loaded again.
+        :param row: postitems row
+        :return: postItem
+        """
+        item = postItem(row.name, row.description, row.post_id)
+        item.id = row.id
+        item.create_at = row.create_at
+        item.modified_at = row.modified_at
+        make_transient_to_detached(item)
+        return item
 
     def update(self, name, description=None):
         """
@@ -231,26 +1004,125 @@ class postItem(db.Model):
         self.name = name
         if description is not None:
             self.description = description
-        db.session.commit()
+        self.modified_at = datetime.datetime.utcnow()
 
     def delete(self):
         """
-        Delete an item
+        Tombstone an item and take it off the item count of its post
         :return:
         """
-        db.session.delete(self)
-        db.session.commit()
+        count_items(self.post_id, -1)
+        self.deleted_at = datetime.datetime.utcnow()
+        db.session.flush()
 
-    def json(self):
+    def json(self, fields=None):
         """
         Json representation of the model
+        :param fields: Json keys to include, all of them when None
         :return:
         """
-        return {
-            'id': self.id,
-            'name': self.name,
-            'description': self.description,
-            'postId': self.post_id,
-            'createdAt': self.create_at.isoformat(),
-            'modifiedAt': self.modified_at.isoformat()
-        }
+        return fields_json(self, fields)
+
+
+def supports_returning():
+    """
+    Whether the database can return the rows written by an INSERT, UPDATE or DELETE,
+    so that writes do not have to read the row again.
+    :return: Boolean
+    """
+    return db.engine.dialect.name == 'postgresql'
+
+
+@event.listens_for(Engine, 'connect')
+def enforce_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """
+    SQLite only enforces foreign keys, and cascades deletes, when asked to on each connection.
+    :param dbapi_connection: DBAPI connection
+    :param connection_record: Pool connection record
+    :return:
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute('PRAGMA foreign_keys = ON')
+
+
+def write_returning(statement):
+    """
+    Run a write statement returning the written row in the current unit of work.
+    :param statement: INSERT, UPDATE or DELETE statement with a RETURNING clause
+    :return: The returned row or None if nothing was written
+    """
+    return db.session.execute(statement).first()
+
+
+def cache_post_owner(post_id, user_id):
+    """
+    Cache the owner of a new post once the transaction creating it commits.
+    :param post_id: post Id
+    :param user_id: User Id
+    :return:
+    """
+    on_commit(lambda: post_owners.set(post_id, user_id))
+
+
+def count_posts(user_id, delta):
+    """
+    Add to the post count of a user with an atomic UPDATE in the current transaction,
+    also applied to the user if it is loaded in the session.
+    :param user_id: User Id
+    :param delta: Number of posts added, negative for removed posts
+    :return:
+    """
+    User.query.filter_by(id=user_id).update({User.post_count: User.post_count + delta},
+                                            synchronize_session='evaluate')
+
+
+def count_items(post_id, delta):
+    """
+    Add to the item count of a post with an atomic UPDATE in the current transaction,
+    also applied to the post if it is loaded in the session.
+    :param post_id: post Id
+    :param delta: Number of items added, negative for removed items
+    :return:
+    """
+    post.query.filter_by(id=post_id).update({post.item_count: post.item_count + delta},
+                                            synchronize_session='evaluate')
+
+
+def compact_tombstones(before, batch_size):
+    """
+    Physically delete a batch of the items and posts tombstoned before a time. The
+    items of the tombstoned posts are deleted first, so that deleting a post never
+    cascades to more than a batch of items. The caller commits each batch so that
+    no transaction holds its locks for long.
+    :param before: Naive UTC datetime, older tombstones are deleted
+    :param batch_size: Maximum number of rows deleted
+    :return: Number of deleted items and posts
+    """
+    tombstoned_items = db.session.query(postItem.id).filter(postItem.deleted_at < before)
+    items_of_tombstoned_posts = db.session.query(postItem.id).join(post, postItem.post_id == post.id) \
+        .filter(post.deleted_at < before)
+    for batch in (tombstoned_items, items_of_tombstoned_posts):
+        batch = batch.limit(batch_size).subquery()
+        items = postItem.query.filter(postItem.id.in_(db.select([batch.c.id]))).delete(synchronize_session=False)
+        if items:
+            return items, 0
+    batch = db.session.query(post.id).filter(post.deleted_at < before).limit(batch_size).subquery()
+    return 0, post.query.filter(post.id.in_(db.select([batch.c.id]))).delete(synchronize_session=False)
+
+
+def reconcile_counters():
+    """
+    Recount the live posts of every user and the live items of every post and repair
+    the counters that drifted, for example after rows were written without the models.
+    The caller commits.
+    :return: Number of users and of posts whose counter was repaired
+    """
+    post_count = db.select([db.func.count(post.id)]) \
+        .where(db.and_(post.user_id == User.id, post.deleted_at.is_(None))).as_scalar()
+    users = User.query.filter(User.post_count != post_count) \
+        .update({User.post_count: post_count}, synchronize_session=False)
+    item_count = db.select([db.func.count(postItem.id)]) \
+        .where(db.and_(postItem.post_id == post.id, postItem.deleted_at.is_(None))).as_scalar()
+    posts = post.query.filter(post.item_count != item_count) \
+        .update({post.item_count: item_count}, synchronize_session=False)
+    return users, posts
@@ -0,0 +1,53 @@
+from app import app
+import re
+
+# Largest value of the 32-bit Integer id columns
+MAX_ID = 2 ** 31 - 1
+
+
+class InvalidIds(ValueError):
+    """
+    Raised when the ids query parameter is not a list of ids or has too many of them.
+    """
+
+
+def parse_id(value):
+    """
+    Read an id written in ASCII digits.
+    :param value: String
+    :return: Integer id or None if it is not a valid id
+    """
+    # Longer strings cannot be ids, they are not converted at all
+    if len(value) > len(str(MAX_ID)) or not re.fullmatch(r'[0-9]+', value):
+        return None
+    value = int(value)
+    return value if 1 <= value <= MAX_ID else None
+
+
+def parse_ids(ids):
+    """
+    Read the comma separated ids query parameter of a multi-get request, dropping
+    repeated ids.
+    :param ids: Comma separated ids
+    :return: List of integer ids in the requested order
+    """
+    parsed = [parse_id(part.strip()) for part in ids.split(',') if part.strip()]
+    if not parsed or None in parsed:
+        raise InvalidIds('Provide a comma separated list of valid ids')
+    maximum = app.config['MAX_IDS_PER_REQUEST']
+    ids = list(dict.fromkeys(parsed))
+    if len(ids) > maximum:
+        raise InvalidIds('At most {} ids can be requested at once'.format(maximum))
+    return ids
+
+
+def in_requested_order(rows, ids):
+    """
+    Sort the rows found for a multi-get in the order of the requested ids.
+    :param rows: Rows having an id
+    :param ids: Requested ids
+    :return: The sorted rows and the list of the ids that were not found
+    """
+    rows_by_id = {row.id: row for row in rows}
+    return [rows_by_id[row_id] for row_id in ids if row_id in rows_by_id], \
+        [row_id for row_id in ids if row_id not in rows_by_id]
@@ -0,0 +1,129 @@
+from flask import url_for
+from sqlalchemy import DateTime, Float, Integer, tuple_
+import base64
+import datetime
+import json
+import math
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class InvalidCursor(ValueError):
+    """
+    Raised when a pagination cursor cannot be decoded or does not match the sort key.
+    """
+
+
+def _dump(value):
+    if isinstance(value, datetime.datetime):
+        return {'t': (value - EPOCH) // datetime.timedelta(microseconds=1)}
+    return value
+
+
+def _load(value):
+    if isinstance(value, dict):
+        return EPOCH + datetime.timedelta(microseconds=value['t'])
+    return value
+
+
+def _matches(value, column):
+    """
+    Check that a decoded cursor value can be compared with its sort column.
+    :param value: Decoded value
+    :param column: Sort column
+    :return: Boolean
+    """
+    if isinstance(column.type, DateTime):
+        return isinstance(value, datetime.datetime)
+    if isinstance(value, bool):
+        return False
+    if isinstance(column.type, Integer):
+        return isinstance(value, int) and -2 ** 63 <= value < 2 ** 63
+    if isinstance(column.type, Float):
+        return isinstance(value, (int, float)) and math.isfinite(value)
+    return isinstance(value, str) and '\x00' not in value
+
+
+def encode_cursor(key, direction):
+    """
+    Make an opaque cursor from the sort key of a row.
+    :param key: Tuple of the sort column values of the row
+    :param direction: 'next' to read the rows after the key or 'prev' for the rows before it
+    :return: Url safe string
+    """
+    data = json.dumps({'k': [_dump(value) for value in key], 'd': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor made by encode_cursor.
+    :param cursor: Url safe string
+    :return: Sort key tuple and direction
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+        key = tuple(_load(value) for value in data['k'])
+        direction = data['d']
+    except (ValueError, TypeError, KeyError, OverflowError):
+        raise InvalidCursor(cursor)
+    if direction not in ('next', 'prev'):
+        raise InvalidCursor(cursor)
+    return key, direction
+
+
+def keyset_paginate(query, columns, descending, cursor, per_page):
+    """
+    Paginate a query on a unique sort key instead of an offset, so that every page is
+    read with an index range scan whatever its depth.
+    :param query: Query to paginate
+    :param columns: Columns forming a unique sort key, e.g. (post.id,)
+    :param descending: Whether the listing is sorted in descending key order
+    :param cursor: Cursor from a previous page or None for the first page
+    :param per_page: Page size
+    :return: The rows of the page, the cursor of the next page and the cursor of the previous page
+    """
+    direction = 'next'
+    if cursor:
+        values, direction = decode_cursor(cursor)
+        if len(values) != len(columns) \
+                or not all(_matches(value, column) for value, column in zip(values, columns)):
+            raise InvalidCursor(cursor)
+    # The previous page is read walking the sort key in the opposite order
+    scan_descending = descending == (direction == 'next')
+    if cursor:
+        key = tuple_(*columns) if len(columns) > 1 else columns[0]
+        value = tuple_(*values) if len(columns) > 1 else values[0]
+        query = query.filter(key < value if scan_descending else key > value)
+    query = query.order_by(*[column.desc() if scan_descending else column.asc() for column in columns])
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == 'prev':
+        rows.reverse()
+
+    def row_key(row):
+        return tuple(getattr(row, column.key) for column in columns)
+
+    nex = previous = None
+    if rows:
+        if (direction == 'next' and has_more) or (direction == 'prev' and cursor):
+            nex = encode_cursor(row_key(rows[-1]), 'next')
+        if (direction == 'prev' and has_more) or (direction == 'next' and cursor):
+            previous = encode_cursor(row_key(rows[0]), 'prev')
+    return rows, nex, previous
+
+
+def page_urls(endpoint, nex, previous, **params):
+    """
+    Build the external urls of the next and previous pages.
+    :param endpoint: Listing endpoint
+    :param nex: Cursor of the next page or None
+    :param previous: Cursor of the previous page or None
+    :param params: Other query and path parameters, the ones set to None are left out
+    :return: Next page url and previous page url
+    """
+    params = {name: value for name, value in params.items() if value is not None}
+    next_url = url_for(endpoint, cursor=nex, _external=True, **params) if nex else None
+    previous_url = url_for(endpoint, cursor=previous, _external=True, **params) if previous else None
+    return next_url, previous_url
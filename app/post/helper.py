@@ -1,6 +1,11 @@
-from flask import make_response, jsonify, url_for
-from app import app
-from app.models import post
+from flask import make_response, jsonify
+from app import app, db
+from app.models import User, post, postItem
+from app.bulk import failed, operation_id, succeeded
+from app.fields import load_fields
+from app.multiget import parse_id
+from app.pagination import keyset_paginate, page_urls
+from app.search import backend as search
 
 
 def response_for_user_post(user_post):
@@ -45,18 +50,133 @@ def response(status, message, code):
     })), code
 
 
-def get_user_post_json_list(user_posts):
+def get_user_post_json_list(user_posts, items_limit=None, fields=None):
     """
     Make json objects of the user posts and add them to a list.
+    The newest items of all the posts are embedded with a single query.
     :param user_posts: post
+    :param items_limit: Number of items embedded in each post, None embeds no items
+    :param fields: Json keys of the posts, all of them when None
     :return:
     """
     posts = []
+    items = postItem.first_of_posts([user_post.id for user_post in user_posts], items_limit) if items_limit else {}
     for user_post in user_posts:
-        posts.append(user_post.json())
+        post_json = user_post.json(fields)
+        if items_limit:
+            post_json['items'] = [item.json() for item in items[user_post.id]]
+        posts.append(post_json)
     return posts
 
 
+def embedded_items_limit(include, items_limit):
+    """
+    Read the number of items to embed in each post from the include and items_limit
+    query parameters.
+    :param include: Comma separated resources to include, only items are supported
+    :param items_limit: Number of items of each post or None for the default
+    :return: Number of items or None if items are not included
+    :raises ValueError: If a parameter is invalid
+    """
+    if not include:
+        return None
+    if set(include.split(',')) != {'items'}:
+        raise ValueError('Only items can be included')
+    if items_limit is None:
+        return app.config['EMBEDDED_ITEMS_LIMIT']
+    maximum = app.config['MAX_EMBEDDED_ITEMS_LIMIT']
+    limit = parse_id(items_limit)
+    if limit is None or limit > maximum:
+        raise ValueError('items_limit must be between 1 and {}'.format(maximum))
+    return limit
+
+
+def response_with_missing(posts, missing):
+    """
+    Make a http response for multi-get requests of posts.
+    :param posts: Json of the posts found, in the requested order
+    :param missing: Requested Ids of no post of the user
+    :return: Http Json response
+    """
+    return make_response(jsonify({
+        'status': 'success',
+        'posts': posts,
+        'missing': missing
+    })), 200
+
+
+def response_with_results(results):
+    """
+    Make a http response for bulk requests of posts.
+    :param results: Result of each operation, in the order of the operations
+    :return: Http Json response
+    """
+    return make_response(jsonify({
+        'status': 'success',
+        'results': results
+    })), 200
+
+
+def create_posts(user_id, operations):
+    """
+    Create the posts of a bulk request at once, the operations without a name fail.
+    :param user_id: User Id
+    :param operations: Operations with the name of each post
+    :return: Result of each operation
+    """
+    results = [failed('Missing name attribute') for _ in operations]
+    indexes = [index for index, operation in enumerate(operations)
+               if isinstance(operation.get('name'), str) and operation['name']]
+    user_posts = post.create_many(user_id, [operations[index]['name'].lower() for index in indexes]) if indexes else []
+    for index, user_post in zip(indexes, user_posts):
+        results[index] = succeeded(post=user_post.json())
+    return results
+
+
+def update_posts(user_id, operations):
+    """
+    Rename the posts of a bulk request at once. The operations without a valid Id or
+    a name, repeating the Id of an earlier operation or for no post of the user fail.
+    :param user_id: User Id
+    :param operations: Operations with the Id and the new name of each post
+    :return: Result of each operation
+    """
+    results, names, pending = [], {}, []
+    for index, operation in enumerate(operations):
+        post_id, name = operation_id(operation), operation.get('name')
+        if post_id is None:
+            results.append(failed('Please provide a valid post Id'))
+        elif not isinstance(name, str) or not name:
+            results.append(failed('No attribute or value was specified, nothing was changed'))
+        elif post_id in names:
+            results.append(failed('The post with Id {} was already changed'.format(post_id)))
+        else:
+            names[post_id] = name
+            pending.append((index, post_id))
+            results.append(None)
+    user_posts = {user_post.id: user_post for user_post in post.update_many_owned(user_id, names)} if names else {}
+    for index, post_id in pending:
+        results[index] = succeeded(post=user_posts[post_id].json()) if post_id in user_posts else \
+            failed('The post with Id {} does not exist'.format(post_id))
+    return results
+
+
+def delete_posts(user_id, operations):
+    """
+    Delete the posts of a bulk request at once, the operations without a valid Id or
+    for no post of the user fail.
+    :param user_id: User Id
+    :param operations: Operations with the Id of each post
+    :return: Result of each operation
+    """
+    post_ids = [operation_id(operation) for operation in operations]
+    requested = [post_id for post_id in post_ids if post_id is not None]
+    deleted_ids = set(post.delete_many_owned(user_id, requested)) if requested else set()
+    return [failed('Please provide a valid post Id') if post_id is None else
+            succeeded(id=post_id) if post_id in deleted_ids else
+            failed('The post with Id {} does not exist'.format(post_id)) for post_id in post_ids]
+
+
 def response_with_pagination(posts, previous, nex, count):
     """
     Make a http response for postList get requests.
@@ -75,34 +195,30 @@ def response_with_pagination(posts, previous, nex, count):
     })), 200
 
 
-def paginate_posts(user_id, page, q, user):
+def paginate_posts(user_id, cursor, q, with_count=True, items_limit=None, fields=None):
     """
-    Get a user by Id, then get hold of their posts and also paginate the results.
+    Get the posts of a user by their Id and paginate them by Id with a cursor.
     There is also an option to search for a post name if the query param is set.
     Generate previous and next pagination urls
     :param q: Query parameter
     :param user_id: User Id
-    :param user: Current User
-    :param page: Page number
-    :return: Pagination next url, previous url and the user posts.
+    :param cursor: Cursor of the requested page or None for the first page
+    :param with_count: Whether to count all the matching posts, without a search the post
+    count of the user is read instead of counting
+    :param items_limit: Number of items embedded in each post, carried over to the page urls
+    :param fields: Json keys whose columns are loaded, all of them when None
+    :return: The user posts, next url, previous url and the total count or None.
     """
+    query = post.query.filter_by(user_id=user_id, deleted_at=None)
+    query = load_fields(query, post, fields, 'id')
     if q:
-        pagination = post.query.filter(post.name.like("%" + q.lower().strip() + "%")).filter_by(user_id=user_id) \
-            .paginate(page=page, per_page=app.config['post_AND_ITEMS_PER_PAGE'], error_out=False)
-    else:
-        pagination = user.posts.paginate(page=page, per_page=app.config['post_AND_ITEMS_PER_PAGE'],
-                                           error_out=False)
-    previous = None
-    if pagination.has_prev:
-        if q:
-            previous = url_for('post.postlist', q=q, page=page - 1, _external=True)
-        else:
-            previous = url_for('post.postlist', page=page - 1, _external=True)
-    nex = None
-    if pagination.has_next:
-        if q:
-            nex = url_for('post.postlist', q=q, page=page + 1, _external=True)
-        else:
-            nex = url_for('post.postlist', page=page + 1, _external=True)
-    items = pagination.items
-    return items, nex, pagination, previous
+        query = query.filter(search.matches(post, q))
+    items, nex, previous = keyset_paginate(query, (post.id,), False, cursor, app.config['POST_AND_ITEMS_PER_PAGE'])
+    count = None
+    if with_count:
+        count = query.order_by(None).count() if q else \
+            db.session.query(User.post_count).filter_by(id=user_id).scalar()
+    nex, previous = page_urls('post.postlist', nex, previous, q=q, count=None if with_count else 'false',
+                              include='items' if items_limit else None, items_limit=items_limit,
+                              fields=','.join(fields) if fields else None)
+    return items, nex, previous, count
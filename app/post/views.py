@@ -1,8 +1,13 @@
 from flask import Blueprint, request, abort
 from app.auth.helper import token_required
 from app.post.helper import response, response_for_created_post, response_for_user_post, response_with_pagination, \
-    get_user_post_json_list, paginate_posts
-from app.models import User, post
+    get_user_post_json_list, paginate_posts, embedded_items_limit, response_with_missing, response_with_results, \
+    create_posts, update_posts, delete_posts
+from app.models import post as Post
+from app.bulk import InvalidOperations, parse_operations
+from app.fields import parse_fields
+from app.multiget import parse_ids, in_requested_order
+from app.pagination import InvalidCursor
 
 # Initialize blueprint
 post = Blueprint('post', __name__)
@@ -12,20 +17,34 @@ post = Blueprint('post', __name__)
 @token_required
 def postlist(current_user):
     """
-    Return all the posts owned by the user or limit them to 10.
+    Return a page of the posts owned by the user, the next and previous urls carry
+    the cursors of the adjacent pages. Send count=false to skip counting the posts and
+    include=items to embed the newest items_limit items of each post. Send fields to
+    only return some of the keys of the posts.
+    Send ids to get the posts with these Ids instead, in the requested order along
+    with the Ids that are missing.
     Return an empty posts object if user has no posts
     :param current_user:
     :return:
     """
-    user = User.get_by_id(current_user.id)
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None, type=str)
     q = request.args.get('q', None, type=str)
-
-    items, nex, pagination, previous = paginate_posts(current_user.id, page, q, user)
-
-    if items:
-        return response_with_pagination(get_user_post_json_list(items), previous, nex, pagination.total)
-    return response_with_pagination([], previous, nex, 0)
+    with_count = request.args.get('count', 'true', type=str).lower() != 'false'
+    try:
+        items_limit = embedded_items_limit(request.args.get('include'), request.args.get('items_limit'))
+        fields = parse_fields(Post, request.args.get('fields'))
+        ids = parse_ids(request.args['ids']) if 'ids' in request.args else None
+    except ValueError as error:
+        return response('failed', str(error), 400)
+
+    if ids is not None:
+        user_posts, missing = in_requested_order(Post.get_many_owned(current_user.id, ids, fields), ids)
+        return response_with_missing(get_user_post_json_list(user_posts, items_limit, fields), missing)
+    try:
+        items, nex, previous, count = paginate_posts(current_user.id, cursor, q, with_count, items_limit, fields)
+    except InvalidCursor:
+        return response('failed', 'Invalid pagination cursor', 400)
+    return response_with_pagination(get_user_post_json_list(items, items_limit, fields), previous, nex, count)
 
 
 @post.route('/postlists/', methods=['POST'])
@@ -40,18 +59,38 @@ def create_postlist(current_user):
         data = request.get_json()
         name = data.get('name')
         if name:
-            user_post = post(name.lower(), current_user.id)
-            user_post.save()
+            user_post = Post.create(current_user.id, name.lower())
             return response_for_created_post(user_post, 201)
         return response('failed', 'Missing name attribute', 400)
     return response('failed', 'Content-type must be json', 202)
 
 
+@post.route('/postlists/bulk', methods=['POST', 'PATCH', 'DELETE'])
+@token_required
+def bulk_posts(current_user):
+    """
+    Create, rename or delete the posts of the posts array of operations in a single
+    transaction. POST takes the name of each post, PATCH its Id and new name and
+    DELETE its Id. The result of each operation is returned in the order of the operations.
+    :param current_user: Current User
+    :return: Http Json response
+    """
+    if request.content_type == 'application/json':
+        try:
+            operations = parse_operations(request.get_json(), 'posts')
+        except InvalidOperations as error:
+            return response('failed', str(error), 400)
+        apply = {'POST': create_posts, 'PATCH': update_posts, 'DELETE': delete_posts}[request.method]
+        return response_with_results(apply(current_user.id, operations))
+    return response('failed', 'Content-type must be json', 202)
+
+
 @post.route('/postlists/<post_id>', methods=['GET'])
 @token_required
 def get_post(current_user, post_id):
     """
-    Return a user post with the supplied user Id.
+    Return a user post with the supplied user Id, with its newest items_limit items
+    when include=items is sent and only the keys listed in fields when it is sent.
     :param current_user: User
     :param post_id: post Id
     :return:
@@ -60,19 +99,24 @@ def get_post(current_user, post_id):
         int(post_id)
     except ValueError:
         return response('failed', 'Please provide a valid post Id', 400)
-    else:
-        user_post = User.get_by_id(current_user.id).posts.filter_by(id=post_id).first()
-        if user_post:
-            return response_for_user_post(user_post.json())
-        return response('failed', "post not found", 404)
+    try:
+        items_limit = embedded_items_limit(request.args.get('include'), request.args.get('items_limit'))
+        fields = parse_fields(Post, request.args.get('fields'))
+    except ValueError as error:
+        return response('failed', str(error), 400)
+    user_post = Post.get_owned(current_user.id, post_id, fields)
+    if user_post:
+        return response_for_user_post(get_user_post_json_list([user_post], items_limit, fields)[0])
+    return response('failed', "post not found", 404)
 
 
-@post.route('/postlists/<post_id>', methods=['PUT'])
+@post.route('/postlists/<post_id>', methods=['PUT', 'PATCH'])
 @token_required
 def edit_post(current_user, post_id):
     """
     Validate the post Id. Also check for the name attribute in the json payload.
-    If the name exists update the post with the new name.
+    If the name exists update the post with the new name, name being the only editable
+    attribute PUT and PATCH requests are the same.
     :param current_user: Current User
     :param post_id: post Id
     :return: Http Json response
@@ -85,9 +129,8 @@ def edit_post(current_user, post_id):
                 int(post_id)
             except ValueError:
                 return response('failed', 'Please provide a valid post Id', 400)
-            user_post = User.get_by_id(current_user.id).posts.filter_by(id=post_id).first()
+            user_post = Post.update_owned(current_user.id, post_id, {'name': name})
             if user_post:
-                user_post.update(name)
                 return response_for_created_post(user_post, 201)
             return response('failed', 'The post with Id ' + post_id + ' does not exist', 404)
         return response('failed', 'No attribute or value was specified, nothing was changed', 400)
@@ -107,10 +150,8 @@ def delete_post(current_user, post_id):
         int(post_id)
     except ValueError:
         return response('failed', 'Please provide a valid post Id', 400)
-    user_post = User.get_by_id(current_user.id).posts.filter_by(id=post_id).first()
-    if not user_post:
+    if not Post.delete_owned(current_user.id, int(post_id)):
         abort(404)
-    user_post.delete()
     return response('success', 'post Deleted successfully', 200)
 
 
@@ -1,7 +1,11 @@
-from flask import jsonify, make_response, request, url_for
-from app import app
+from flask import jsonify, make_response, request
+from app import app, db
 from functools import wraps
-from app.models import User, postItem
+from app.models import post, postItem, post_owners
+from app.bulk import failed, operation_id, succeeded
+from app.fields import load_fields
+from app.pagination import keyset_paginate, page_urls
+from app.search import backend as search
 
 
 def post_required(f):
@@ -37,17 +41,18 @@ def response(status, message, status_code):
     })), status_code
 
 
-def response_with_post_item(status, item, status_code):
+def response_with_post_item(status, item, status_code, fields=None):
     """
     Http response for response with a post item.
     :param status: Status Message
     :param item: postItem
     :param status_code: Http Status Code
+    :param fields: Json keys of the item, all of them when None
     :return:
     """
     return make_response(jsonify({
         'status': status,
-        'item': item.json()
+        'item': item.json(fields)
     })), status_code
 
 
@@ -69,48 +74,197 @@ def response_with_pagination(items, previous, nex, count):
     })), 200
 
 
-def get_user_post(current_user, post_id):
+def response_with_missing(items, missing):
     """
-    Query the user to find and return the post specified by the post Id
+    Make a http response for multi-get requests of items.
+    :param items: Json of the items found, in the requested order
+    :param missing: Requested Ids of no item of the post
+    :return: Http Json response
+    """
+    return make_response(jsonify({
+        'status': 'success',
+        'items': items,
+        'missing': missing
+    })), 200
+
+
+def response_with_results(results):
+    """
+    Make a http response for bulk requests of items.
+    :param results: Result of each operation, in the order of the operations
+    :return: Http Json response
+    """
+    return make_response(jsonify({
+        'status': 'success',
+        'results': results
+    })), 200
+
+
+def create_items(user_id, post_id, operations):
+    """
+    Create the items of a bulk request in a post of the user at once, the operations
+    without a name or with a description that is not text fail.
+    :param user_id: User Id
+    :param post_id: post Id
+    :param operations: Operations with the name and optional description of each item
+    :return: Result of each operation
+    """
+    results, indexes = [], []
+    for index, operation in enumerate(operations):
+        name, description = operation.get('name'), operation.get('description')
+        if not isinstance(name, str) or not name:
+            results.append(failed('No name or value attribute found'))
+        elif description is not None and not isinstance(description, str):
+            results.append(failed('The description must be text'))
+        else:
+            indexes.append(index)
+            results.append(missing_post(post_id))
+    values = [(operations[index]['name'].lower(), operations[index].get('description')) for index in indexes]
+    for index, item in zip(indexes, postItem.create_many_owned(user_id, post_id, values) if values else []):
+        results[index] = succeeded(item=item.json())
+    return results
+
+
+def missing_post(post_id):
+    """
+    Result of an operation writing to no live post of the user, such as a post deleted
+    since its owner was cached.
     :param post_id: post Id
+    :return: Dictionary
+    """
+    return failed('User has no post with Id {}'.format(post_id))
+
+
+def item_ids(operations):
+    """
+    Read the item Id of each operation of a bulk request.
+    :param operations: Operations with the Id of an item
+    :return: The Id of each operation, None when it is not valid, and the valid Ids
+    """
+    ids = [operation_id(operation) for operation in operations]
+    return ids, list(dict.fromkeys(item_id for item_id in ids if item_id is not None))
+
+
+def missing_item(item_id):
+    """
+    Result of an operation for an item of no post of the user, or of another post.
+    :param item_id: Item Id or None if it is not valid
+    :return: Dictionary
+    """
+    if item_id is None:
+        return failed('Provide a valid item Id')
+    return failed('The item with Id {} does not exist'.format(item_id))
+
+
+def move_items(user_id, post_id, to_post_id, operations):
+    """
+    Move the items of a bulk request to another post of the user at once.
+    :param user_id: User Id
+    :param post_id: post Id the items are in
+    :param to_post_id: post Id the items are moved to
+    :param operations: Operations with the Id of each item
+    :return: Result of each operation
+    """
+    ids, requested = item_ids(operations)
+    moved = {item.id: item for item in postItem.move_many_owned(user_id, post_id, requested, to_post_id)} \
+        if requested else {}
+    return [succeeded(item=moved[item_id].json()) if item_id in moved else missing_item(item_id)
+            for item_id in ids]
+
+
+def copy_items(user_id, post_id, to_post_id, operations):
+    """
+    Copy the items of a bulk request to another post of the user, the items are read
+    with a single query and their copies created at once. An item is copied once for
+    each operation naming it.
+    :param user_id: User Id
+    :param post_id: post Id the items are in
+    :param to_post_id: post Id the items are copied to
+    :param operations: Operations with the Id of each item
+    :return: Result of each operation
+    """
+    ids, requested = item_ids(operations)
+    found = {item.id: item for item in postItem.get_many(post_id, requested)} if requested else {}
+    copied = [item_id for item_id in ids if item_id in found]
+    copies = postItem.create_many_owned(user_id, to_post_id, [(found[item_id].name, found[item_id].description)
+                                                              for item_id in copied]) if copied else []
+    if copied and not copies:
+        return [missing_post(to_post_id) if item_id in found else missing_item(item_id) for item_id in ids]
+    copies = iter(copies)
+    return [succeeded(id=item_id, item=next(copies).json()) if item_id in found else missing_item(item_id)
+            for item_id in ids]
+
+
+def delete_items(user_id, post_id, operations):
+    """
+    Delete the items of a bulk request from a post of the user at once.
+    :param user_id: User Id
+    :param post_id: post Id
+    :param operations: Operations with the Id of each item
+    :return: Result of each operation
+    """
+    ids, requested = item_ids(operations)
+    deleted_ids = set(postItem.delete_many_owned(user_id, post_id, requested)) if requested else set()
+    return [succeeded(id=item_id) if item_id in deleted_ids else missing_item(item_id) for item_id in ids]
+
+
+def owns_post(current_user, post_id):
+    """
+    Check that the post specified by the post Id belongs to the user, the owner of hot
+    posts is read from the post owner cache.
     :param current_user: User
-    :return:
+    :param post_id: post Id
+    :return: Boolean
+    """
+    return post.get_owner_id(int(post_id)) == current_user.id
+
+
+def get_user_item(current_user, post_id, item_id, fields=None):
     """
-    user_post = User.get_by_id(current_user.id).posts.filter_by(id=post_id).first()
-    return user_post
+    Query the item specified by the item Id in the user post specified by the post Id.
+    When the owner of the post is cached the item is read joining the post only to check
+    it is live, otherwise a query joining the post checks the owner and fills the cache.
+    :param current_user: User
+    :param post_id: post Id
+    :param item_id: Item Id
+    :param fields: Json keys whose columns are loaded, all of them when None
+    :return: postItem or None if the user has no such item
+    """
+    owner_id = post_owners.get(int(post_id))
+    if owner_id is None:
+        item = postItem.get_owned(current_user.id, post_id, item_id, fields)
+        if item is not None:
+            post_owners.set(int(post_id), current_user.id)
+        return item
+    if owner_id != current_user.id:
+        return None
+    return postItem.of_live_post(load_fields(postItem.query, postItem, fields, 'id')) \
+        .filter(postItem.id == item_id, postItem.post_id == post_id, postItem.deleted_at.is_(None)).first()
 
 
-def get_paginated_items(post, post_id, page, q):
+def get_paginated_items(post_id, cursor, q, with_count=True, fields=None):
     """
-    Get the items from the post and then paginate the results.
+    Get the items from the post, newest first, and paginate them with a cursor.
     Items can also be search when the query parameter is set.
     Construct the previous and next urls.
     :param q: Query parameter
-    :param post: post
     :param post_id: post Id
-    :param page: Page number
-    :return:
+    :param cursor: Cursor of the requested page or None for the first page
+    :param with_count: Whether to count all the matching items, without a search the item
+    count of the post is used instead of counting
+    :param fields: Json keys whose columns are loaded, all of them when None
+    :return: The items, next url, previous url and the total count or None.
     """
-
+    query = postItem.of_live_post(load_fields(postItem.query, postItem, fields, 'id', 'create_at')) \
+        .filter(postItem.post_id == post_id, postItem.deleted_at.is_(None))
     if q:
-        pagination = postItem.query.filter(postItem.name.like("%" + q.lower().strip() + "%")) \
-            .order_by(postItem.create_at.desc()) \
-            .filter_by(post_id=post_id) \
-            .paginate(page=page, per_page=app.config['post_AND_ITEMS_PER_PAGE'], error_out=False)
-    else:
-        pagination = post.items.order_by(postItem.create_at.desc()).paginate(page=page, per_page=app.config[
-            'post_AND_ITEMS_PER_PAGE'], error_out=False)
-
-    previous = None
-    if pagination.has_prev:
-        if q:
-            previous = url_for('items.get_items', q=q, post_id=post_id, page=page - 1, _external=True)
-        else:
-            previous = url_for('items.get_items', post_id=post_id, page=page - 1, _external=True)
-    nex = None
-    if pagination.has_next:
-        if q:
-            nex = url_for('items.get_items', q=q, post_id=post_id, page=page + 1, _external=True)
-        else:
-            nex = url_for('items.get_items', post_id=post_id, page=page + 1, _external=True)
-    return pagination.items, nex, pagination, previous
+        query = query.filter(search.matches(postItem, q))
+    items, nex, previous = keyset_paginate(query, (postItem.create_at, postItem.id), True, cursor,
+                                           app.config['POST_AND_ITEMS_PER_PAGE'])
+    count = None
+    if with_count:
+        count = query.order_by(None).count() if q else \
+            db.session.query(post.item_count).filter_by(id=post_id).scalar()
+    nex, previous = page_urls('items.get_items', nex, previous, post_id=post_id, q=q,
+                              count=None if with_count else 'false', fields=','.join(fields) if fields else None)
+    return items, nex, previous, count
@@ -1,9 +1,14 @@
 from flask import Blueprint, request, abort
 from app.auth.helper import token_required
-from app.postitems.helper import post_required, response, get_user_post, response_with_post_item, \
-    response_with_pagination, get_paginated_items
+from app.postitems.helper import post_required, response, owns_post, get_user_item, response_with_post_item, \
+    response_with_pagination, get_paginated_items, response_with_missing, response_with_results, create_items, \
+    move_items, copy_items, delete_items
 from sqlalchemy import exc
 from app.models import postItem
+from app.bulk import InvalidOperations, operation_id, parse_operations
+from app.fields import InvalidFields, parse_fields
+from app.multiget import InvalidIds, parse_ids, in_requested_order
+from app.pagination import InvalidCursor
 
 postitems = Blueprint('items', __name__)
 
@@ -16,27 +21,37 @@ def get_items(current_user, post_id):
     A user`s items belonging to a post specified by the post_id are returned if the post Id
     is valid and belongs to the user.
     An empty item list is returned if the post has no items.
+    Send fields to only return some of the keys of the items, and ids to get the items
+    with these Ids instead, in the requested order along with the Ids that are missing.
     :param current_user: User
     :param post_id: post Id
     :return: List of Items
     """
-    # Get the user post
-    post = get_user_post(current_user, post_id)
-    if post is None:
+    # Check the user owns the post
+    if not owns_post(current_user, post_id):
         return response('failed', 'post not found', 404)
 
     # Get items in the post
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None, type=str)
     q = request.args.get('q', None, type=str)
-    items, nex, pagination, previous = get_paginated_items(post, post_id, page, q)
+    with_count = request.args.get('count', 'true', type=str).lower() != 'false'
+    try:
+        fields = parse_fields(postItem, request.args.get('fields'))
+        if 'ids' in request.args:
+            ids = parse_ids(request.args['ids'])
+            items, missing = in_requested_order(postItem.get_many(int(post_id), ids, fields), ids)
+            return response_with_missing([item.json(fields) for item in items], missing)
+        items, nex, previous, count = get_paginated_items(int(post_id), cursor, q, with_count, fields)
+    except InvalidCursor:
+        return response('failed', 'Invalid pagination cursor', 400)
+    except (InvalidFields, InvalidIds) as error:
+        return response('failed', str(error), 400)
 
     # Make a list of items
-    if items:
-        result = []
-        for item in items:
-            result.append(item.json())
-        return response_with_pagination(result, previous, nex, pagination.total)
-    return response_with_pagination([], previous, nex, 0)
+    result = []
+    for item in items:
+        result.append(item.json(fields))
+    return response_with_pagination(result, previous, nex, count)
 
 
 @postitems.route('/postlists/<post_id>/items/<item_id>/', methods=['GET'])
@@ -45,7 +60,7 @@ def get_items(current_user, post_id):
 def get_item(current_user, post_id, item_id):
     """
     An item can be returned from the post if the item and post exist and below to the user.
-    The post and Item Ids must be valid.
+    The post and Item Ids must be valid. Send fields to only return some of its keys.
     :param current_user: User
     :param post_id: post Id
     :param item_id: Item Id
@@ -56,17 +71,18 @@ def get_item(current_user, post_id, item_id):
         int(item_id)
     except ValueError:
         return response('failed', 'Provide a valid item Id', 202)
+    try:
+        fields = parse_fields(postItem, request.args.get('fields'))
+    except InvalidFields as error:
+        return response('failed', str(error), 400)
 
-    # Get the user post
-    post = get_user_post(current_user, post_id)
-    if post is None:
-        return response('failed', 'User has no post with Id ' + post_id, 404)
-
-    # Delete the item from the post
-    item = post.items.filter_by(id=item_id).first()
+    # Get the item of the user post
+    item = get_user_item(current_user, post_id, item_id, fields)
     if not item:
+        if not owns_post(current_user, post_id):
+            return response('failed', 'User has no post with Id ' + post_id, 404)
         abort(404)
-    return response_with_post_item('success', item, 200)
+    return response_with_post_item('success', item, 200, fields)
 
 
 @postitems.route('/postlists/<post_id>/items/', methods=['POST'])
@@ -87,17 +103,72 @@ def post(current_user, post_id):
     if not item_name:
         return response('failed', 'No name or value attribute found', 401)
 
-    # Get the user post
-    post = get_user_post(current_user, post_id)
-    if post is None:
+    # Save the post Item into the Database if the user owns the post
+    item = postItem.create_owned(current_user.id, int(post_id), item_name.lower(), data.get('description', None))
+    if item is None:
         return response('failed', 'User has no post with Id ' + post_id, 202)
-
-    # Save the post Item into the Database
-    item = postItem(item_name.lower(), data.get('description', None), post.id)
-    item.save()
     return response_with_post_item('success', item, 200)
 
 
+@postitems.route('/postlists/<post_id>/items/bulk', methods=['POST', 'DELETE'])
+@token_required
+@post_required
+def bulk_items(current_user, post_id):
+    """
+    Create or delete the items of the items array of operations in a single transaction.
+    POST takes the name and optional description of each item and DELETE its Id.
+    The result of each operation is returned in the order of the operations.
+    :param current_user: User
+    :param post_id: post Id
+    :return: Http Response
+    """
+    if not request.content_type == 'application/json':
+        return response('failed', 'Content-type must be application/json', 401)
+    if not owns_post(current_user, post_id):
+        return response('failed', 'User has no post with Id ' + post_id, 404)
+    try:
+        operations = parse_operations(request.get_json(), 'items')
+    except InvalidOperations as error:
+        return response('failed', str(error), 400)
+
+    if request.method == 'POST':
+        return response_with_results(create_items(current_user.id, int(post_id), operations))
+    return response_with_results(delete_items(current_user.id, int(post_id), operations))
+
+
+@postitems.route('/postlists/<post_id>/items/bulk/<any(move, copy):action>', methods=['POST'])
+@token_required
+@post_required
+def transfer_items(current_user, post_id, action):
+    """
+    Move or copy the items of the items array of operations, each with the Id of an
+    item, to the post with the postId of the json payload. The result of each operation
+    is returned in the order of the operations.
+    :param current_user: User
+    :param post_id: post Id the items are in
+    :param action: move or copy
+    :return: Http Response
+    """
+    if not request.content_type == 'application/json':
+        return response('failed', 'Content-type must be application/json', 401)
+    if not owns_post(current_user, post_id):
+        return response('failed', 'User has no post with Id ' + post_id, 404)
+    data = request.get_json()
+    try:
+        operations = parse_operations(data, 'items')
+    except InvalidOperations as error:
+        return response('failed', str(error), 400)
+    to_post_id = operation_id(data, 'postId')
+    if to_post_id is None or to_post_id == int(post_id):
+        return response('failed', 'Provide the valid Id of another post in postId', 400)
+    if not owns_post(current_user, to_post_id):
+        return response('failed', 'User has no post with Id ' + str(to_post_id), 404)
+
+    if action == 'move':
+        return response_with_results(move_items(current_user.id, int(post_id), to_post_id, operations))
+    return response_with_results(copy_items(current_user.id, int(post_id), to_post_id, operations))
+
+
 @postitems.route('/postlists/<post_id>/items/<item_id>/', methods=['PUT'])
 @token_required
 @post_required
@@ -119,29 +190,64 @@ def edit_item(current_user, post_id, item_id):
     except ValueError:
         return response('failed', 'Provide a valid item Id', 202)
 
-    # Get the user post
-    post = get_user_post(current_user, post_id)
-    if post is None:
-        return response('failed', 'User has no post with Id ' + post_id, 202)
-
-    # Get the item
-    item = post.items.filter_by(id=item_id).first()
-    if not item:
-        abort(404)
-
     # Check for Json data
     request_json_data = request.get_json()
-    item_new_name = request_json_data.get('name')
-    item_new_description = request_json_data.get('description', None)
-
     if not request_json_data:
         return response('failed', 'No attributes specified in the request', 401)
 
+    item_new_name = request_json_data.get('name')
     if not item_new_name:
         return response('failed', 'No name or value attribute found', 401)
 
-    # Update the item record
-    item.update(item_new_name, item_new_description)
+    values = {'name': item_new_name}
+    if request_json_data.get('description') is not None:
+        values['description'] = request_json_data['description']
+    return update_item(current_user, post_id, item_id, values)
+
+
+@postitems.route('/postlists/<post_id>/items/<item_id>/', methods=['PATCH'])
+@token_required
+@post_required
+def patch_item(current_user, post_id, item_id):
+    """
+    Update only the attributes sent in the json payload, name and/or description, of an
+    item with a valid Id. The description can be cleared by sending null.
+    :param current_user: User
+    :param post_id: post Id
+    :param item_id: Item Id
+    :return: Response of Edit Item
+    """
+    if not request.content_type == 'application/json':
+        return response('failed', 'Content-type must be application/json', 401)
+
+    try:
+        int(item_id)
+    except ValueError:
+        return response('failed', 'Provide a valid item Id', 202)
+
+    request_json_data = request.get_json() or {}
+    values = {column: request_json_data[column] for column in ('name', 'description') if column in request_json_data}
+    if not values:
+        return response('failed', 'No attributes specified in the request', 401)
+    if 'name' in values and not values['name']:
+        return response('failed', 'No name or value attribute found', 401)
+    return update_item(current_user, post_id, item_id, values)
+
+
+def update_item(current_user, post_id, item_id, values):
+    """
+    Update the item of the user post and respond with the updated item.
+    :param current_user: User
+    :param post_id: post Id
+    :param item_id: Item Id
+    :param values: Dictionary of the new attribute values
+    :return: Http Response
+    """
+    item = postItem.update_owned(current_user.id, int(post_id), int(item_id), values)
+    if not item:
+        if not owns_post(current_user, post_id):
+            return response('failed', 'User has no post with Id ' + post_id, 202)
+        abort(404)
     return response_with_post_item('success', item, 200)
 
 
@@ -162,16 +268,11 @@ def delete(current_user, post_id, item_id):
     except ValueError:
         return response('failed', 'Provide a valid item Id', 202)
 
-    # Get the user post
-    post = get_user_post(current_user, post_id)
-    if post is None:
-        return response('failed', 'User has no post with Id ' + post_id, 202)
-
-    # Delete the item from the post
-    item = post.items.filter_by(id=item_id).first()
-    if not item:
+    # Delete the item from the user post
+    if not postItem.delete_owned(current_user.id, int(post_id), int(item_id)):
+        if not owns_post(current_user, post_id):
+            return response('failed', 'User has no post with Id ' + post_id, 202)
         abort(404)
-    item.delete()
     return response('success', 'Successfully deleted the item from post with Id ' + post_id, 200)
 
 
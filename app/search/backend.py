@@ -0,0 +1,158 @@
+from app import db
+from app.models import post, postItem
+from sqlalchemy import DDL, and_, event, func, literal, literal_column, or_, select, table
+
+# Trigram indexes cannot serve queries shorter than a trigram
+MIN_INDEXED_QUERY_LENGTH = 3
+
+# Text search configuration of the tsvector indexes, the queries must use the same one to match them
+TS_CONFIG = literal_column("'simple'")
+
+# Searchable tables with the FTS5 table used on SQLite, the SQL of their search document
+# and the columns it is made of
+DOCUMENTS = {
+    'posts': ('posts_search', "{0}name", 'name'),
+    'postitems': ('postitems_search', "{0}name || ' ' || coalesce({0}description, '')", 'name, description')
+}
+
+POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX ix_{0}_document_tsv ON {0} USING gin (to_tsvector('simple', {1}))",
+    "CREATE INDEX ix_{0}_document_trgm ON {0} USING gin (({1}) gin_trgm_ops)"
+]
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {1} USING fts5(document, tokenize='trigram')",
+    "CREATE TRIGGER {1}_insert AFTER INSERT ON {0} BEGIN "
+    "INSERT INTO {1} (rowid, document) VALUES (new.id, {2}); END",
+    # Counter bumps, tombstones and moves leave the document as it is
+    "CREATE TRIGGER {1}_update AFTER UPDATE OF {3} ON {0} BEGIN "
+    "UPDATE {1} SET document = {2} WHERE rowid = new.id; END",
+    "CREATE TRIGGER {1}_delete AFTER DELETE ON {0} BEGIN "
+    "DELETE FROM {1} WHERE rowid = old.id; END"
+]
+
+
+def document(model):
+    """
+    The search document of a model, built exactly like in the search indexes so that
+    Postgres can match them.
+    :param model: post or postItem
+    :return: SQL expression
+    """
+    if model is postItem:
+        return model.name.op('||')(literal_column("' '")).op('||')(
+            func.coalesce(model.description, literal_column("''")))
+    return model.name
+
+
+def escape_like(q):
+    """
+    Escape the LIKE wildcards of a search query.
+    :param q: Search query
+    :return: Escaped query
+    """
+    return q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def fts_phrase(q):
+    """
+    Quote a search query as a FTS5 phrase so that its characters are not read as operators.
+    :param q: Search query
+    :return: FTS5 phrase
+    """
+    return '"' + q.replace('"', '""') + '"'
+
+
+def dialect():
+    """
+    Name of the database dialect in use, search is implemented differently on each.
+    :return: Dialect name
+    """
+    return db.engine.dialect.name
+
+
+def word_similarity_operator():
+    """
+    The pg_trgm `<%` operator, with its percent sign doubled for drivers using format placeholders.
+    :return: Operator string
+    """
+    if db.engine.dialect.paramstyle in ('format', 'pyformat'):
+        return '<%%'
+    return '<%'
+
+
+def matches(model, q):
+    """
+    Filter matching the rows of a model whose search document contains the query.
+    On Postgres words are matched through the tsvector index, substrings and typos
+    through the pg_trgm index. On SQLite substrings are matched through the FTS5
+    trigram table. Queries shorter than a trigram fall back to a LIKE scan, which
+    the caller is expected to have narrowed down to a single user or post.
+    Tombstoned rows never match.
+    :param model: post or postItem
+    :param q: Search query
+    :return: SQL expression
+    """
+    return and_(model.deleted_at.is_(None), matches_document(model, q.strip()))
+
+
+def matches_document(model, q):
+    """
+    Filter matching the rows of a model whose search document contains the query, see `matches`.
+    :param model: post or postItem
+    :param q: Stripped search query
+    :return: SQL expression
+    """
+    like = document(model).ilike('%' + escape_like(q) + '%', escape='\\')
+    if len(q) < MIN_INDEXED_QUERY_LENGTH:
+        return like
+    if dialect() == 'postgresql':
+        return or_(func.to_tsvector(TS_CONFIG, document(model)).op('@@')(func.plainto_tsquery(TS_CONFIG, q)),
+                   like,
+                   literal(q).op(word_similarity_operator())(document(model)))
+    if dialect() == 'sqlite':
+        search_table = DOCUMENTS[model.__tablename__][0]
+        return model.id.in_(select([literal_column('rowid')])
+                            .select_from(table(search_table))
+                            .where(literal_column(search_table).op('MATCH')(fts_phrase(q))))
+    return like
+
+
+def rank(model, q):
+    """
+    Relevance of the rows matched by `matches`, higher is better.
+    Postgres adds the word rank to the trigram word similarity so that close spellings
+    are ranked right after the exact matches, SQLite uses the FTS5 bm25 score. Both
+    rank short documents first among equal matches.
+    :param model: post or postItem
+    :param q: Search query
+    :return: SQL expression
+    """
+    q = q.strip()
+    if dialect() == 'postgresql':
+        # Normalization 1 divides the word rank by the log of the document length
+        return (func.ts_rank(func.to_tsvector(TS_CONFIG, document(model)), func.plainto_tsquery(TS_CONFIG, q), 1) +
+                func.word_similarity(q, document(model)))
+    if dialect() == 'sqlite' and len(q) >= MIN_INDEXED_QUERY_LENGTH:
+        search_table = DOCUMENTS[model.__tablename__][0]
+        return (select([-func.bm25(literal_column(search_table))])
+                .select_from(table(search_table))
+                .where(literal_column(search_table).op('MATCH')(fts_phrase(q)))
+                .where(literal_column(search_table + '.rowid') == model.id)
+                .as_scalar())
+    return literal(0.0)
+
+
+for model_table in (post.__table__, postItem.__table__):
+    search_table, model_document, document_columns = DOCUMENTS[model_table.name]
+    for statement in POSTGRES_DDL:
+        event.listen(model_table, 'after_create',
+                     DDL(statement.format(model_table.name, model_document.format(''))).execute_if(
+                         dialect='postgresql'))
+    for statement in SQLITE_DDL:
+        event.listen(model_table, 'after_create',
+                     DDL(statement.format(model_table.name, search_table, model_document.format('new.'),
+                                          document_columns)).execute_if(dialect='sqlite'))
+    event.listen(model_table, 'before_drop',
+                 DDL('DROP TABLE IF EXISTS {}'.format(search_table)).execute_if(dialect='sqlite'))
@@ -0,0 +1,132 @@
+from flask import make_response, jsonify
+from app import app, db
+from app.models import post, postItem
+from app.pagination import keyset_paginate, page_urls
+from app.search import backend as search
+from sqlalchemy import Float, Text, cast, func, literal_column, null, union_all
+
+
+def response(status, message, status_code):
+    """
+    Make an http response helper
+    :param status: Status message
+    :param message: Response Message
+    :param status_code: Http response code
+    :return:
+    """
+    return make_response(jsonify({
+        'status': status,
+        'message': message
+    })), status_code
+
+
+def response_with_hits(hits, facets, previous, nex):
+    """
+    Make a http response for search requests.
+    :param hits: Ranked post and item hits
+    :param facets: Number of hits per post
+    :param previous: Previous page Url if it exists
+    :param nex: Next page Url if it exists
+    :return: Http Json response
+    """
+    return make_response(jsonify({
+        'status': 'success',
+        'previous': previous,
+        'next': nex,
+        'facets': facets,
+        'hits': hits
+    })), 200
+
+
+def search_hits(user_id, q):
+    """
+    Build the subquery of all the posts and items of a user matching the query, each
+    hit has a kind ('post' or 'item'), its id, the id of its post, its name, its
+    description and its rank.
+    :param user_id: User Id
+    :param q: Search query
+    :return: Aliased union subquery
+    """
+    posts = db.session.query(
+        literal_column("'post'").label('kind'),
+        post.id.label('id'),
+        post.id.label('post_id'),
+        post.name.label('name'),
+        cast(null(), Text).label('description'),
+        cast(search.rank(post, q), Float).label('rank')
+    ).filter(post.user_id == user_id, search.matches(post, q))
+    items = db.session.query(
+        literal_column("'item'").label('kind'),
+        postItem.id.label('id'),
+        postItem.post_id.label('post_id'),
+        postItem.name.label('name'),
+        postItem.description.label('description'),
+        cast(search.rank(postItem, q), Float).label('rank')
+    ).join(post, postItem.post_id == post.id) \
+        .filter(post.user_id == user_id, post.deleted_at.is_(None), search.matches(postItem, q))
+    return union_all(posts.statement, items.statement).alias('hits')
+
+
+def snippet(hit, q, length):
+    """
+    Cut the part of the hit text around the first occurrence of the query.
+    Typo matches have no occurrence and start the snippet at the beginning of the text.
+    :param hit: Hit row
+    :param q: Search query
+    :param length: Maximum snippet length
+    :return: Snippet string
+    """
+    text = hit.name if not hit.description else hit.name + ' - ' + hit.description
+    start = max(text.lower().find(q.strip().lower()), 0)
+    start = max(min(start - length // 4, len(text) - length), 0)
+    end = start + length
+    return ('...' if start else '') + text[start:end] + ('...' if end < len(text) else '')
+
+
+def hit_json(hit, q):
+    """
+    Json representation of a search hit.
+    :param hit: Hit row
+    :param q: Search query
+    :return:
+    """
+    return {
+        'type': hit.kind,
+        'id': hit.id,
+        'postId': hit.post_id,
+        'name': hit.name,
+        'snippet': snippet(hit, q, app.config['SEARCH_SNIPPET_LENGTH']),
+        'rank': round(hit.rank, 4)
+    }
+
+
+def search_facets(hits):
+    """
+    Count the hits of each post, largest first.
+    :param hits: Hits subquery
+    :return: List of post facets
+    """
+    hit_count = func.count().label('hit_count')
+    facets = db.session.query(post.id, post.name, hit_count) \
+        .join(hits, hits.c.post_id == post.id) \
+        .group_by(post.id, post.name) \
+        .order_by(hit_count.desc(), post.id) \
+        .limit(app.config['SEARCH_FACETS_LIMIT'])
+    return [{'postId': post_id, 'name': name, 'count': count} for post_id, name, count in facets]
+
+
+def search_user(user_id, cursor, q):
+    """
+    Search all the posts and items of a user in one query and paginate the hits,
+    best ranked first, with a cursor.
+    Generate previous and next pagination urls
+    :param user_id: User Id
+    :param cursor: Cursor of the requested page or None for the first page
+    :param q: Search query
+    :return: The hits, the post facets, next url and previous url
+    """
+    hits = search_hits(user_id, q)
+    rows, nex, previous = keyset_paginate(db.session.query(hits), (hits.c.rank, hits.c.kind, hits.c.id), True,
+                                          cursor, app.config['POST_AND_ITEMS_PER_PAGE'])
+    nex, previous = page_urls('search.search_user', nex, previous, q=q)
+    return [hit_json(row, q) for row in rows], search_facets(hits), nex, previous
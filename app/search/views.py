@@ -0,0 +1,29 @@
+from flask import Blueprint, request
+from app.auth.helper import token_required
+from app.pagination import InvalidCursor
+from app.search.helper import response, response_with_hits, search_user as search_user_hits
+
+# Initialize blueprint
+search = Blueprint('search', __name__)
+
+
+@search.route('/search', methods=['GET'])
+@token_required
+def search_user(current_user):
+    """
+    Search all the posts and items of the user at once. Return a page of ranked hits
+    with snippets, the number of hits in each post and the next and previous urls
+    carrying the cursors of the adjacent pages.
+    :param current_user: User
+    :return: Http Json response
+    """
+    cursor = request.args.get('cursor', None, type=str)
+    q = request.args.get('q', '', type=str)
+    if not q.strip():
+        return response('failed', 'Provide a search query', 400)
+
+    try:
+        hits, facets, nex, previous = search_user_hits(current_user.id, cursor, q)
+    except InvalidCursor:
+        return response('failed', 'Invalid pagination cursor', 400)
+    return response_with_hits(hits, facets, previous, nex)
@@ -0,0 +1,83 @@
+from app import app, db
+from contextlib import contextmanager
+from sqlalchemy import event
+
+
+def on_commit(callback):
+    """
+    Run a callback once the current transaction commits, for example to update a per
+    worker cache only when the change it mirrors is visible to the other workers.
+    The callback is dropped if the transaction rolls back. It runs after the commit,
+    so it must not use the session.
+    :param callback: Callable without arguments
+    :return:
+    """
+    db.session.info.setdefault('on_commit', []).append(callback)
+
+
+@event.listens_for(db.session, 'after_commit')
+def run_commit_callbacks(session):
+    """
+    Run the callbacks registered during the transaction that was just committed.
+    :param session: Session
+    :return:
+    """
+    for callback in session.info.pop('on_commit', []):
+        callback()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def drop_commit_callbacks(session):
+    """
+    Forget the callbacks registered during the transaction that was rolled back.
+    :param session: Session
+    :return:
+    """
+    session.info.pop('on_commit', None)
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Commit the changes staged by the models within the block at once, or roll all
+    of them back if the block raises. Used by the manage.py commands, requests get
+    their unit of work from commit_request.
+    :return: Session
+    """
+    try:
+        yield db.session
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+@app.after_request
+def commit_request(response):
+    """
+    Commit the changes staged while serving a request in a single transaction.
+    Client errors still commit, for example the revocation of a reused refresh token,
+    server errors roll everything back.
+    :param response: Http response
+    :return: Http response
+    """
+    if response.status_code >= 500:
+        db.session.rollback()
+        return response
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return response
+
+
+@app.teardown_request
+def rollback_request(exception):
+    """
+    Roll back the changes of a request that raised before its response was made.
+    :param exception: Unhandled exception or None
+    :return:
+    """
+    if exception is not None:
+        db.session.rollback()
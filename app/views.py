@@ -1,5 +1,28 @@
-from app import app
+from flask import abort, jsonify, request
+from app import app, metrics
+from app.hashing import HashingUnavailable
 from app.postitems.helper import response
+import hmac
+
+
+@app.route('/v1/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Return the in process counters (caches, pools, throttles) of this worker to the
+    operators, who send the METRICS_TOKEN secret in the X-Metrics-Token header.
+    The endpoint does not exist when no secret is configured.
+    :return: Http Json response
+    """
+    metrics_token = app.config.get('METRICS_TOKEN')
+    if not metrics_token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('X-Metrics-Token', '').encode('utf-8'),
+                               metrics_token.encode('utf-8')):
+        return response('failed', 'Provide the metrics token', 401)
+    return jsonify({
+        'status': 'success',
+        'metrics': metrics.collect()
+    })
 
 
 @app.errorhandler(404)
@@ -30,3 +53,15 @@ def internal_server_error(e):
     :return:
     """
     return response('failed', 'Internal server error', 500)
+
+
+@app.errorhandler(HashingUnavailable)
+def hashing_unavailable(e):
+    """
+    Return a 503 when the password hashing queue is full.
+    :param e: Exception
+    :return:
+    """
+    http_response, status_code = response('failed', 'The server is busy, please try again later', 503)
+    http_response.headers['Retry-After'] = '1'
+    return http_response, status_code
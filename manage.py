@@ -1,13 +1,16 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 from app import app, db, models
-from app.models import User, post, postItem
+from app.models import User, BlackListToken, RefreshToken, post, postItem, compact_tombstones, reconcile_counters
+from app.hashing import calibrate_cost
+from app.auth.provisioning import read_users, provision_users
+from app.unit_of_work import unit_of_work
 import unittest
 import coverage
+import datetime
 import os
 import forgery_py as faker
-from random import randint
-from sqlalchemy.exc import IntegrityError
+from random import choice
 
 # Initializing the manager
 manager = Manager(app)
@@ -45,28 +48,108 @@ def test():
     return 1
 
 
+@manager.command
+def purge_tokens():
+    """
+    Delete the blacklisted tokens and the refresh tokens that have already expired.
+    Meant to be run periodically, for example from the Heroku scheduler.
+    :return:
+    """
+    with unit_of_work():
+        deleted = BlackListToken.purge_expired()
+        deleted_refresh = RefreshToken.purge_expired()
+    print('Purged {} expired blacklisted tokens and {} expired refresh tokens'.format(deleted, deleted_refresh))
+
+
+@manager.option('-r', '--retention-days', dest='retention_days', type=int,
+                default=app.config['TOMBSTONE_RETENTION_DAYS'], help='Age in days of the tombstones deleted')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=app.config['TOMBSTONE_COMPACTION_BATCH_SIZE'], help='Number of rows deleted per transaction')
+def compact(retention_days, batch_size):
+    """
+    Delete the posts and items deleted more than the retention days ago, and the items of those posts.
+    Meant to be run periodically, for example from the Heroku scheduler.
+    :param retention_days: Age in days of the tombstones deleted
+    :param batch_size: Number of rows deleted per transaction
+    :return:
+    """
+    before = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+    items = posts = 0
+    while True:
+        with unit_of_work():
+            deleted_items, deleted_posts = compact_tombstones(before, batch_size)
+        items, posts = items + deleted_items, posts + deleted_posts
+        if not deleted_items and not deleted_posts:
+            break
+    print('Compacted {} items and {} posts deleted before {:%Y-%m-%d %H:%M}'.format(items, posts, before))
+
+
+@manager.command
+def reconcile_counts():
+    """
+    Recount the posts of every user and the items of every post and repair the counters that drifted.
+    :return:
+    """
+    with unit_of_work():
+        users, posts = reconcile_counters()
+    print('Repaired the post count of {} users and the item count of {} posts'.format(users, posts))
+
+
+@manager.option('-t', '--target', dest='target_ms', type=int, default=250,
+                help='Target time of a single password hash in milliseconds')
+def calibrate_hashing(target_ms):
+    """
+    Benchmark bcrypt on this host and print the cost factor fitting the target login latency.
+    :param target_ms: Target time of a single hash in milliseconds
+    :return:
+    """
+    cost, timings = calibrate_cost(target_ms / 1000.0)
+    for rounds, seconds in timings:
+        print('cost {:>2}: {:>8.1f} ms'.format(rounds, seconds * 1000))
+    print('Recommended cost factor: {0}, set it with BCRYPT_HASH_PREFIX={0}'.format(cost))
+    print('Existing passwords are rehashed with the new cost when their users next log in.')
+
+
+@manager.option('path', help='CSV or newline delimited json file with email and password fields')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+                help='Number of users inserted per transaction')
+def import_users(path, batch_size):
+    """
+    Create the users listed in a file, skipping the emails that are already registered.
+    :param path: Path of the CSV or newline delimited json file
+    :param batch_size: Number of users inserted per transaction
+    :return:
+    """
+    result = provision_users(read_users(path), batch_size)
+    rate = result['created'] / result['elapsed'] if result['elapsed'] else 0
+    print('Created {created} users, skipped {skipped} existing and {invalid} invalid '
+          'records in {elapsed:.1f}s'.format(**result))
+    print('Throughput: {:.0f} users/s'.format(rate))
+
+
 @manager.command
 def dummy():
-    # Create a user if they do not exist.
-    user = User.query.filter_by(email="example@postmail.com").first()
-    if not user:
-        user = User("example@postmail.com", "123456")
-        user.save()
-
-    for i in range(100):
-        # Add posts to the database
-        post = post(faker.name.industry(), user.id)
-        post.save()
-
-    for buck in range(1000):
-        # Add items to the post
-        buckt = post.query.filter_by(id=randint(1, post.query.count() - 1)).first()
-        item = postItem(faker.name.company_name(), faker.lorem_ipsum.word(), buckt.id)
-        db.session.add(item)
-        try:
-            db.session.commit()
-        except IntegrityError:
-            db.session.rollback()
+    """
+    Seed the database with a user, 100 posts and 1000 items, committed at once.
+    :return:
+    """
+    with unit_of_work():
+        # Create a user if they do not exist.
+        user = User.query.filter_by(email="example@postmail.com").first()
+        if not user:
+            user = User("example@postmail.com", "123456")
+            user.save()
+
+        post_ids = []
+        for i in range(100):
+            # Add posts to the database
+            user_post = post(faker.name.industry(), user.id)
+            user_post.save()
+            post_ids.append(user_post.id)
+
+        for i in range(1000):
+            # Add items to the posts
+            postItem(faker.name.company_name(), faker.lorem_ipsum.word(), choice(post_ids)).save()
 
 
 # Run the manager
@@ -41,7 +41,7 @@ def run_migrations_offline():
 
     """
     url = config.get_main_option("sqlalchemy.url")
-    context.configure(url=url)
+    context.configure(url=url, transaction_per_migration=True)
 
     with context.begin_transaction():
         context.run_migrations()
@@ -73,6 +73,9 @@ def run_migrations_online():
     context.configure(connection=connection,
                       target_metadata=target_metadata,
                       process_revision_directives=process_revision_directives,
+                      # Migrations building indexes concurrently leave their transaction,
+                      # the migrations before them must be committed already
+                      transaction_per_migration=True,
                       **current_app.extensions['migrate'].configure_args)
 
     try:
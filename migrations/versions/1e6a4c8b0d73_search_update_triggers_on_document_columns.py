@@ -0,0 +1,47 @@
+"""search update triggers on document columns
+
+Revision ID: 1e6a4c8b0d73
+Revises: 5d2f9a7c1e48
+Create Date: 2026-10-19 10:42:18.264105
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '1e6a4c8b0d73'
+down_revision = '5d2f9a7c1e48'
+branch_labels = None
+depends_on = None
+
+# Searched tables with their FTS5 table on SQLite, the SQL of their search document and
+# the columns it is made of
+DOCUMENTS = {
+    'posts': ('posts_search', "new.name", 'name'),
+    'postitems': ('postitems_search', "new.name || ' ' || coalesce(new.description, '')", 'name, description')
+}
+
+
+def replace_update_triggers(only_document_columns):
+    """
+    Recreate the SQLite triggers keeping the search documents up to date on updates.
+    Postgres indexes the documents themselves and has no triggers.
+    :param only_document_columns: Whether the triggers only fire on updates of the document columns
+    :return:
+    """
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for table, (search_table, document, columns) in DOCUMENTS.items():
+        op.execute('DROP TRIGGER IF EXISTS {}_update'.format(search_table))
+        op.execute("CREATE TRIGGER {1}_update AFTER UPDATE {3}ON {0} BEGIN "
+                   "UPDATE {1} SET document = {2} WHERE rowid = new.id; END"
+                   .format(table, search_table, document, 'OF {} '.format(columns) if only_document_columns else ''))
+
+
+def upgrade():
+    # Counter bumps, tombstones and moves rewrote the unchanged documents
+    replace_update_triggers(True)
+
+
+def downgrade():
+    replace_update_triggers(False)
@@ -0,0 +1,60 @@
+"""search indexes
+
+Revision ID: 2d7f8e4a1c6b
+Revises: 5e1a9d3c7b24
+Create Date: 2026-10-18 16:21:07.318452
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '2d7f8e4a1c6b'
+down_revision = '5e1a9d3c7b24'
+branch_labels = None
+depends_on = None
+
+# Searched tables with their FTS5 table on SQLite, the SQL of their search document and
+# the columns it is made of
+DOCUMENTS = {
+    'posts': ('posts_search', "{0}name", 'name'),
+    'postitems': ('postitems_search', "{0}name || ' ' || coalesce({0}description, '')", 'name, description')
+}
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for table, (search_table, document, columns) in DOCUMENTS.items():
+            new_document = document.format('new.')
+            op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(document, tokenize='trigram')"
+                       .format(search_table))
+            op.execute("CREATE TRIGGER {1}_insert AFTER INSERT ON {0} BEGIN "
+                       "INSERT INTO {1} (rowid, document) VALUES (new.id, {2}); END"
+                       .format(table, search_table, new_document))
+            op.execute("CREATE TRIGGER {1}_update AFTER UPDATE OF {3} ON {0} BEGIN "
+                       "UPDATE {1} SET document = {2} WHERE rowid = new.id; END"
+                       .format(table, search_table, new_document, columns))
+            op.execute("CREATE TRIGGER {1}_delete AFTER DELETE ON {0} BEGIN "
+                       "DELETE FROM {1} WHERE rowid = old.id; END"
+                       .format(table, search_table))
+            op.execute("INSERT INTO {1} (rowid, document) SELECT id, {2} FROM {0}"
+                       .format(table, search_table, document.format('')))
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table, (search_table, document, columns) in DOCUMENTS.items():
+        op.execute("CREATE INDEX ix_{0}_document_tsv ON {0} USING gin (to_tsvector('simple', {1}))"
+                   .format(table, document.format('')))
+        op.execute("CREATE INDEX ix_{0}_document_trgm ON {0} USING gin (({1}) gin_trgm_ops)"
+                   .format(table, document.format('')))
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for search_table, document, columns in DOCUMENTS.values():
+            for trigger in ('insert', 'update', 'delete'):
+                op.execute('DROP TRIGGER IF EXISTS {}_{}'.format(search_table, trigger))
+            op.execute('DROP TABLE IF EXISTS {}'.format(search_table))
+        return
+    for table in DOCUMENTS:
+        op.drop_index('ix_{}_document_trgm'.format(table), table_name=table)
+        op.drop_index('ix_{}_document_tsv'.format(table), table_name=table)
@@ -0,0 +1,61 @@
+"""compact token blacklist
+
+Revision ID: 3b8d1f6c2a9e
+Revises: f365bba04f17
+Create Date: 2026-10-18 09:12:41.503112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import datetime
+import hashlib
+import jwt
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8d1f6c2a9e'
+down_revision = 'f365bba04f17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('blacklist_token', sa.Column('token_digest', sa.String(length=64), nullable=True))
+    op.add_column('blacklist_token', sa.Column('expires_at', sa.DateTime(), nullable=True))
+
+    # Replace the stored tokens by their digest and expiry
+    blacklist_token = sa.table('blacklist_token',
+                               sa.column('id', sa.Integer()),
+                               sa.column('token', sa.String()),
+                               sa.column('token_digest', sa.String()),
+                               sa.column('expires_at', sa.DateTime()))
+    connection = op.get_bind()
+    rows = connection.execute(sa.select([blacklist_token.c.id, blacklist_token.c.token])).fetchall()
+    for row_id, token in rows:
+        try:
+            expires_at = datetime.datetime.utcfromtimestamp(jwt.decode(token, verify=False)['exp'])
+        except (jwt.InvalidTokenError, KeyError):
+            expires_at = datetime.datetime.utcnow()
+        connection.execute(blacklist_token.update()
+                           .where(blacklist_token.c.id == row_id)
+                           .values(token_digest=hashlib.sha256(token.encode('utf-8')).hexdigest(),
+                                   expires_at=expires_at))
+
+    op.alter_column('blacklist_token', 'token_digest', nullable=False)
+    op.alter_column('blacklist_token', 'expires_at', nullable=False)
+    op.create_unique_constraint('blacklist_token_token_digest_key', 'blacklist_token', ['token_digest'])
+    op.create_index('ix_blacklist_token_expires_at', 'blacklist_token', ['expires_at'])
+    op.create_index('ix_blacklist_token_blacklisted_on', 'blacklist_token', ['blacklisted_on'])
+    op.drop_column('blacklist_token', 'token')
+
+
+def downgrade():
+    # The original tokens cannot be recovered from their digests
+    op.execute('DELETE FROM blacklist_token')
+    op.add_column('blacklist_token', sa.Column('token', sa.String(length=255), nullable=False))
+    op.create_unique_constraint('blacklist_token_token_key', 'blacklist_token', ['token'])
+    op.drop_index('ix_blacklist_token_blacklisted_on', table_name='blacklist_token')
+    op.drop_index('ix_blacklist_token_expires_at', table_name='blacklist_token')
+    op.drop_constraint('blacklist_token_token_digest_key', 'blacklist_token', type_='unique')
+    op.drop_column('blacklist_token', 'expires_at')
+    op.drop_column('blacklist_token', 'token_digest')
@@ -0,0 +1,46 @@
+"""cascade post item deletes
+
+Revision ID: 4a9e1c7f2b68
+Revises: 8f2c5a7d3e90
+Create Date: 2026-10-18 20:37:52.104386
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '4a9e1c7f2b68'
+down_revision = '8f2c5a7d3e90'
+branch_labels = None
+depends_on = None
+
+
+def replace_foreign_key(on_delete):
+    """
+    Replace the foreign key of the items on their post. The new constraint is added
+    NOT VALID, which only locks the items table briefly, and is validated once the
+    migration transaction has committed and released that lock, so that the table is
+    not locked against writes while the existing rows are checked.
+    :param on_delete: ON DELETE clause
+    :return:
+    """
+    op.execute('ALTER TABLE postitems DROP CONSTRAINT postitems_post_id_fkey, '
+               'ADD CONSTRAINT postitems_post_id_fkey FOREIGN KEY (post_id) REFERENCES posts (id) '
+               '{} NOT VALID'.format(on_delete))
+    with op.get_context().autocommit_block():
+        op.execute('ALTER TABLE postitems VALIDATE CONSTRAINT postitems_post_id_fkey')
+
+
+def upgrade():
+    # Items orphaned by the post deletes that cleared their post Id
+    op.execute('DELETE FROM postitems WHERE post_id IS NULL')
+    if op.get_bind().dialect.name != 'postgresql':
+        # SQLite cannot alter a constraint without copying the table, which would drop the search triggers
+        return
+    replace_foreign_key('ON DELETE CASCADE')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    replace_foreign_key('')
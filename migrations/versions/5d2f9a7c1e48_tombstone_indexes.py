@@ -0,0 +1,107 @@
+"""tombstone indexes
+
+Revision ID: 5d2f9a7c1e48
+Revises: 7c1d3e5f9b24
+Create Date: 2026-10-19 11:26:40.913562
+
+"""
+from alembic import op
+from contextlib import contextmanager
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2f9a7c1e48'
+down_revision = '7c1d3e5f9b24'
+branch_labels = None
+depends_on = None
+
+LIVE = sa.text('deleted_at IS NULL')
+TOMBSTONED = sa.text('deleted_at IS NOT NULL')
+ITEM_LISTING = ['post_id', sa.text('create_at DESC'), sa.text('id DESC')]
+
+
+def postgresql():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+@contextmanager
+def outside_transaction():
+    """
+    Indexes are built and dropped concurrently on Postgres so that the tables stay
+    writable, which cannot happen in a transaction, so the block runs in alembic's
+    autocommit block there. This migration only changes indexes and env.py commits
+    each migration on its own, so leaving the migration transaction commits nothing
+    else early.
+    :return:
+    """
+    if not postgresql():
+        yield
+        return
+    with op.get_context().autocommit_block():
+        yield
+
+
+def create_index(name, table, columns, where):
+    """
+    Create an index, concurrently on Postgres where an index left invalid by an
+    interrupted run is dropped first.
+    :param name: Index name
+    :param table: Table name
+    :param columns: Indexed columns
+    :param where: Partial index condition or None
+    :return:
+    """
+    if not postgresql():
+        op.create_index(name, table, columns, sqlite_where=where)
+        return
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+    op.create_index(name, table, columns, postgresql_where=where, postgresql_concurrently=True)
+
+
+def drop_index(name, table):
+    """
+    Drop an index, concurrently on Postgres.
+    :param name: Index name
+    :param table: Table name
+    :return:
+    """
+    if not postgresql():
+        op.drop_index(name, table_name=table)
+        return
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+
+
+def replace_index(name, table, columns, where):
+    """
+    Replace an index with a version restricted by where, under the same name. On Postgres
+    the new index is built before the old one is dropped so that queries keep an index.
+    :param name: Index name
+    :param table: Table name
+    :param columns: Indexed columns
+    :param where: Partial index condition or None
+    :return:
+    """
+    if not postgresql():
+        drop_index(name, table)
+        create_index(name, table, columns, where)
+        return
+    create_index(name + '_new', table, columns, where)
+    drop_index(name, table)
+    op.execute('ALTER INDEX {0}_new RENAME TO {0}'.format(name))
+
+
+def upgrade():
+    with outside_transaction():
+        replace_index('ix_posts_user_id_id', 'posts', ['user_id', 'id'], LIVE)
+        replace_index('ix_postitems_post_id_create_at_id', 'postitems', ITEM_LISTING, LIVE)
+        for table in ('posts', 'postitems'):
+            create_index('ix_{}_deleted_at'.format(table), table, ['deleted_at'], TOMBSTONED)
+
+
+def downgrade():
+    with outside_transaction():
+        for table in ('posts', 'postitems'):
+            drop_index('ix_{}_deleted_at'.format(table), table)
+        replace_index('ix_postitems_post_id_create_at_id', 'postitems', ITEM_LISTING, None)
+        replace_index('ix_posts_user_id_id', 'posts', ['user_id', 'id'], None)
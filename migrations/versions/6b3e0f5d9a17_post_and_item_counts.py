@@ -0,0 +1,28 @@
+"""post and item counts
+
+Revision ID: 6b3e0f5d9a17
+Revises: 2d7f8e4a1c6b
+Create Date: 2026-10-18 17:45:33.614209
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b3e0f5d9a17'
+down_revision = '2d7f8e4a1c6b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('posts', sa.Column('item_count', sa.Integer(), server_default='0', nullable=False))
+    op.execute('UPDATE users SET post_count = (SELECT count(*) FROM posts WHERE posts.user_id = users.id)')
+    op.execute('UPDATE posts SET item_count = (SELECT count(*) FROM postitems WHERE postitems.post_id = posts.id)')
+
+
+def downgrade():
+    op.drop_column('posts', 'item_count')
+    op.drop_column('users', 'post_count')
@@ -0,0 +1,32 @@
+"""post and item tombstones
+
+Revision ID: 7c1d3e5f9b24
+Revises: 4a9e1c7f2b68
+Create Date: 2026-10-18 21:14:06.582731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1d3e5f9b24'
+down_revision = '4a9e1c7f2b68'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.add_column('postitems', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    # Posts handed off for purging had their user Id cleared
+    op.execute('UPDATE posts SET deleted_at = CURRENT_TIMESTAMP WHERE user_id IS NULL')
+
+
+def downgrade():
+    # Without the tombstones the deleted rows would be live again
+    op.execute('DELETE FROM postitems WHERE deleted_at IS NOT NULL '
+               'OR post_id IN (SELECT id FROM posts WHERE deleted_at IS NOT NULL)')
+    op.execute('DELETE FROM posts WHERE deleted_at IS NOT NULL')
+    op.drop_column('postitems', 'deleted_at')
+    op.drop_column('posts', 'deleted_at')
@@ -0,0 +1,48 @@
+"""listing indexes
+
+Revision ID: 8f2c5a7d3e90
+Revises: 6b3e0f5d9a17
+Create Date: 2026-10-18 19:02:18.450917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f2c5a7d3e90'
+down_revision = '6b3e0f5d9a17'
+branch_labels = None
+depends_on = None
+
+
+# Indexes serving the post and item listings
+INDEXES = [
+    ('ix_posts_user_id_id', 'posts', ['user_id', 'id']),
+    ('ix_postitems_post_id_create_at_id', 'postitems', ['post_id', sa.text('create_at DESC'), sa.text('id DESC')])
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns)
+        return
+    # Building the indexes concurrently keeps the tables writable, which cannot happen in a
+    # transaction. This migration only builds indexes and env.py commits each migration on
+    # its own, so leaving the migration transaction commits nothing else early.
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            # An index left invalid by an interrupted build is built again
+            op.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table)
+        return
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
@@ -0,0 +1,24 @@
+"""user token epoch
+
+Revision ID: 9c4e27a1d5f0
+Revises: 3b8d1f6c2a9e
+Create Date: 2026-10-18 11:40:07.218554
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4e27a1d5f0'
+down_revision = '3b8d1f6c2a9e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('token_epoch', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('users', 'token_epoch')
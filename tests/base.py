@@ -1,5 +1,11 @@
 from app import app, db
+from app.auth.helper import token_cache
+from app.auth.throttle import throttle
+from app.hashing import hasher
+from app.models import blacklist_filter, post_owners, token_epochs
 from flask_testing import TestCase
+from contextlib import contextmanager
+from sqlalchemy import event
 import json
 
 
@@ -27,6 +33,38 @@ class BaseTestCase(TestCase):
         """
         db.session.remove()
         db.drop_all()
+        token_cache.clear()
+        blacklist_filter.clear()
+        token_epochs.clear()
+        post_owners.clear()
+        hasher.reset()
+        throttle.reset()
+
+    @contextmanager
+    def count_queries(self):
+        """
+        Record the SQL statements executed within the block
+        :return: List the statements are appended to
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    def get_metrics(self):
+        """
+        Read the counters of the metrics endpoint as an operator
+        :return: Dictionary of the metrics
+        """
+        response = self.client.get('v1/metrics', headers={'X-Metrics-Token': app.config['METRICS_TOKEN']})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data.decode())['metrics']
 
     def register_user(self, email, password):
         """
@@ -1,6 +1,12 @@
 from tests.base import BaseTestCase
-from app.models import User
-from app import db
+from app.auth.helper import token_cache
+from app.hashing import hasher, hash_cost, _hash_password
+from app.models import User, token_epochs
+from app import app, db
+from contextlib import closing
+from unittest import mock
+import sqlite3
+import threading
 import unittest
 import json
 import time
@@ -288,6 +294,285 @@ class TestAuthBluePrint(BaseTestCase):
             self.assertTrue(data['status'] == 'failed')
             self.assertTrue(data['message'] == 'Signature expired, Please sign in again')
 
+    def test_verified_token_is_served_from_the_cache(self):
+        """
+        Test that a token is only verified against the database on its first use
+        :return:
+        """
+        with self.client:
+            token = self.register_and_login_in_user()['auth_token']
+            for _ in range(3):
+                response = self.client.get('v1/postlists/id', headers=dict(Authorization='Bearer ' + token))
+                self.assertNotEqual(response.status_code, 401)
+            self.assertEqual(token_cache.misses, 1)
+            self.assertEqual(token_cache.hits, 2)
+            metrics = self.get_metrics()
+            self.assertEqual(metrics['tokenCache']['hits'], 2)
+
+    def test_metrics_require_the_operator_token(self):
+        """
+        Test that the metrics are only served to requests sending the operator token
+        :return:
+        """
+        with self.client:
+            token = self.register_and_login_in_user()['auth_token']
+            for headers in ({}, {'X-Metrics-Token': 'guess'}, {'Authorization': 'Bearer ' + token}):
+                response = self.client.get('v1/metrics', headers=headers)
+                self.assertEqual(response.status_code, 401)
+                self.assertNotIn('metrics', json.loads(response.data.decode()))
+            with mock.patch.dict(app.config, {'METRICS_TOKEN': None}):
+                response = self.client.get('v1/metrics', headers={'X-Metrics-Token': 'metrics-token'})
+                self.assertEqual(response.status_code, 404)
+
+    def test_cached_token_is_invalidated_on_logout(self):
+        """
+        Test that a token verified before logging out is rejected afterwards
+        :return:
+        """
+        with self.client:
+            token = self.register_and_login_in_user()['auth_token']
+            self.client.get('v1/postlists/id', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(len(token_cache), 1)
+            self.logout_user(token)
+            response = self.client.get('v1/postlists/id', headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 401)
+            self.assertTrue(data['message'] == 'Token was Blacklisted, Please login In')
+
+    def test_registration_returns_503_when_hashing_queue_is_full(self):
+        """
+        Test that requests needing a password hash are rejected when no hashing slot frees up
+        in time, as when the other threads of a threaded worker are hashing
+        :return:
+        """
+        self.app.config['HASH_QUEUE_SIZE'] = 0
+        self.app.config['HASH_QUEUE_TIMEOUT_SECONDS'] = 0
+        hasher.reset()
+        started, finish = threading.Event(), threading.Event()
+
+        def slow_hash():
+            started.set()
+            finish.wait(5)
+
+        busy = threading.Thread(target=hasher.submit, args=(slow_hash,))
+        busy.start()
+        started.wait(5)
+        with self.client:
+            try:
+                response = self.register_user('example@gmail.com', '123456')
+            finally:
+                finish.set()
+                busy.join()
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            self.assertTrue(data['status'] == 'failed')
+            self.assertTrue(data['message'] == 'The server is busy, please try again later')
+            self.assertEqual(hasher.rejected, 1)
+
+    def test_password_is_rehashed_on_login_when_cost_changed(self):
+        """
+        Test that a password hashed with another cost factor is rehashed with the configured one on login
+        :return:
+        """
+        user = User('john@gmail.com', '123456')
+        user.password = _hash_password('123456', 5)
+        db.session.add(user)
+        db.session.commit()
+        with self.client:
+            response = self.login_user('john@gmail.com', '123456')
+            self.assertEqual(response.status_code, 200)
+            user = User.get_by_email('john@gmail.com')
+            self.assertEqual(hash_cost(user.password), self.app.config['BCRYPT_HASH_PREFIX'])
+            self.assertFalse(hasher.needs_rehash(user.password))
+            response = self.login_user('john@gmail.com', '123456')
+            self.assertEqual(response.status_code, 200)
+
+    def test_tokens_are_revoked_after_password_reset(self):
+        """
+        Test that the tokens issued before a password reset can no longer be used, and that
+        the session resetting the password gets a refresh token of its own
+        :return:
+        """
+        with self.client:
+            tokens = self.register_and_login_in_user()
+            token = tokens['auth_token']
+            response = self.client.post(
+                'v1/auth/reset/password',
+                headers=dict(Authorization='Bearer ' + token),
+                content_type='application/json',
+                data=json.dumps(dict(oldPassword='123456', newPassword='098765',
+                                     passwordConfirmation='098765')))
+            data = json.loads(response.data.decode())
+            new_token = data['auth_token']
+            self.assertEqual(self.refresh(data['refresh_token']).status_code, 200)
+            self.assertEqual(self.refresh(tokens['refresh_token']).status_code, 401)
+            response = self.client.get('v1/postlists/id', headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 401)
+            self.assertTrue(data['message'] == 'Token was revoked, Please login In')
+            response = self.client.get('v1/postlists/id', headers=dict(Authorization='Bearer ' + new_token))
+            self.assertEqual(response.status_code, 400)
+
+    def test_logout_of_all_sessions(self):
+        """
+        Test that logging out of all sessions revokes every token of the user
+        :return:
+        """
+        with self.client:
+            token = self.register_and_login_in_user()['auth_token']
+            other_token = self.login_user('john@gmail.com', '123456')
+            other_token = json.loads(other_token.data.decode())['auth_token']
+            response = self.client.post('v1/auth/logout/all', headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data['message'] == 'Successfully logged out of all sessions')
+            for used_token in (token, other_token):
+                response = self.client.get('v1/postlists/id', headers=dict(Authorization='Bearer ' + used_token))
+                self.assertEqual(response.status_code, 401)
+
+    def test_new_tokens_are_accepted_with_a_stale_cached_epoch(self):
+        """
+        Test that a worker still caching the epoch from before a logout of all sessions
+        accepts the tokens issued since, and keeps rejecting the revoked ones
+        :return:
+        """
+        with self.client:
+            token = self.register_and_login_in_user()['auth_token']
+            response = self.client.post('v1/auth/logout/all', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(response.status_code, 200)
+            user_id = User.get_by_email('john@gmail.com').id
+            token_epochs.set(user_id, 0)
+            new_token = json.loads(self.login_user('john@gmail.com', '123456').data.decode())['auth_token']
+            response = self.client.get('v1/postlists/id', headers=dict(Authorization='Bearer ' + new_token))
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(token_epochs.get(user_id), 1)
+            response = self.client.get('v1/postlists/id', headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 401)
+            self.assertTrue(data['message'] == 'Token was revoked, Please login In')
+
+    def test_login_attempts_are_throttled_per_email(self):
+        """
+        Test that repeated login attempts for an email are rejected with a Retry-After header
+        :return:
+        """
+        self.app.config['THROTTLE_LOGIN_EMAIL'] = (2, 60)
+        with self.client:
+            for _ in range(2):
+                response = self.login_user('john@gmail.com', '123456')
+                self.assertEqual(response.status_code, 401)
+            response = self.login_user('john@gmail.com', '123456')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 429)
+            self.assertTrue(data['message'] == 'Too many attempts, please try again later')
+            self.assertTrue(0 < int(response.headers['Retry-After']) <= 30)
+            response = self.login_user('jane@gmail.com', '123456')
+            self.assertEqual(response.status_code, 401)
+            metrics = self.get_metrics()
+            self.assertEqual(metrics['throttle']['login.email.throttled'], 1)
+
+    def test_registrations_are_throttled_per_forwarded_client(self):
+        """
+        Test that behind a trusted proxy the clients are told apart by the address the proxy
+        appended to X-Forwarded-For, ignoring the addresses sent by the client
+        :return:
+        """
+        self.app.config.update(TRUSTED_PROXY_HOPS=1, THROTTLE_REGISTER_IP=(1, 3600))
+        with self.client:
+            for email, forwarded_for, status_code in (('a@gmail.com', '1.1.1.1', 201),
+                                                      ('b@gmail.com', '1.1.1.1', 429),
+                                                      ('c@gmail.com', '2.2.2.2', 201),
+                                                      ('d@gmail.com', '3.3.3.3, 1.1.1.1', 429)):
+                response = self.client.post('v1/auth/register', content_type='application/json',
+                                            data=json.dumps(dict(email=email, password='123456')),
+                                            headers={'X-Forwarded-For': forwarded_for})
+                self.assertEqual(response.status_code, status_code, email)
+
+    def test_attempts_throttled_per_email_do_not_use_the_ip_bucket(self):
+        """
+        Test that login attempts rejected for their email are not counted against the client address
+        :return:
+        """
+        self.app.config.update(THROTTLE_LOGIN_EMAIL=(1, 60), THROTTLE_LOGIN_IP=(2, 60))
+        with self.client:
+            for email, status_code in (('john@gmail.com', 401), ('john@gmail.com', 429),
+                                       ('john@gmail.com', 429), ('jane@gmail.com', 401)):
+                response = self.login_user(email, '123456')
+                self.assertEqual(response.status_code, status_code, email)
+
+    def test_idle_throttle_buckets_are_purged(self):
+        """
+        Test that the buckets left idle for longer than the longest refill period are deleted
+        :return:
+        """
+        with self.client:
+            with mock.patch('app.auth.throttle.time.time', return_value=1000.0):
+                self.login_user('john@gmail.com', '123456')
+            with mock.patch('app.auth.throttle.time.time', return_value=1000.0 + 3600 + 60):
+                self.login_user('jane@gmail.com', '123456')
+            with closing(sqlite3.connect(self.app.config['THROTTLE_DB_PATH'])) as connection:
+                keys = sorted(key for key, in connection.execute('SELECT key FROM buckets'))
+            self.assertEqual(keys, ['login:email:jane@gmail.com', 'login:ip:127.0.0.1'])
+
+    def test_refresh_token_is_rotated(self):
+        """
+        Test that a refresh token is exchanged for a new auth token and refresh token
+        :return:
+        """
+        with self.client:
+            login_data = self.register_and_login_in_user()
+            self.assertTrue(login_data['refresh_token'])
+            response = self.refresh(login_data['refresh_token'])
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data['message'] == 'Successfully refreshed')
+            self.assertTrue(data['auth_token'])
+            self.assertNotEqual(data['refresh_token'], login_data['refresh_token'])
+            response = self.client.get('v1/postlists/id', headers=dict(Authorization='Bearer ' + data['auth_token']))
+            self.assertEqual(response.status_code, 400)
+
+    def test_reused_refresh_token_revokes_the_token_family(self):
+        """
+        Test that replaying a rotated refresh token revokes the refresh tokens issued since
+        :return:
+        """
+        with self.client:
+            login_data = self.register_and_login_in_user()
+            new_refresh_token = json.loads(self.refresh(login_data['refresh_token']).data.decode())['refresh_token']
+            response = self.refresh(login_data['refresh_token'])
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 401)
+            self.assertTrue(data['message'] == 'Refresh token was revoked, Please sign in again')
+            response = self.refresh(new_refresh_token)
+            self.assertEqual(response.status_code, 401)
+
+    def test_refresh_token_is_revoked_on_logout(self):
+        """
+        Test that the refresh token sent on logout can no longer be used
+        :return:
+        """
+        with self.client:
+            login_data = self.register_and_login_in_user()
+            self.client.post(
+                'v1/auth/logout',
+                headers=dict(Authorization='Bearer ' + login_data['auth_token']),
+                content_type='application/json',
+                data=json.dumps(dict(refresh_token=login_data['refresh_token'])))
+            response = self.refresh(login_data['refresh_token'])
+            self.assertEqual(response.status_code, 401)
+
+    def refresh(self, refresh_token):
+        """
+        Helper method to exchange a refresh token
+        :param refresh_token: Refresh token
+        :return:
+        """
+        return self.client.post(
+            'v1/auth/refresh',
+            content_type='application/json',
+            data=json.dumps(dict(refresh_token=refresh_token)))
+
     def register_and_login_in_user(self):
         """
         Helper method to sign up and login a user
@@ -1,4 +1,8 @@
+from app import db
 from tests.base import BaseTestCase
+from app.models import User, post, postItem, compact_tombstones
+from app.pagination import encode_cursor
+import datetime
 import unittest
 import json
 
@@ -319,8 +323,7 @@ class TestpostBluePrint(BaseTestCase):
     def test_posts_returned_when_searched(self):
         """
         Test posts are returned when a query search q is present in the url
-        Also test that the next page pagination string is 'http://localhost/postlists/1/items/?page=2'
-        and previous is none
+        Also test that the next page url carries a cursor and previous is none
         :return:
         """
         with self.client:
@@ -336,22 +339,28 @@ class TestpostBluePrint(BaseTestCase):
             self.assertEqual(len(data['posts']), 3)
             self.assertEqual(data['posts'][0]['id'], 1)
             self.assertEqual(data['count'], 6)
-            self.assertEqual(data['next'], 'http://localhost/v1/postlists/?q=T&page=2')
+            self.assertTrue(data['next'].startswith('http://localhost/v1/postlists/?'))
+            self.assertIn('q=T', data['next'])
+            self.assertIn('cursor=', data['next'])
             self.assertEqual(data['previous'], None)
             self.assertEqual(response.status_code, 200)
 
     def test_posts_returned_when_searched_2(self):
         """
         Test posts are returned when a query search q is present in the url
-        Also test that the next page pagination string is None
-        and previous is 'http://localhost/postlists/1/items/?page=1'
+        Also test that following the next page url returns the second page whose next
+        url is None and whose previous url leads back to the first page
         :return:
         """
         with self.client:
             token = self.get_user_token()
             self.create_posts(token)
+            first_page = json.loads(self.client.get(
+                'v1/postlists/?q=T',
+                headers=dict(Authorization='Bearer ' + token)
+            ).data.decode())
             response = self.client.get(
-                'v1/postlists/?q=T&page=2',
+                first_page['next'],
                 headers=dict(Authorization='Bearer ' + token)
             )
             data = json.loads(response.data.decode())
@@ -361,8 +370,320 @@ class TestpostBluePrint(BaseTestCase):
             self.assertEqual(data['posts'][0]['id'], 4)
             self.assertEqual(data['count'], 6)
             self.assertEqual(data['next'], None)
-            self.assertEqual(data['previous'], 'http://localhost/v1/postlists/?q=T&page=1')
+            self.assertIn('q=T', data['previous'])
+            self.assertEqual(response.status_code, 200)
+            previous_page = json.loads(self.client.get(
+                data['previous'],
+                headers=dict(Authorization='Bearer ' + token)
+            ).data.decode())
+            self.assertEqual([item['id'] for item in previous_page['posts']], [1, 2, 3])
+            self.assertEqual(previous_page['previous'], None)
+
+    def test_posts_are_listed_without_count(self):
+        """
+        Test that the count is left out when count=false is sent
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_posts(token)
+            with self.count_queries() as statements:
+                response = self.client.get(
+                    'v1/postlists/?count=false',
+                    headers=dict(Authorization='Bearer ' + token)
+                )
+            data = json.loads(response.data.decode())
+            self.assertEqual(len(data['posts']), 3)
+            self.assertEqual(data['count'], None)
+            self.assertIn('count=false', data['next'])
+            self.assertFalse([statement for statement in statements if 'count(' in statement.lower()])
+
+    def test_post_count_is_read_from_the_user(self):
+        """
+        Test that the listing count follows created and deleted posts without counting them
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_posts(token)
+            self.client.delete('v1/postlists/2', headers=dict(Authorization='Bearer ' + token))
+            with self.count_queries() as statements:
+                response = self.client.get(
+                    'v1/postlists/',
+                    headers=dict(Authorization='Bearer ' + token)
+                )
+            data = json.loads(response.data.decode())
+            self.assertEqual(data['count'], 5)
+            self.assertFalse([statement for statement in statements if 'count(' in statement.lower()])
+
+    def test_invalid_pagination_cursor(self):
+        """
+        Test that a malformed cursor is rejected
+        :return:
+        """
+        with self.client:
+            response = self.client.get(
+                'v1/postlists/?cursor=notacursor',
+                headers=dict(Authorization='Bearer ' + self.get_user_token())
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertTrue(data['message'] == 'Invalid pagination cursor')
+
+    def test_tampered_pagination_cursor(self):
+        """
+        Test that a cursor whose values do not match the sort key is rejected
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            cursors = [('/v1/postlists/', key) for key in [('x',), (True,), (1.5,), (2 ** 70,), (None,)]]
+            cursors += [('/v1/postlists/1/items/', key) for key in
+                        [('x', 1), ({'t': 10 ** 30}, 1), ({'t': 'x'}, 1), ({'t': 0}, 'x'), (1, 1)]]
+            for url, key in cursors:
+                response = self.client.get(
+                    url + '?cursor=' + encode_cursor(key, 'next'),
+                    headers=dict(Authorization='Bearer ' + token)
+                )
+                data = json.loads(response.data.decode())
+                self.assertEqual(response.status_code, 400)
+                self.assertTrue(data['message'] == 'Invalid pagination cursor')
+
+    def test_post_lookup_does_not_load_the_user(self):
+        """
+        Test that getting a post with an already verified token runs a single query
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            with self.count_queries() as statements:
+                response = self.client.get('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(statements), 1)
+            self.assertNotIn('FROM users', statements[0])
+
+
+    def test_deleted_post_is_tombstoned(self):
+        """
+        Test that deleting a post only marks it deleted, which hides it and its items
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            for name in ('mug', 'pan', 'bread'):
+                postItem(name, None, 1).save()
+            db.session.commit()
+            with self.count_queries() as statements:
+                response = self.client.delete('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse([statement for statement in statements if 'postitems' in statement])
+            self.assertFalse([statement for statement in statements if statement.startswith('DELETE')])
+            self.assertIsNotNone(post.query.get(1).deleted_at)
+            self.assertEqual(postItem.query.count(), 3)
+            for url in ('v1/postlists/1', 'v1/postlists/1/items/', 'v1/postlists/1/items/1/'):
+                response = self.client.get(url, headers=dict(Authorization='Bearer ' + token))
+                self.assertEqual(response.status_code, 404, url)
+            response = self.client.delete('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(response.status_code, 404)
+            response = self.client.get('v1/postlists/', headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual((data['count'], data['posts']), (0, []))
+
+    def test_tombstones_are_compacted_in_batches(self):
+        """
+        Test that old tombstones and the items of tombstoned posts are deleted in batches
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_posts(token)
+            for name in ('mug', 'pan', 'bread'):
+                postItem(name, None, 1).save()
+            postItem('map', None, 2).save()
+            postItem('tent', None, 2).save()
+            db.session.commit()
+            self.client.delete('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            self.client.delete('v1/postlists/2/items/4/', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(compact_tombstones(datetime.datetime.utcnow() - datetime.timedelta(days=1), 2), (0, 0))
+            batches = []
+            while not batches or batches[-1] != (0, 0):
+                batches.append(compact_tombstones(datetime.datetime.utcnow() + datetime.timedelta(seconds=1), 2))
+                db.session.commit()
+            self.assertEqual(batches, [(1, 0), (2, 0), (1, 0), (0, 1), (0, 0)])
+            self.assertEqual([item.name for item in postItem.query.all()], ['tent'])
+            self.assertEqual(post.query.count(), 5)
+
+    def test_items_are_embedded_in_the_post_listing(self):
+        """
+        Test that the newest items of every post of the page are loaded with a single query
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_posts(token)
+            for name in ('mug', 'pan', 'bread', 'tent'):
+                postItem(name, None, 1).save()
+            postItem('map', None, 2).save()
+            db.session.commit()
+            with self.count_queries() as statements:
+                response = self.client.get('v1/postlists/?include=items&items_limit=2&count=false',
+                                           headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
             self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(statements), 2)
+            self.assertEqual([[item['name'] for item in user_post['items']] for user_post in data['posts']],
+                             [['tent', 'bread'], ['map'], []])
+            self.assertIn('include=items', data['next'])
+            self.assertIn('items_limit=2', data['next'])
+
+    def test_items_are_embedded_in_a_post(self):
+        """
+        Test that a post is returned with its newest items and that the parameters are validated
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            for number in range(5):
+                postItem('item {}'.format(number), None, 1).save()
+            db.session.commit()
+            response = self.client.get('v1/postlists/1?include=items', headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual([item['name'] for item in data['post']['items']], ['item 4', 'item 3', 'item 2'])
+            response = self.client.get('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            self.assertNotIn('items', json.loads(response.data.decode())['post'])
+            for url in ('v1/postlists/1?include=users', 'v1/postlists/?include=items&items_limit=0',
+                        'v1/postlists/?include=items&items_limit=%C2%B2'):
+                response = self.client.get(url, headers=dict(Authorization='Bearer ' + token))
+                self.assertEqual(response.status_code, 400, url)
+
+    def test_posts_are_returned_with_sparse_fields(self):
+        """
+        Test that the post listing and lookup only return the requested fields
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_posts(token)
+            response = self.client.get('v1/postlists/?fields=name', headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(data['posts'], [{'name': 'travel'}, {'name': 'tral'}, {'name': 'trvel'}])
+            self.assertIn('fields=name', data['next'])
+            response = self.client.get('v1/postlists/1?fields=id,itemCount',
+                                       headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(data['post'], {'id': 1, 'itemCount': 0})
+            response = self.client.get('v1/postlists/1?fields=owner', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(response.status_code, 400)
+
+    def test_posts_are_fetched_by_ids(self):
+        """
+        Test that posts are fetched by their Ids with a single query, in the requested order,
+        with the Ids of missing and deleted posts and of posts of other users reported
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_posts(token)
+            db.session.add(User(email='other@gmail.com', password='123456'))
+            post('other', 2).save()
+            db.session.commit()
+            self.client.delete('v1/postlists/2', headers=dict(Authorization='Bearer ' + token))
+            with self.count_queries() as statements:
+                response = self.client.get('v1/postlists/?ids=5,1,2,7,99,5&fields=id',
+                                           headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(data['posts'], [{'id': 5}, {'id': 1}])
+            self.assertEqual(data['missing'], [2, 7, 99])
+            for ids in ('1,a', '', '%C2%B2', '0', '2147483648', '9' * 5000,
+                        ','.join(str(number) for number in range(1, 102))):
+                response = self.client.get('v1/postlists/?ids=' + ids, headers=dict(Authorization='Bearer ' + token))
+                self.assertEqual(response.status_code, 400, ids)
+
+    def test_posts_are_created_in_bulk(self):
+        """
+        Test that the posts of a bulk request are created and counted at once, with the result
+        of each operation
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            response = self.client.post('v1/postlists/bulk', data=json.dumps(dict(posts=[
+                {'name': 'Travel'}, {'name': ''}, {'name': 'Food'}])),
+                headers=dict(Authorization='Bearer ' + token), content_type='application/json')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([result['status'] for result in data['results']], ['success', 'failed', 'success'])
+            self.assertEqual(data['results'][0]['post']['name'], 'travel')
+            self.assertEqual(data['results'][1]['message'], 'Missing name attribute')
+            self.assertEqual(data['results'][2]['post']['id'], data['results'][0]['post']['id'] + 1)
+            self.assertEqual(User.query.get(1).post_count, 2)
+            for posts in ([], [{'name': 'Travel'}, 'Food'], [{'name': 'Travel'}] * 501):
+                response = self.client.post('v1/postlists/bulk', data=json.dumps(dict(posts=posts)),
+                                            headers=dict(Authorization='Bearer ' + token),
+                                            content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+            self.assertEqual(post.query.count(), 2)
+
+    def test_posts_are_updated_in_bulk(self):
+        """
+        Test that the posts of a bulk request are renamed with a single update, and that the
+        operations for posts of other users, without a name or repeating an Id fail
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_posts(token)
+            db.session.add(User(email='other@gmail.com', password='123456'))
+            post('other', 2).save()
+            db.session.commit()
+            response = self.client.patch('v1/postlists/bulk', data=json.dumps(dict(posts=[
+                {'id': 1, 'name': 'Food'}, {'id': 7, 'name': 'Mine'}, {'id': 'a', 'name': 'Food'},
+                {'id': 1, 'name': 'Drinks'}, {'id': '2'}, {'id': '3', 'name': 'Drinks'}])),
+                headers=dict(Authorization='Bearer ' + token), content_type='application/json')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([result['status'] for result in data['results']],
+                             ['success', 'failed', 'failed', 'failed', 'failed', 'success'])
+            self.assertEqual(data['results'][1]['message'], 'The post with Id 7 does not exist')
+            self.assertEqual(data['results'][5]['post']['name'], 'Drinks')
+            self.assertEqual([user_post.name for user_post in post.query.order_by(post.id)],
+                             ['Food', 'tral', 'Drinks', 'tavel', 'travl', 'trave', 'other'])
+
+    def test_posts_are_deleted_in_bulk(self):
+        """
+        Test that the posts of a bulk request are tombstoned with a single update and taken off
+        the post count, and that the operations for posts of other users or deleted posts fail
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_posts(token)
+            db.session.add(User(email='other@gmail.com', password='123456'))
+            post('other', 2).save()
+            db.session.commit()
+            self.client.delete('v1/postlists/3', headers=dict(Authorization='Bearer ' + token))
+            response = self.client.delete('v1/postlists/bulk', data=json.dumps(dict(posts=[
+                {'id': 1}, {'id': 7}, {'id': 3}, {'id': 2}, {}, {'id': '\u00b2'}, {'id': 10 ** 30}, {'id': True}])),
+                headers=dict(Authorization='Bearer ' + token), content_type='application/json')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['results'], [
+                {'status': 'success', 'id': 1},
+                {'status': 'failed', 'message': 'The post with Id 7 does not exist'},
+                {'status': 'failed', 'message': 'The post with Id 3 does not exist'},
+                {'status': 'success', 'id': 2}] + [
+                {'status': 'failed', 'message': 'Please provide a valid post Id'}] * 4)
+            self.assertEqual(User.query.get(1).post_count, 3)
+            self.assertEqual([user_post.id for user_post in post.query.filter_by(deleted_at=None).order_by(post.id)],
+                             [4, 5, 6, 7])
+            response = self.client.get('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(response.status_code, 404)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 from tests.base import BaseTestCase
+from app.models import post, postItem, post_owners, supports_returning
 import unittest
 import json
 
@@ -187,8 +188,7 @@ class TestpostItem(BaseTestCase):
     def test_items_returned_when_searched(self):
         """
         Test post Items are returned when a query search q is present in the url
-        Also test that the next page pagination string is 'http://localhostv1/postlists/1/items/?page=2'
-        and previous is none
+        Also test that the next page url carries a cursor and previous is none
         :return:
         """
         with self.client:
@@ -206,22 +206,28 @@ class TestpostItem(BaseTestCase):
             self.assertEqual(data['items'][0]['postId'], 1)
             self.assertEqual(data['items'][0]['id'], 6)
             self.assertEqual(data['count'], 6)
-            self.assertEqual(data['next'], 'http://localhost/v1/postlists/1/items/?q=f&page=2')
+            self.assertTrue(data['next'].startswith('http://localhost/v1/postlists/1/items/?'))
+            self.assertIn('q=f', data['next'])
+            self.assertIn('cursor=', data['next'])
             self.assertEqual(data['previous'], None)
             self.assertEqual(response.status_code, 200)
 
     def test_items_returned_when_searched_2(self):
         """
         Test post Items are returned when a query search q is present in the url
-        Also test that the next page pagination is none and previous 'http://localhostv1/postlists/1/items/?page=1'
+        Also test that following the next page url returns the second page whose next url is None
         :return:
         """
         with self.client:
             token = self.get_user_token()
             self.create_post(token)
             self.create_items(token)
+            first_page = json.loads(self.client.get(
+                'v1/postlists/1/items/?q=f',
+                headers=dict(Authorization='Bearer ' + token)
+            ).data.decode())
             response = self.client.get(
-                'v1/postlists/1/items/?q=f&page=2',
+                first_page['next'],
                 headers=dict(Authorization='Bearer ' + token)
             )
             data = json.loads(response.data.decode())
@@ -232,7 +238,7 @@ class TestpostItem(BaseTestCase):
             self.assertEqual(data['items'][0]['id'], 3)
             self.assertEqual(data['count'], 6)
             self.assertEqual(data['next'], None)
-            self.assertEqual(data['previous'], 'http://localhost/v1/postlists/1/items/?q=f&page=1')
+            self.assertIn('q=f', data['previous'])
             self.assertEqual(response.status_code, 200)
 
     def test_empty_item_list_is_returned_when_no_items_in_post(self):
@@ -361,6 +367,390 @@ class TestpostItem(BaseTestCase):
             self.assertTrue(data['message'] == 'Successfully deleted the item from post with Id 1')
             self.assertEqual(response.status_code, 200)
 
+    def test_item_count_is_maintained(self):
+        """
+        Test that the item count of the post follows created and deleted items
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            self.create_items(token)
+            self.client.delete('v1/postlists/1/items/1/', headers=dict(Authorization='Bearer ' + token))
+            response = self.client.get('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(data['post']['itemCount'], 5)
+            with self.count_queries() as statements:
+                response = self.client.get(
+                    'v1/postlists/1/items/',
+                    headers=dict(Authorization='Bearer ' + token)
+                )
+            data = json.loads(response.data.decode())
+            self.assertEqual(data['count'], 5)
+            self.assertFalse([statement for statement in statements if 'count(' in statement.lower()])
+
+    def test_item_lookup_runs_a_single_query(self):
+        """
+        Test that getting an item of the user post runs one query, the owner of the post
+        being cached when it was created
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            self.create_item(token)
+            with self.count_queries() as statements:
+                response = self.client.get('v1/postlists/1/items/1/', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(statements), 1)
+            self.assertNotIn('FROM posts', statements[0])
+
+    def test_item_writes_take_a_single_statement(self):
+        """
+        Test that creating, editing and deleting an item each run one statement where the
+        database supports RETURNING
+        :return:
+        """
+        if not supports_returning():
+            self.skipTest('The database does not support RETURNING')
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            requests = [
+                ('POST', 'v1/postlists/1/items/', dict(name='food', description='bread')),
+                ('PUT', 'v1/postlists/1/items/1/', dict(name='cake')),
+                ('PATCH', 'v1/postlists/1/items/1/', dict(description='chocolate')),
+                ('DELETE', 'v1/postlists/1/items/1/', None)
+            ]
+            for method, url, data in requests:
+                with self.count_queries() as statements:
+                    response = self.client.open(
+                        url,
+                        method=method,
+                        data=json.dumps(data) if data else None,
+                        content_type='application/json',
+                        headers=dict(Authorization='Bearer ' + token)
+                    )
+                self.assertEqual(response.status_code, 200, method)
+                self.assertEqual(len(statements), 1, method)
+            response = self.client.get('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(json.loads(response.data.decode())['post']['itemCount'], 0)
+
+    def test_item_is_patched(self):
+        """
+        Test that a PATCH request only changes the sent attributes and updates the modification time
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            self.create_item(token)
+            response = self.client.patch(
+                'v1/postlists/1/items/1/',
+                data=json.dumps(dict(description='Baking')),
+                content_type='application/json',
+                headers=dict(Authorization='Bearer ' + token)
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data['item']['name'] == 'food')
+            self.assertTrue(data['item']['description'] == 'Baking')
+            self.assertGreater(data['item']['modifiedAt'], data['item']['createdAt'])
+            response = self.client.patch(
+                'v1/postlists/1/items/1/',
+                data=json.dumps(dict(description=None)),
+                content_type='application/json',
+                headers=dict(Authorization='Bearer ' + token)
+            )
+            self.assertIsNone(json.loads(response.data.decode())['item']['description'])
+            response = self.client.patch(
+                'v1/postlists/1/items/1/',
+                data=json.dumps(dict(colour='red')),
+                content_type='application/json',
+                headers=dict(Authorization='Bearer ' + token)
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 401)
+            self.assertTrue(data['message'] == 'No attributes specified in the request')
+            response = self.client.patch(
+                'v1/postlists/1/items/2/',
+                data=json.dumps(dict(name='cake')),
+                content_type='application/json',
+                headers=dict(Authorization='Bearer ' + token)
+            )
+            self.assertEqual(response.status_code, 404)
+
+    def test_post_owner_is_cached_on_first_check(self):
+        """
+        Test that the owner of a post is read once and then served from the cache until the post is deleted
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            self.create_item(token)
+            post_owners.clear()
+            with self.count_queries() as statements:
+                self.client.get('v1/postlists/1/items/1/', headers=dict(Authorization='Bearer ' + token))
+                self.client.get('v1/postlists/1/items/', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(len([statement for statement in statements if 'posts.user_id' in statement]), 1)
+            self.assertFalse([statement for statement in statements if 'FROM posts' in statement
+                              and 'JOIN' not in statement and 'item_count' not in statement])
+            self.assertEqual(self.get_metrics()['postOwnerCache']['hits'], 1)
+            self.client.delete('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            self.assertIsNone(post_owners.get(1))
+            response = self.client.get('v1/postlists/1/items/', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(response.status_code, 404)
+
+    def test_items_of_a_deleted_post_are_not_read_with_a_stale_owner(self):
+        """
+        Test that a worker still caching the owner of a deleted post does not serve its items
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            self.create_item(token)
+            self.client.delete('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            post_owners.set(1, post.query.get(1).user_id)
+            for url in ('v1/postlists/1/items/', 'v1/postlists/1/items/?q=food'):
+                response = self.client.get(url, headers=dict(Authorization='Bearer ' + token))
+                self.assertEqual(json.loads(response.data.decode())['items'], [], url)
+            response = self.client.get('v1/postlists/1/items/?ids=1', headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual((data['items'], data['missing']), ([], [1]))
+            response = self.client.get('v1/postlists/1/items/1/', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(response.status_code, 404)
+
+    def test_item_of_another_post_is_not_found(self):
+        """
+        Test that an item is only found through the post it belongs to
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            self.create_item(token)
+            self.create_post(token)
+            response = self.client.get('v1/postlists/2/items/1/', headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 404)
+            self.assertTrue(data['message'] == 'Item not found')
+            response = self.client.get('v1/postlists/3/items/1/', headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 404)
+            self.assertTrue(data['message'] == 'User has no post with Id 3')
+
+    def test_items_are_returned_with_sparse_fields(self):
+        """
+        Test that only the columns of the requested fields are selected and returned
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            self.create_items(token)
+            with self.count_queries() as statements:
+                response = self.client.get('v1/postlists/1/items/?fields=id,name&count=false',
+                                           headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([sorted(item) for item in data['items']], [['id', 'name']] * 3)
+            self.assertIn('fields=id%2Cname', data['next'])
+            self.assertFalse([statement for statement in statements if 'description' in statement])
+            with self.count_queries() as statements:
+                response = self.client.get('v1/postlists/1/items/1/?fields=name',
+                                           headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(data['item'], {'name': 'food'})
+            self.assertFalse([statement for statement in statements if 'description' in statement])
+            response = self.client.get('v1/postlists/1/items/?fields=name,size',
+                                       headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(data['message'], 'Unknown fields: size')
+
+    def test_items_are_fetched_by_ids(self):
+        """
+        Test that items of a post are fetched by their Ids in the requested order with the missing Ids
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            self.create_items(token)
+            self.client.delete('v1/postlists/1/items/2/', headers=dict(Authorization='Bearer ' + token))
+            response = self.client.get('v1/postlists/1/items/?ids=4,2,1,42&fields=id,name',
+                                       headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['items'], [{'id': 4, 'name': 'foda'}, {'id': 1, 'name': 'food'}])
+            self.assertEqual(data['missing'], [2, 42])
+            for ids in ('x', '%C2%B2', '99999999999999999999999'):
+                response = self.client.get('v1/postlists/1/items/?ids=' + ids,
+                                           headers=dict(Authorization='Bearer ' + token))
+                self.assertEqual(response.status_code, 400, ids)
+                self.assertEqual(json.loads(response.data.decode())['message'],
+                                 'Provide a comma separated list of valid ids')
+            response = self.client.get('v1/postlists/2/items/?ids=1', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(response.status_code, 404)
+
+    def test_items_are_created_in_bulk(self):
+        """
+        Test that the items of a bulk request are created and counted at once, with the result
+        of each operation
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            response = self.client.post('v1/postlists/1/items/bulk', data=json.dumps(dict(items=[
+                {'name': 'Food', 'description': 'Enjoying the good life'}, {'name': ''},
+                {'name': 'Drinks', 'description': 5}, {'name': 'Tea'}])),
+                headers=dict(Authorization='Bearer ' + token), content_type='application/json')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([result['status'] for result in data['results']],
+                             ['success', 'failed', 'failed', 'success'])
+            self.assertEqual(data['results'][0]['item']['name'], 'food')
+            self.assertEqual(data['results'][0]['item']['description'], 'Enjoying the good life')
+            self.assertEqual(data['results'][3]['item']['id'], data['results'][0]['item']['id'] + 1)
+            response = self.client.get('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(json.loads(response.data.decode())['post']['itemCount'], 2)
+            response = self.client.post('v1/postlists/2/items/bulk', data=json.dumps(dict(items=[{'name': 'Food'}])),
+                                        headers=dict(Authorization='Bearer ' + token),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 404)
+            response = self.client.post('v1/postlists/1/items/bulk', data=json.dumps(dict(items='Food')),
+                                        headers=dict(Authorization='Bearer ' + token),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_items_are_moved_and_copied_in_bulk(self):
+        """
+        Test that items are moved and copied to another post of the user with the result of
+        each operation, and that the item counts of both posts follow
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            self.create_items(token)
+            self.create_post(token)
+            self.client.delete('v1/postlists/1/items/2/', headers=dict(Authorization='Bearer ' + token))
+            response = self.client.post('v1/postlists/1/items/bulk/move', data=json.dumps(dict(postId=2, items=[
+                {'id': 1}, {'id': 2}, {'id': 99}, {'id': 'x'}])),
+                headers=dict(Authorization='Bearer ' + token), content_type='application/json')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['results'][0]['item']['postId'], 2)
+            self.assertEqual(data['results'][1:], [
+                {'status': 'failed', 'message': 'The item with Id 2 does not exist'},
+                {'status': 'failed', 'message': 'The item with Id 99 does not exist'},
+                {'status': 'failed', 'message': 'Provide a valid item Id'}])
+            response = self.client.post('v1/postlists/1/items/bulk/copy', data=json.dumps(dict(postId='2', items=[
+                {'id': 3}, {'id': 3}, {'id': 1}])),
+                headers=dict(Authorization='Bearer ' + token), content_type='application/json')
+            data = json.loads(response.data.decode())
+            self.assertEqual([result['status'] for result in data['results']], ['success', 'success', 'failed'])
+            self.assertEqual([result['item']['postId'] for result in data['results'][:2]], [2, 2])
+            self.assertEqual(data['results'][0]['item']['name'], 'foood')
+            response = self.client.get('v1/postlists/2/items/?fields=name',
+                                       headers=dict(Authorization='Bearer ' + token))
+            data = json.loads(response.data.decode())
+            self.assertEqual(sorted(item['name'] for item in data['items']), ['food', 'foood', 'foood'])
+            self.assertEqual(data['count'], 3)
+            response = self.client.get('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(json.loads(response.data.decode())['post']['itemCount'], 4)
+            for post_id, status_code in ((1, 400), (None, 400), ('\u00b2', 400), (3, 404)):
+                response = self.client.post('v1/postlists/1/items/bulk/move',
+                                            data=json.dumps(dict(postId=post_id, items=[{'id': 3}])),
+                                            headers=dict(Authorization='Bearer ' + token),
+                                            content_type='application/json')
+                self.assertEqual(response.status_code, status_code)
+
+    def test_bulk_writes_check_the_post_is_live(self):
+        """
+        Test that items are neither created nor copied in a post deleted since its owner was
+        cached, as by another worker
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            self.create_item(token)
+            self.create_post(token)
+            self.client.delete('v1/postlists/2', headers=dict(Authorization='Bearer ' + token))
+            post_owners.set(2, 1)
+            response = self.client.post('v1/postlists/1/items/bulk/copy',
+                                        data=json.dumps(dict(postId=2, items=[{'id': 1}, {'id': 5}])),
+                                        headers=dict(Authorization='Bearer ' + token),
+                                        content_type='application/json')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['results'], [
+                {'status': 'failed', 'message': 'User has no post with Id 2'},
+                {'status': 'failed', 'message': 'The item with Id 5 does not exist'}])
+            response = self.client.post('v1/postlists/2/items/bulk', data=json.dumps(dict(items=[{'name': 'Food'}])),
+                                        headers=dict(Authorization='Bearer ' + token),
+                                        content_type='application/json')
+            data = json.loads(response.data.decode())
+            self.assertEqual(data['results'], [{'status': 'failed', 'message': 'User has no post with Id 2'}])
+            self.assertEqual(postItem.query.filter_by(post_id=2).count(), 0)
+            self.assertEqual(post.query.get(2).item_count, 0)
+
+    def test_item_writes_check_the_post_is_live(self):
+        """
+        Test that items are neither created, moved nor deleted in a post deleted since its
+        owner was cached, as by another worker
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            self.create_item(token)
+            self.create_post(token)
+            self.client.delete('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            post_owners.set(1, 1)
+            response = self.client.post('v1/postlists/1/items/', data=json.dumps(dict(name='Food')),
+                                        headers=dict(Authorization='Bearer ' + token),
+                                        content_type='application/json')
+            self.assertEqual(json.loads(response.data.decode())['message'], 'User has no post with Id 1')
+            for url, data in (('v1/postlists/1/items/bulk/move', dict(postId=2, items=[{'id': 1}])),
+                              ('v1/postlists/1/items/bulk', dict(items=[{'id': 1}]))):
+                response = self.client.open(url, method='POST' if url.endswith('move') else 'DELETE',
+                                            data=json.dumps(data), headers=dict(Authorization='Bearer ' + token),
+                                            content_type='application/json')
+                self.assertEqual(json.loads(response.data.decode())['results'][0]['status'], 'failed', url)
+            item = postItem.query.get(1)
+            self.assertEqual((item.post_id, item.deleted_at), (1, None))
+            self.assertEqual(postItem.query.count(), 1)
+            self.assertEqual(post.query.get(2).item_count, 0)
+
+    def test_items_are_deleted_in_bulk(self):
+        """
+        Test that the items of a bulk request are tombstoned at once and taken off the item count
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            self.create_post(token)
+            self.create_items(token)
+            response = self.client.delete('v1/postlists/1/items/bulk', data=json.dumps(dict(items=[
+                {'id': 1}, {'id': 3}, {'id': 1}, {'id': 42}])),
+                headers=dict(Authorization='Bearer ' + token), content_type='application/json')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['results'], [
+                {'status': 'success', 'id': 1},
+                {'status': 'success', 'id': 3},
+                {'status': 'success', 'id': 1},
+                {'status': 'failed', 'message': 'The item with Id 42 does not exist'}])
+            response = self.client.get('v1/postlists/1/items/1/', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(response.status_code, 404)
+            response = self.client.get('v1/postlists/1', headers=dict(Authorization='Bearer ' + token))
+            self.assertEqual(json.loads(response.data.decode())['post']['itemCount'], 4)
+
     def create_item(self, token):
         """
         Create an item into a post
@@ -0,0 +1,127 @@
+from app import db
+from tests.base import BaseTestCase
+from app.models import User, post, postItem
+from sqlalchemy import event
+import re
+import unittest
+
+
+class TestQueryPlans(BaseTestCase):
+    """
+    Test that the queries of every endpoint are served by indexes. The statements run
+    while serving requests are explained, and any sequential scan of a table fails
+    the test. Postgres is told to avoid sequential scans so that the small seeded
+    tables do not hide a missing index.
+    """
+
+    def seed(self):
+        """
+        Helper method to save two users with posts and items
+        :return: Token of the first user
+        """
+        for email in ('other@gmail.com', 'example@gmail.com'):
+            user = User(email=email, password='123456')
+            user.save()
+            for number in range(5):
+                user_post = post('travel {}'.format(number), user.id)
+                user_post.save()
+                for item_number in range(5):
+                    postItem('item {}'.format(item_number), 'a travel mug', user_post.id).save()
+        return user.encode_auth_token(user.id).decode('utf-8'), user
+
+    def record(self, requests, token):
+        """
+        Send the requests and record the statements they execute.
+        :param requests: List of (method, url) pairs
+        :param token: Auth token
+        :return: List of (statement, parameters) pairs
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not executemany:
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            for method, url in requests:
+                response = self.client.open(url, method=method, headers=dict(Authorization='Bearer ' + token))
+                self.assertLess(response.status_code, 300, url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return statements
+
+    def sequential_scans(self, statement, parameters):
+        """
+        Explain a statement and return the tables it reads with a sequential scan.
+        :param statement: SQL statement
+        :param parameters: Statement parameters
+        :return: List of table names
+        """
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if db.engine.dialect.name == 'postgresql':
+                cursor.execute('SET enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + statement, parameters)
+                plan = [row[0] for row in cursor.fetchall()]
+                tables = [re.search(r'Seq Scan on (\w+)', line) for line in plan]
+            else:
+                cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+                plan = [row[-1] for row in cursor.fetchall()]
+                tables = [re.match(r'SCAN (?:TABLE )?(\w+)', line) for line in plan]
+            connection.rollback()
+        finally:
+            connection.close()
+        return [table.group(1) for table in tables if table and table.group(1) in db.metadata.tables]
+
+    def assert_no_sequential_scans(self, requests):
+        token, user = self.seed()
+        first_post = user.posts.order_by(post.id).first()
+        first_item = first_post.items.order_by(postItem.id).first()
+        requests = [(method, url.format(post_id=first_post.id, item_id=first_item.id)) for method, url in requests]
+        with self.client:
+            for statement, parameters in self.record(requests, token):
+                if re.match(r'\s*(WITH|SELECT|UPDATE|DELETE)', statement, re.IGNORECASE):
+                    self.assertEqual(self.sequential_scans(statement, parameters), [], statement)
+
+    def test_post_endpoints_use_indexes(self):
+        """
+        Test the queries of the post endpoints
+        :return:
+        """
+        self.assert_no_sequential_scans([
+            ('GET', 'v1/postlists/'),
+            ('GET', 'v1/postlists/?q=travel'),
+            ('GET', 'v1/postlists/?q=t'),
+            ('GET', 'v1/postlists/{post_id}'),
+            ('GET', 'v1/postlists/?include=items'),
+            ('GET', 'v1/postlists/?ids={post_id},1,2')
+        ])
+
+    def test_item_endpoints_use_indexes(self):
+        """
+        Test the queries of the item endpoints
+        :return:
+        """
+        self.assert_no_sequential_scans([
+            ('GET', 'v1/postlists/{post_id}/items/'),
+            ('GET', 'v1/postlists/{post_id}/items/?q=mug'),
+            ('GET', 'v1/postlists/{post_id}/items/?q=m'),
+            ('GET', 'v1/postlists/{post_id}/items/?ids={item_id},1,2'),
+            ('DELETE', 'v1/postlists/{post_id}/items/{item_id}/')
+        ])
+
+    def test_search_endpoint_uses_indexes(self):
+        """
+        Test the queries of the search endpoint
+        :return:
+        """
+        self.assert_no_sequential_scans([
+            ('GET', 'v1/search?q=travel'),
+            ('GET', 'v1/search?q=tr')
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
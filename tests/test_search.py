@@ -0,0 +1,214 @@
+from app import db
+from tests.base import BaseTestCase
+from app.models import User, post, postItem
+from app.pagination import encode_cursor
+from app.search import backend as search
+import json
+import unittest
+
+
+class TestSearchBackend(BaseTestCase):
+    """
+    Test that posts and items are searched through the search indexes
+    """
+
+    def setUp(self):
+        super(TestSearchBackend, self).setUp()
+        user = User(email='example@gmail.com', password='123456')
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+    def create_post(self, name):
+        """
+        Helper method to save a post of the user
+        :param name: post name
+        :return: post
+        """
+        user_post = post(name, self.user_id)
+        user_post.save()
+        return user_post
+
+    def search_posts(self, q):
+        return [user_post.name for user_post in post.query.filter(search.matches(post, q)).order_by(post.id)]
+
+    def test_substrings_are_matched_ignoring_case(self):
+        """
+        Test that a query matches anywhere in the post name whatever its case
+        :return:
+        """
+        self.create_post('Travel to Kampala')
+        self.create_post('Cooking')
+        self.assertEqual(self.search_posts('AMPAL'), ['Travel to Kampala'])
+        self.assertEqual(self.search_posts('ook'), ['Cooking'])
+        self.assertEqual(self.search_posts('zzz'), [])
+
+    def test_short_queries_fall_back_to_like(self):
+        """
+        Test that queries shorter than a trigram are still matched
+        :return:
+        """
+        self.create_post('Travel')
+        self.create_post('Cooking')
+        self.assertEqual(self.search_posts('av'), ['Travel'])
+
+    def test_wildcards_are_matched_literally(self):
+        """
+        Test that LIKE wildcards and FTS operators in the query are not interpreted
+        :return:
+        """
+        self.create_post('100% done')
+        self.create_post('1000 done')
+        self.assertEqual(self.search_posts('0%'), ['100% done'])
+        self.assertEqual(self.search_posts('"0% d'), [])
+
+    def test_search_follows_updates_and_deletes(self):
+        """
+        Test that renamed and deleted posts are searched by their current state
+        :return:
+        """
+        user_post = self.create_post('Travel')
+        user_post.update('Cooking')
+        self.assertEqual(self.search_posts('Travel'), [])
+        self.assertEqual(self.search_posts('Cooking'), ['Cooking'])
+        user_post.delete()
+        self.assertEqual(self.search_posts('Cooking'), [])
+
+    def test_documents_are_only_rewritten_when_they_change(self):
+        """
+        Test that the SQLite search triggers only rewrite a document when its columns are updated
+        :return:
+        """
+        if search.dialect() != 'sqlite':
+            self.skipTest('Only SQLite keeps the documents up to date with triggers')
+        user_post = self.create_post('Travel')
+
+        def rows_written(statement):
+            before = db.session.execute('SELECT total_changes()').scalar()
+            db.session.execute(statement, {'id': user_post.id})
+            return db.session.execute('SELECT total_changes()').scalar() - before
+
+        self.assertEqual(rows_written('UPDATE posts SET item_count = item_count + 1 WHERE id = :id'), 1)
+        self.assertGreater(rows_written("UPDATE posts SET name = 'Cooking' WHERE id = :id"), 1)
+        db.session.expire_all()
+        self.assertEqual(self.search_posts('Cooking'), ['Cooking'])
+
+    def test_items_are_matched_by_name_and_description(self):
+        """
+        Test that items are searched by both their name and description
+        :return:
+        """
+        user_post = self.create_post('Shopping')
+        postItem('Biscuits', 'from the corner shop', user_post.id).save()
+        postItem('Bread', None, user_post.id).save()
+        items = postItem.query.filter(search.matches(postItem, 'corner')).all()
+        self.assertEqual([item.name for item in items], ['Biscuits'])
+        items = postItem.query.filter(search.matches(postItem, 'bread')).all()
+        self.assertEqual([item.name for item in items], ['Bread'])
+
+    def test_closer_matches_are_ranked_first(self):
+        """
+        Test that the rank orders the best matches first
+        :return:
+        """
+        self.create_post('Cooking and travel guide')
+        self.create_post('Travel')
+        rank = search.rank(post, 'travel')
+        posts = post.query.filter(search.matches(post, 'travel')).order_by(rank.desc()).all()
+        self.assertEqual([user_post.name for user_post in posts][0], 'Travel')
+
+
+
+class TestSearchBluePrint(BaseTestCase):
+    """
+    Test the user wide search endpoint
+    """
+
+    def seed(self, user_id):
+        """
+        Helper method to save posts and items of the user and of another user
+        :param user_id: User Id
+        :return:
+        """
+        other_user = User(email='other@gmail.com', password='123456')
+        db.session.add(other_user)
+        db.session.commit()
+        post('travel', other_user.id).save()
+        travel = post('travel plans', user_id)
+        travel.save()
+        cooking = post('cooking', user_id)
+        cooking.save()
+        postItem('travel mug', 'for the road', cooking.id).save()
+        postItem('pan', 'a non stick pan for travel', cooking.id).save()
+        postItem('bread', None, cooking.id).save()
+        return travel, cooking
+
+    def search(self, token, url):
+        response = self.client.get(url, headers=dict(Authorization='Bearer ' + token))
+        return response, json.loads(response.data.decode())
+
+    def test_posts_and_items_of_the_user_are_searched(self):
+        """
+        Test that the posts and items of all the posts of the user are returned with facets
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            travel, cooking = self.seed(1)
+            response, data = self.search(token, 'v1/search?q=Travel')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data['status'] == 'success')
+            self.assertEqual(sorted((hit['type'], hit['name']) for hit in data['hits']),
+                             [('item', 'pan'), ('item', 'travel mug'), ('post', 'travel plans')])
+            self.assertEqual(data['facets'], [
+                {'postId': cooking.id, 'name': 'cooking', 'count': 2},
+                {'postId': travel.id, 'name': 'travel plans', 'count': 1}
+            ])
+            pan = [hit for hit in data['hits'] if hit['name'] == 'pan'][0]
+            self.assertEqual(pan['postId'], cooking.id)
+            self.assertIn('travel', pan['snippet'])
+            self.assertEqual(data['next'], None)
+            self.assertEqual(data['previous'], None)
+
+    def test_hits_are_paginated_with_a_cursor(self):
+        """
+        Test that following the next and previous urls walks all the hits once
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            for name in ('road trip', 'trip one', 'trip two', 'trip three', 'trip four'):
+                post(name, 1).save()
+            response, first_page = self.search(token, 'v1/search?q=trip')
+            self.assertEqual(len(first_page['hits']), 3)
+            self.assertEqual(sum(facet['count'] for facet in first_page['facets']), 5)
+            response, second_page = self.search(token, first_page['next'])
+            self.assertEqual(len(second_page['hits']), 2)
+            self.assertEqual(second_page['next'], None)
+            ids = [hit['id'] for hit in first_page['hits'] + second_page['hits']]
+            self.assertEqual(sorted(ids), [1, 2, 3, 4, 5])
+            ranks = [hit['rank'] for hit in first_page['hits'] + second_page['hits']]
+            self.assertEqual(ranks, sorted(ranks, reverse=True))
+            response, previous_page = self.search(token, second_page['previous'])
+            self.assertEqual(previous_page['hits'], first_page['hits'])
+
+    def test_search_query_is_required(self):
+        """
+        Test that a search without a query is rejected
+        :return:
+        """
+        with self.client:
+            token = self.get_user_token()
+            response, data = self.search(token, 'v1/search?q=%20')
+            self.assertEqual(response.status_code, 400)
+            self.assertTrue(data['message'] == 'Provide a search query')
+            response, data = self.search(token, 'v1/search?q=trip&cursor=notacursor')
+            self.assertEqual(response.status_code, 400)
+            self.assertTrue(data['message'] == 'Invalid pagination cursor')
+            response, data = self.search(token, 'v1/search?q=trip&cursor=' + encode_cursor(('x', 'post', 1), 'next'))
+            self.assertEqual(response.status_code, 400)
+            self.assertTrue(data['message'] == 'Invalid pagination cursor')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+from app import app, db
+from tests.base import BaseTestCase
+from app.models import User, post, post_owners
+from app.unit_of_work import on_commit, unit_of_work
+from contextlib import contextmanager
+from sqlalchemy import event
+from unittest import mock
+import json
+import unittest
+
+
+class TestUnitOfWork(BaseTestCase):
+    """
+    Test that the models stage their changes and that requests and commands commit them at once
+    """
+
+    @contextmanager
+    def count_commits(self):
+        """
+        Record the transactions committed within the block
+        :return: List a None is appended to on each commit
+        """
+        commits = []
+
+        def commit(conn):
+            commits.append(None)
+
+        event.listen(db.engine, 'commit', commit)
+        try:
+            yield commits
+        finally:
+            event.remove(db.engine, 'commit', commit)
+
+    def test_request_commits_once(self):
+        """
+        Test that registering a user and issuing their refresh token take a single commit
+        :return:
+        """
+        with self.client:
+            with self.count_commits() as commits:
+                response = self.register_user('example@gmail.com', '123456')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(len(commits), 1)
+
+    def test_server_error_rolls_back_the_request(self):
+        """
+        Test that the changes staged by a request failing with a server error are not committed
+        :return:
+        """
+        token = self.get_user_token()
+        app.config.update(PROPAGATE_EXCEPTIONS=False, PRESERVE_CONTEXT_ON_EXCEPTION=False)
+        try:
+            with mock.patch('app.post.views.response_for_created_post', side_effect=RuntimeError):
+                response = self.client.post('v1/postlists/', data=json.dumps(dict(name='Travel')),
+                                            headers=dict(Authorization='Bearer ' + token),
+                                            content_type='application/json')
+        finally:
+            app.config.update(PROPAGATE_EXCEPTIONS=None, PRESERVE_CONTEXT_ON_EXCEPTION=None)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(post.query.count(), 0)
+        self.assertEqual(User.query.get(1).post_count, 0)
+        self.assertIsNone(post_owners.get(1))
+
+    def test_commit_callbacks_only_run_once_committed(self):
+        """
+        Test that the callbacks registered in a unit of work run after it commits and are dropped on rollback
+        :return:
+        """
+        calls = []
+        with unit_of_work():
+            on_commit(lambda: calls.append('committed'))
+            self.assertEqual(calls, [])
+        self.assertEqual(calls, ['committed'])
+        with self.assertRaises(RuntimeError):
+            with unit_of_work():
+                User(email='example@gmail.com', password='123456').save()
+                on_commit(lambda: calls.append('rolled back'))
+                raise RuntimeError
+        self.assertEqual(calls, ['committed'])
+        self.assertEqual(User.query.count(), 0)
+
+    def test_post_owner_is_cached_once_committed(self):
+        """
+        Test that a saved post only enters the owner cache when its transaction commits
+        :return:
+        """
+        with unit_of_work():
+            user = User(email='example@gmail.com', password='123456')
+            user.save()
+            user_post = post('travel', user.id)
+            user_post.save()
+            self.assertIsNone(post_owners.get(user_post.id))
+        self.assertEqual(post_owners.get(user_post.id), user.id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,12 @@
 from app import db
 from tests.base import BaseTestCase
-from app.models import User
+from app.auth.provisioning import provision_users, read_users
+from app.hashing import hasher
+from app.models import User, BlackListToken, RefreshToken, blacklist_filter, post, postItem, reconcile_counters
+from unittest import mock
+import datetime
+import os
+import tempfile
 import unittest
 
 
@@ -48,5 +54,181 @@ class TestUserModel(BaseTestCase):
         return auth_token
 
 
+class TestBlackListTokenModel(BaseTestCase):
+    """
+    Test that blacklisted tokens are stored compactly and purged once expired
+    """
+
+    def test_token_digest_and_expiry_are_stored(self):
+        """
+        Test that the digest and expiry of the token are stored instead of the token
+        :return:
+        """
+        user = User(email='example@gmail.com', password='123456')
+        db.session.add(user)
+        db.session.commit()
+        auth_token = user.encode_auth_token(user.id).decode('utf-8')
+        BlackListToken(auth_token).blacklist()
+        row = BlackListToken.query.first()
+        self.assertEqual(len(row.token_digest), 64)
+        self.assertNotEqual(row.token_digest, auth_token)
+        self.assertTrue(row.expires_at > datetime.datetime.utcnow())
+        self.assertTrue(BlackListToken.check_blacklist(auth_token))
+        self.assertFalse(BlackListToken.check_blacklist(auth_token + 'x'))
+
+    def test_tokens_blacklisted_by_other_workers_are_synced(self):
+        """
+        Test that the membership filter picks up rows it did not write itself
+        :return:
+        """
+        db.session.add(BlackListToken('a.b.c', datetime.datetime.utcnow() + datetime.timedelta(hours=1)))
+        db.session.commit()
+        blacklist_filter.sync(force=True)
+        self.assertTrue(BlackListToken.check_blacklist('a.b.c'))
+
+    def test_expired_tokens_are_purged(self):
+        """
+        Test that only the expired blacklisted tokens are deleted
+        :return:
+        """
+        db.session.add(BlackListToken('a.b.c', datetime.datetime.utcnow() - datetime.timedelta(seconds=1)))
+        db.session.add(BlackListToken('d.e.f', datetime.datetime.utcnow() + datetime.timedelta(hours=1)))
+        db.session.commit()
+        self.assertEqual(BlackListToken.purge_expired(), 1)
+        self.assertEqual(BlackListToken.query.count(), 1)
+        self.assertFalse(BlackListToken.check_blacklist('a.b.c'))
+
+
+class TestRefreshTokenModel(BaseTestCase):
+    """
+    Test that refresh tokens are purged once expired
+    """
+
+    def test_expired_refresh_tokens_are_purged(self):
+        """
+        Test that only the expired refresh tokens are deleted, revoked or not
+        :return:
+        """
+        user = User(email='example@gmail.com', password='123456')
+        db.session.add(user)
+        db.session.commit()
+        tokens = [RefreshToken(user.id) for _ in range(3)]
+        tokens[0].expires_at = tokens[1].expires_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        tokens[1].revoked_at = tokens[2].revoked_at = datetime.datetime.utcnow()
+        db.session.add_all(tokens)
+        db.session.commit()
+        self.assertEqual(RefreshToken.purge_expired(), 2)
+        db.session.commit()
+        self.assertEqual([row.id for row in RefreshToken.query.all()], [tokens[2].id])
+
+
+class TestUserProvisioning(BaseTestCase):
+    """
+    Test that users are created in bulk
+    """
+
+    def test_users_are_provisioned_in_batches(self):
+        """
+        Test that new users are created, existing and duplicate emails skipped and invalid records counted
+        :return:
+        """
+        db.session.add(User(email='existing@gmail.com', password='123456'))
+        db.session.commit()
+        records = [
+            {'email': 'existing@gmail.com', 'password': '123456'},
+            {'email': 'one@gmail.com', 'password': '123456'},
+            {'email': 'two@gmail.com', 'password': '654321'},
+            {'email': 'two@gmail.com', 'password': '654321'},
+            {'email': 'three', 'password': '123456'},
+            {'email': 'four@gmail.com', 'password': '123'},
+        ]
+        result = provision_users(records, batch_size=2)
+        self.assertEqual(result['created'], 2)
+        self.assertEqual(result['skipped'], 2)
+        self.assertEqual(result['invalid'], 2)
+        self.assertEqual(User.query.count(), 3)
+        user = User.get_by_email('two@gmail.com')
+        self.assertTrue(hasher.check_password_hash(user.password, '654321'))
+
+    def test_malformed_records_are_counted_as_invalid(self):
+        """
+        Test that records of the wrong types and undecodable json lines are counted as invalid
+        :return:
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'users.ndjson')
+            with open(path, 'w') as users_file:
+                users_file.write('{"email": "one@gmail.com", "password": 123456}\n'
+                                 '{"email": ["two@gmail.com"], "password": "123456"}\n'
+                                 '["three@gmail.com", "123456"]\n'
+                                 'not json\n'
+                                 '{"email": "four@gmail.com", "password": "123456"}\n')
+            result = provision_users(read_users(path), batch_size=2)
+        self.assertEqual((result['created'], result['skipped'], result['invalid']), (1, 0, 4))
+        self.assertEqual([user.email for user in User.query.all()], ['four@gmail.com'])
+
+    def test_users_registered_during_the_import_are_skipped(self):
+        """
+        Test that a user registering between the email lookup and the insert is skipped
+        :return:
+        """
+        hash_many = hasher.hash_many
+
+        def register_then_hash(passwords):
+            db.session.add(User(email='two@gmail.com', password='654321'))
+            db.session.commit()
+            return hash_many(passwords)
+
+        records = [{'email': 'one@gmail.com', 'password': '123456'}, {'email': 'two@gmail.com', 'password': '123456'}]
+        with mock.patch.object(hasher, 'hash_many', side_effect=register_then_hash):
+            result = provision_users(records)
+        self.assertEqual((result['created'], result['skipped'], result['invalid']), (1, 1, 0))
+        self.assertEqual(User.query.count(), 2)
+        self.assertTrue(hasher.check_password_hash(User.get_by_email('two@gmail.com').password, '654321'))
+
+
+
+class TestCounters(BaseTestCase):
+    """
+    Test that the post and item counters are maintained and repaired
+    """
+
+    def test_counters_follow_saves_and_deletes(self):
+        """
+        Test that saving and deleting posts and items updates the counters
+        :return:
+        """
+        user = User(email='example@gmail.com', password='123456')
+        user.save()
+        user_post = post('travel', user.id)
+        user_post.save()
+        post('cooking', user.id).save()
+        item = postItem('mug', None, user_post.id)
+        item.save()
+        item.update('cup')
+        item.save()
+        self.assertEqual(User.query.get(user.id).post_count, 2)
+        self.assertEqual(post.query.get(user_post.id).item_count, 1)
+        item.delete()
+        user_post.delete()
+        self.assertEqual(User.query.get(user.id).post_count, 1)
+
+    def test_drifted_counters_are_reconciled(self):
+        """
+        Test that counters of rows written without the models are repaired
+        :return:
+        """
+        user = User(email='example@gmail.com', password='123456')
+        user.save()
+        user_post = post('travel', user.id)
+        db.session.add(user_post)
+        db.session.commit()
+        db.session.add_all([postItem('mug', None, user_post.id), postItem('pan', None, user_post.id)])
+        db.session.commit()
+        self.assertEqual(reconcile_counters(), (1, 1))
+        self.assertEqual(User.query.get(user.id).post_count, 1)
+        self.assertEqual(post.query.get(user_post.id).item_count, 2)
+        self.assertEqual(reconcile_counters(), (0, 0))
+
 if __name__ == '__main__':
     unittest.main()